@@ -18,6 +18,7 @@ from pathlib import Path
 
 import bemserver_service_acquisition_mqtt as svc
 from bemserver_service_acquisition_mqtt.service import Service
+from bemserver_service_acquisition_mqtt.supervisor import Supervisor
 from bemserver_service_acquisition_mqtt.exceptions import ServiceError
 
 
@@ -35,7 +36,20 @@ def signal_term_handler(sigcode, frame):
     stop_service()
 
 
+def signal_hup_handler(sigcode, frame):
+    """Callback for SIGHUP signal.
+
+    This signal is sent by systemd when the service is reloaded: topology
+    changes (subscribers, topics...) are applied without restart.
+    """
+    sig = signal.Signals(sigcode)
+    logger.debug(f"Service received {sig.name} ({sigcode}) signal.")
+    if service is not None and service.is_running:
+        service.request_reload()
+
+
 signal.signal(signal.SIGTERM, signal_term_handler)
+signal.signal(signal.SIGHUP, signal_hup_handler)
 
 
 def echo_version(ctx, param, value):
@@ -56,10 +70,14 @@ def echo_version(ctx, param, value):
     "-v", "--verbose", is_flag=True, default=False, help="Print log messages.")
 @click.option(
     "-d", "--debug", is_flag=True, default=False, help="Set debug mode.")
+@click.option(
+    "-w", "--workers", type=click.IntRange(min=0), default=0,
+    show_default=True,
+    help="Number of worker processes sharing subscribers (0: no workers).")
 @click.option(
     "--version", is_flag=True, callback=echo_version, expose_value=False,
     is_eager=True, help="Show application version.")
-def main(config_file, verbose, debug):
+def main(config_file, verbose, debug, workers):
     """BEMServer service - Timeseries acquisition through MQTT
 
     CONFIG_FILE is the path name of the service configuration file.
@@ -70,6 +88,9 @@ def main(config_file, verbose, debug):
         If True prints log messages in console output.
     :param bool debug: (optional, default False)
         If True forces log level to DEBUG.
+    :param int workers: (optional, default 0)
+        Number of worker processes, run by a supervisor. Service runs in
+        this process if 0.
     """
     svc_config = load_config(config_file)
     init_logger(svc_config["logging"], verbose=verbose, debug=debug)
@@ -77,8 +98,12 @@ def main(config_file, verbose, debug):
     logger.info(f"Service PID: {os.getpid()}...")
 
     global service
-    service = Service(svc_config["working_dirpath"])
-    service.set_db_url(svc_config["db_url"])
+    if workers > 0:
+        # SIGTERM is forwarded to workers when supervisor stops.
+        service = Supervisor(
+            svc_config, workers, verbose=verbose, debug=debug)
+    else:
+        service = create_service(svc_config)
     try:
         service.run()
     except ServiceError as exc:
@@ -87,12 +112,39 @@ def main(config_file, verbose, debug):
     try:
         while service.is_running:
             time.sleep(1)
+            if service.is_reload_requested:
+                service.reload()
     except KeyboardInterrupt:
         logger.warning("Service received Ctrl+C and will stop.")
     finally:
         stop_service()
 
 
+def create_service(svc_config):
+    """Create and configure the service.
+
+    :param dict svc_config: Service parameters (see `load_config`).
+    :returns Service: The service, ready to run.
+    """
+    service = Service(svc_config["working_dirpath"])
+    service.set_db_url(svc_config["db_url"])
+    if "ingestion" in svc_config:
+        service.set_ingestion(**svc_config["ingestion"])
+    if "network_loop" in svc_config:
+        service.set_network_loop(svc_config["network_loop"])
+    if "json_backend" in svc_config:
+        service.set_json_backend(svc_config["json_backend"])
+    if "timestamp_cache" in svc_config:
+        service.set_timestamp_cache(svc_config["timestamp_cache"])
+    if "metrics" in svc_config:
+        service.set_metrics(**svc_config["metrics"])
+    if "connection" in svc_config:
+        service.set_connection(**svc_config["connection"])
+    if "reload" in svc_config:
+        service.set_reload(**svc_config["reload"])
+    return service
+
+
 def stop_service():
     """Stop the service and exit program."""
     if service is None:
@@ -124,7 +176,8 @@ def load_config(config_filepath, *, verify=True):
     return svc_config
 
 
-def init_logger(log_config, *, verbose=False, debug=False):
+def init_logger(log_config, *, verbose=False, debug=False,
+                filename_suffix=""):
     """Initialize service logger.
 
     :param dict log_config: An instance of service log configuration.
@@ -132,6 +185,9 @@ def init_logger(log_config, *, verbose=False, debug=False):
         If True prints log messages in console output.
     :param bool debug: (optional, default False)
         If True forces log level to DEBUG.
+    :param str filename_suffix: (optional, default "")
+        Suffix of log file name, for worker processes not to share the same
+        log file.
     """
     # Create our custom record formatters.
     defaultFormat = (
@@ -154,8 +210,11 @@ def init_logger(log_config, *, verbose=False, debug=False):
     # Create a daily rotated log file handler for logger.
     # See example: http://stackoverflow.com/a/25387192
     if "dirpath" in log_config:
+        logfile_path = (
+            Path(log_config["dirpath"])
+            / f"{svc.__binname__}{filename_suffix}.log")
         logfile_handler = TimedRotatingFileHandler(
-            Path(log_config["dirpath"]) / f"{svc.__binname__}.log",
+            logfile_path,
             when="midnight", backupCount=log_config["history"], utc=True)
         logfile_handler.suffix = "%Y-%m-%d"
         logfile_handler.extMatch = re.compile(r"^\d{4}-\d{2}-\d{2}$")
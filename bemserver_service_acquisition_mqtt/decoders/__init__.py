@@ -4,11 +4,15 @@ from bemserver_service_acquisition_mqtt.exceptions import (
     PayloadDecoderNotFoundError,
 )
 
+from . import jsonlib, timestamps, batch, declarative  # noqa
 from .base import PayloadDecoderBase  # noqa
 from .bemserver import PayloadDecoderBEMServer
 from .chirpstack import (
     PayloadDecoderChirpstackARF8200AA, PayloadDecoderChirpstackEM300TH868,
     PayloadDecoderChirpstackUC11, PayloadDecoderChirpstackEAGLE1500)
+from .lorawan import (
+    PayloadDecoderChirpstackFrameARF8200AA,
+    PayloadDecoderChirpstackFrameEM300TH868, PayloadDecoderChirpstackFrameUC11)
 
 
 _PAYLOAD_DECODERS = {
@@ -18,6 +22,9 @@ _PAYLOAD_DECODERS = {
         PayloadDecoderChirpstackEM300TH868,
         PayloadDecoderChirpstackUC11,
         PayloadDecoderChirpstackEAGLE1500,
+        PayloadDecoderChirpstackFrameARF8200AA,
+        PayloadDecoderChirpstackFrameEM300TH868,
+        PayloadDecoderChirpstackFrameUC11,
     ]
 }
 
@@ -35,3 +42,11 @@ def get_payload_decoder_cls(payload_decoder_name):
     except KeyError:
         raise PayloadDecoderNotFoundError(
             f"{payload_decoder_name} decoder not found!")
+
+
+def register_payload_decoder_cls(decoder_cls):
+    """Register a payload decoder class, replacing any of the same name.
+
+    :param PayloadDecoderBase decoder_cls: Payload decoder class.
+    """
+    _PAYLOAD_DECODERS[decoder_cls.name] = decoder_cls
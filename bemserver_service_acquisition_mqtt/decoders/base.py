@@ -3,72 +3,290 @@
 import logging
 import abc
 import datetime as dt
-import sqlalchemy as sqla
 
-from bemserver_core.database import db
-from bemserver_core.model import TimeseriesData
 from bemserver_service_acquisition_mqtt import SERVICE_LOGNAME
+from bemserver_service_acquisition_mqtt import metrics
+from bemserver_service_acquisition_mqtt.routing import RouteLink
+from bemserver_service_acquisition_mqtt.ingestion import (
+    TimeseriesDataWriterInsert)
 from bemserver_service_acquisition_mqtt.exceptions import PayloadDecoderError
 
+from .batch import require_numpy, make_batch, parse_timestamps_array
+from .timestamps import to_epoch_us
+
 
 logger = logging.getLogger(SERVICE_LOGNAME)
 
+# Used to write values when no buffer is set.
+_direct_writer = TimeseriesDataWriterInsert()
+
 
 class PayloadDecoderBase(abc.ABC):
 
     name = None
     description = None
     fields = []
+    # Optional method decoding a payload without parsing its timestamp,
+    #  returning ISO 8601 timestamp (str) and values (dict): decoders
+    #  implementing it are faster to decode by batches, timestamps being
+    #  parsed all at once.
+    _decode_raw = None
 
     @property
     def _log_header(self):
         return f"[Payload decoder {self.name}]"
 
-    def __init__(self, topic):
+    def __init__(self, topic, *, buffer=None, timestamp_cache=None):
         self._db_topic = topic
+        # When set, decoded values are written in database by batches.
+        self.buffer = buffer
+        # When set, values already in database are dropped before writing.
+        self.timestamp_cache = timestamp_cache
+        # Topic data, set when compiled.
+        self._topic_name = None
+        self._on_conflict = None
+        self.links = None
 
         self.timestamp_last_reception = None
 
+    @property
+    def is_compiled(self):
+        return self.links is not None
+
+    @property
+    def topic_name(self):
+        """Name of topic (filter of wildcard topics), once compiled."""
+        return self._topic_name
+
+    def compile(self, links=None):
+        """Read once from topic (database) what is needed to save values.
+
+        Once compiled, processing messages does not access topic attributes
+        (nor database) anymore: topic changes are ignored, the decoder must
+        be replaced by a new compiled one.
+
+        :param tuple links: (optional, default None)
+            Links (`RouteLink` tuples) to use instead of topic links, for
+            example those of a device of a wildcard topic (see
+            `TopicDeviceLink`).
+        """
+        self._topic_name = self._db_topic.name
+        self._on_conflict = self._db_topic.on_conflict
+        if links is None:
+            links = (
+                RouteLink(x.payload_field.name, x.timeseries_id)
+                for x in self._db_topic.links
+            )
+        self.links = tuple(links)
+
     def on_message(self, client, userdata, msg):
-        # /!\ note that if message is retained, it can already be in database
+        # /!\ note that if message is retained (or redelivered), it can
+        #  already be in database: see timestamp cache.
 
         # TODO: save timestamp_last_reception in timeseries data record?
         self.timestamp_last_reception = dt.datetime.now(dt.timezone.utc)
 
         try:
             timestamp, values = self._decode(msg.payload)
-        except PayloadDecoderError:
-            # TODO: raise or log error
-            pass
+        except (
+                PayloadDecoderError, LookupError, TypeError, ValueError
+        ) as exc:
+            # Invalid payload (missing key...): must not stop the MQTT
+            #  network thread (paho raises callbacks exceptions again).
+            metrics.DECODE_FAILURES.labels(self.name).inc()
+            logger.warning(
+                f"{self._log_header} invalid payload from topic"
+                f" {msg.topic}: {exc!r}")
         else:
-            self._save_to_db(timestamp, values)
+            self._save_to_db(
+                timestamp, values, retain=bool(msg.retain),
+                dup=bool(msg.dup))
 
     @abc.abstractmethod
     def _decode(self, raw_payload):
-        logger.debug(f"{self._log_header} decoding {raw_payload}")
-        return dt.datetime.now(dt.timezone.utc), {}
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{self._log_header} decoding {raw_payload}")
+        # Default timestamp: message reception time.
+        return self.timestamp_last_reception, {}
+
+    def decode_batch(self, raw_payloads):
+        """Decode a batch of payloads to columnar arrays.
+
+        Invalid payloads are skipped (and counted in a warning log).
+
+        :param list raw_payloads: Payloads to decode.
+        :returns DecodedBatch: Timestamps (microseconds since Unix epoch),
+            index of fields (in `fields`) and values, as numpy arrays.
+        :raises ImportError: When numpy is not installed.
+        """
+        np = require_numpy()
+        self.timestamp_last_reception = dt.datetime.now(dt.timezone.utc)
+        field_indexes = {x: idx for idx, x in enumerate(self.fields)}
+        has_raw = self._decode_raw is not None
+        timestamps = []
+        batch_fields = []
+        batch_values = []
+        # Number of values of each payload, to repeat its timestamp.
+        nb_values = []
+        nb_invalid = 0
+        for raw_payload in raw_payloads:
+            try:
+                if has_raw:
+                    timestamp, values = self._decode_raw(raw_payload)
+                    if not isinstance(timestamp, str):
+                        raise PayloadDecoderError("Invalid timestamp!")
+                else:
+                    timestamp, values = self._decode(raw_payload)
+                    timestamp = to_epoch_us(timestamp)
+                payload_values = [
+                    (field_indexes[name], float(value))
+                    for name, value in values.items()
+                    if name in field_indexes
+                ]
+            except (PayloadDecoderError, LookupError, TypeError, ValueError):
+                nb_invalid += 1
+                continue
+            timestamps.append(timestamp)
+            nb_values.append(len(payload_values))
+            for field_index, value in payload_values:
+                batch_fields.append(field_index)
+                batch_values.append(value)
+        if nb_invalid:
+            metrics.DECODE_FAILURES.labels(self.name).inc(nb_invalid)
+            logger.warning(
+                f"{self._log_header} {nb_invalid} invalid payloads skipped")
+
+        if has_raw:
+            try:
+                timestamps = parse_timestamps_array(timestamps)
+            except PayloadDecoderError:
+                # Find invalid timestamps to skip them only.
+                return self._decode_batch_invalid_timestamps(
+                    timestamps, nb_values, batch_fields, batch_values)
+        return make_batch(
+            np.repeat(np.array(timestamps, dtype=np.int64), nb_values),
+            batch_fields, batch_values)
+
+    def _decode_batch_invalid_timestamps(
+            self, timestamps, nb_values, batch_fields, batch_values):
+        np = require_numpy()
+        valid = []
+        epoch_us = []
+        for timestamp in timestamps:
+            try:
+                epoch_us.extend(parse_timestamps_array([timestamp]))
+            except PayloadDecoderError:
+                valid.append(False)
+            else:
+                valid.append(True)
+        metrics.DECODE_FAILURES.labels(self.name).inc(valid.count(False))
+        logger.warning(
+            f"{self._log_header} {valid.count(False)} payloads"
+            " with invalid timestamp skipped")
+        values_mask = np.repeat(valid, nb_values)
+        return make_batch(
+            np.repeat(
+                np.array(epoch_us, dtype=np.int64),
+                np.array(nb_values)[valid]),
+            np.array(batch_fields, dtype=np.int32)[values_mask],
+            np.array(batch_values, dtype=np.float64)[values_mask])
+
+    def timeseries_arrays(self, batch):
+        """Get values of a decoded batch to write, by linked timeseries.
+
+        Values of fields not linked to a timeseries are dropped.
+
+        :param DecodedBatch batch: Decoded batch.
+        :returns tuple: Timeseries IDs, timestamps and values arrays.
+        """
+        np = require_numpy()
+        _, _, links = self._get_links()
+        # Timeseries ID of each field (-1 when not linked).
+        field_ts_ids = np.full(len(self.fields), -1, dtype=np.int64)
+        for field_name, timeseries_id in links:
+            if field_name in self.fields:
+                field_ts_ids[self.fields.index(field_name)] = timeseries_id
+        timeseries_ids = field_ts_ids[batch.field_indexes]
+        linked = timeseries_ids >= 0
+        return (
+            timeseries_ids[linked], batch.timestamps[linked],
+            batch.values[linked])
+
+    def save_batch(self, raw_payloads, *, writer=None, connection=None):
+        """Decode a batch of payloads and write values in database at once.
+
+        Intended for replays and backfills: values are not buffered.
+
+        :param list raw_payloads: Payloads to decode.
+        :param TimeseriesDataWriterBase writer: (optional, default None)
+            Writer to use. If None, values are inserted.
+        :param sqlalchemy.engine.Connection connection: (optional)
+            Database connection to use. If None, one is taken from pool.
+        :returns int: Number of values written.
+        """
+        topic_name, on_conflict, _ = self._get_links()
+        timeseries_ids, timestamps, values = self.timeseries_arrays(
+            self.decode_batch(raw_payloads))
+        if writer is None:
+            writer = _direct_writer
+        nb_written = writer.write_arrays(
+            timeseries_ids, timestamps, values, on_conflict=on_conflict,
+            connection=connection)
+        logger.info(
+            f"{self._log_header} {nb_written} values written"
+            f" (from {len(raw_payloads)} payloads) for topic {topic_name}")
+        return nb_written
 
-    def _save_to_db(self, timestamp, values):
+    def _get_links(self):
+        if self.is_compiled:
+            return self._topic_name, self._on_conflict, self.links
         if self._db_topic is None:
-            raise PayloadDecoderError("No topic defined to save to database!")
+            raise PayloadDecoderError(
+                "No topic defined to save to database!")
+        links = [
+            RouteLink(x.payload_field.name, x.timeseries_id)
+            for x in self._db_topic.links
+        ]
+        return self._db_topic.name, self._db_topic.on_conflict, links
 
-        logger.debug(f"{self._log_header} saving decoded data"
-                     f" from topic {self._db_topic.name}")
+    def _save_to_db(self, timestamp, values, *, retain=False, dup=False):
+        topic_name, on_conflict, links = self._get_links()
 
-        for topic_link in self._db_topic.links:
-            if topic_link.payload_field.name not in values:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{self._log_header} saving decoded data"
+                         f" from topic {topic_name}")
+
+        if timestamp.tzinfo is None:
+            # Naive timestamp (custom decoder): in UTC, as when parsed.
+            timestamp = timestamp.replace(tzinfo=dt.timezone.utc)
+
+        rows = []
+        for field_name, timeseries_id in links:
+            if field_name not in values:
                 logger.warning(
-                    f"{self._log_header} no {topic_link.payload_field.name}"
-                    f" value to save for topic {self._db_topic.name}!")
+                    f"{self._log_header} no {field_name}"
+                    f" value to save for topic {topic_name}!")
                 continue
-            tsdata = TimeseriesData(
-                timeseries_id=topic_link.timeseries_id,
-                timestamp=timestamp,
-                value=values[topic_link.payload_field.name],
-            )
-            db.session.add(tsdata)
-            try:
-                db.session.commit()
-            except sqla.exc.IntegrityError:
-                db.session.rollback()
-                # TODO: raise or log error
+            rows.append((timeseries_id, timestamp, values[field_name]))
+
+        if self.timestamp_cache is not None:
+            rows = self.timestamp_cache.filter(
+                rows, on_conflict=on_conflict, retain=retain, dup=dup)
+            if len(rows) <= 0:
+                return
+
+        if self.buffer is not None:
+            self.buffer.extend(rows, on_conflict=on_conflict)
+            return
+
+        try:
+            nb_written = _direct_writer.write(rows, on_conflict=on_conflict)
+        except Exception:
+            if self.timestamp_cache is not None:
+                # Values lost: do not drop them when sent again.
+                self.timestamp_cache.forget(rows)
+            raise
+        if nb_written < len(rows):
+            logger.info(
+                f"{self._log_header} {len(rows) - nb_written} values skipped"
+                f" for topic {topic_name} (already in database)")
@@ -0,0 +1,84 @@
+"""Batch decoding of payloads, to columnar arrays
+
+Decoding a batch of payloads (see `PayloadDecoderBase.decode_batch`) gives
+`DecodedBatch` numpy arrays instead of a datetime and a dict per message:
+    - timestamps: int64, microseconds since Unix epoch
+    - field_indexes: int32, index of field in decoder `fields`
+    - values: float64
+
+numpy is an optional dependency:
+    pip install bemserver-service-acquisition-mqtt[numpy]
+"""
+
+import collections
+
+from .timestamps import parse_timestamps_epoch_us
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+DecodedBatch = collections.namedtuple(
+    "DecodedBatch", ("timestamps", "field_indexes", "values"))
+
+
+def require_numpy():
+    """Get numpy module.
+
+    :raises ImportError: When numpy is not installed.
+    """
+    if np is None:
+        raise ImportError(
+            "numpy is required to decode payloads by batches"
+            " (pip install bemserver-service-acquisition-mqtt[numpy])")
+    return np
+
+
+def make_batch(timestamps, field_indexes, values):
+    """Build a decoded batch from lists.
+
+    :param list timestamps: Microseconds since Unix epoch.
+    :param list field_indexes: Index of each value's field.
+    :param list values: Values (None is NaN).
+    :returns DecodedBatch: Batch of numpy arrays.
+    """
+    np = require_numpy()
+    return DecodedBatch(
+        np.array(timestamps, dtype=np.int64),
+        np.array(field_indexes, dtype=np.int32),
+        np.array(values, dtype=np.float64),
+    )
+
+
+def parse_timestamps_array(timestamps):
+    """Parse ISO 8601 UTC timestamps to an array of epoch microseconds.
+
+    UTC timestamps ("Z" or "+00:00") are parsed by numpy, at once. Others
+    are parsed one by one (see `parse_timestamp`: UTC if no time zone).
+
+    :param list timestamps: ISO 8601 timestamps.
+    :returns numpy.ndarray: Microseconds since Unix epoch, as int64.
+    :raises PayloadDecoderError: When a timestamp is not valid.
+    """
+    np = require_numpy()
+    naive_utc = []
+    for timestamp in timestamps:
+        if timestamp[-1:] == "Z":
+            naive_utc.append(timestamp[:-1])
+        elif timestamp[-6:] == "+00:00":
+            naive_utc.append(timestamp[:-6])
+        else:
+            break
+    else:
+        try:
+            epoch_us = np.array(
+                naive_utc, dtype="datetime64[us]").astype(np.int64)
+        except ValueError:
+            pass
+        else:
+            # Empty strings are parsed as NaT.
+            if not (epoch_us == np.iinfo(np.int64).min).any():
+                return epoch_us
+    return np.array(parse_timestamps_epoch_us(timestamps), dtype=np.int64)
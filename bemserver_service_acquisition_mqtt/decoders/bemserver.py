@@ -1,10 +1,8 @@
 """Decoder for BEMServer payloads"""
 
-import json
-import datetime as dt
-
 from .base import PayloadDecoderBase
-from bemserver_service_acquisition_mqtt.exceptions import PayloadDecoderError
+from .jsonlib import JSONProjection
+from .timestamps import parse_timestamp
 
 
 class PayloadDecoderBEMServer(PayloadDecoderBase):
@@ -13,14 +11,16 @@ class PayloadDecoderBEMServer(PayloadDecoderBase):
     description = "Default BEMServer payload decoder"
     fields = ["value"]
 
+    _json_projection = JSONProjection(("ts", "value",))
+
     def _decode(self, raw_payload):
-        timestamp, values = super()._decode(raw_payload)
-        try:
-            json_payload = json.loads(raw_payload)
-        except json.decoder.JSONDecodeError as exc:
-            raise PayloadDecoderError(str(exc))
-        timestamp = dt.datetime.fromisoformat(
-            json_payload["ts"].replace("Z", "+00:00"))
+        super()._decode(raw_payload)
+        timestamp, values = self._decode_raw(raw_payload)
+        return parse_timestamp(timestamp), values
+
+    def _decode_raw(self, raw_payload):
+        json_payload = self._json_projection(raw_payload)
+        values = {}
         if "value" in json_payload:
             values["value"] = float(json_payload["value"])
-        return timestamp, values
+        return json_payload["ts"], values
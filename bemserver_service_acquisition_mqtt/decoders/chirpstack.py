@@ -1,30 +1,27 @@
 """Decoder for Chirpstack payloads"""
 
-import json
-import datetime as dt
-
 from .base import PayloadDecoderBase
-from bemserver_service_acquisition_mqtt.exceptions import PayloadDecoderError
+from .jsonlib import JSONProjection, loads
+from .timestamps import parse_timestamp
 
 
 class PayloadDecoderChirpstackBase(PayloadDecoderBase):
 
+    # Reception time of first gateway (rxInfo) and device values.
+    _json_projection = JSONProjection(("rxInfo", "objectJSON",))
+
     def _decode(self, raw_payload):
-        timestamp, _ = super()._decode(raw_payload)
-        try:
-            json_payload = json.loads(raw_payload)
-        except json.decoder.JSONDecodeError as exc:
-            raise PayloadDecoderError(str(exc))
-        # example: 2021-04-16T14:03:13.432986Z
-        timestamp = dt.datetime.fromisoformat(
-            json_payload["rxInfo"][0]["time"].replace("Z", "+00:00"))
+        super()._decode(raw_payload)
+        timestamp, values = self._decode_raw(raw_payload)
+        return parse_timestamp(timestamp), values
+
+    def _decode_raw(self, raw_payload):
+        json_payload = self._json_projection(raw_payload)
         data = json_payload.get("objectJSON", {})
         if isinstance(data, str):
-            try:
-                data = json.loads(data)
-            except json.decoder.JSONDecodeError as exc:
-                raise PayloadDecoderError(str(exc))
-        return timestamp, self._decode_values(data)
+            data = loads(data)
+        # example: 2021-04-16T14:03:13.432986Z
+        return json_payload["rxInfo"][0]["time"], self._decode_values(data)
 
     def _decode_values(self, data):
         return {
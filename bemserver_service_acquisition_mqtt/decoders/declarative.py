@@ -0,0 +1,195 @@
+"""Declarative payload decoders
+
+A declarative decoder is described in database (see `PayloadDecoder` model)
+instead of code: the path to payload timestamp and, for each field, the path
+to its value and its type. A path is a dot separated list of keys and list
+indexes in a JSON payload, for example: "rxInfo.0.time". Integer segments are
+list indexes: a numeric key is double quoted ('data."0"'). Keys containing
+dots can not be addressed.
+
+A top level value that is a JSON document in a string (for example Chirpstack
+`objectJSON`) is decoded when a path goes through it.
+
+Each description is compiled once in an extractor function, with one
+expression per value (`payload["objectJSON"]["channelA"]["value"]`), then in
+a decoder class registered among others.
+"""
+
+import enum
+
+from bemserver_service_acquisition_mqtt.exceptions import PayloadDecoderError
+
+from .base import PayloadDecoderBase
+from .jsonlib import JSONProjection, loads
+from .timestamps import parse_timestamp
+
+
+PATH_SEPARATOR = "."
+KEY_QUOTE = '"'
+
+
+class ValueType(enum.Enum):
+    """Type of field values.
+
+    Values are coerced as by Python builtins: int truncates numbers toward
+    zero (21.9 gives 21) and only accepts integer strings ("21.5" is an
+    invalid value). bool also accepts "true"/"false", "on"/"off" and "1"/"0"
+    strings.
+    """
+
+    float = "float"
+    int = "int"
+    bool = "bool"
+
+
+_BOOL_STRINGS = {
+    "true": True, "on": True, "1": True,
+    "false": False, "off": False, "0": False,
+}
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        try:
+            return _BOOL_STRINGS[value.strip().lower()]
+        except KeyError:
+            raise ValueError(f"Invalid boolean value: {value}")
+    return bool(value)
+
+
+# Type coercion functions, as named in extractors code.
+_COERCIONS = {
+    ValueType.float.value: "float",
+    ValueType.int.value: "int",
+    ValueType.bool.value: "_to_bool",
+}
+
+
+def parse_path(path):
+    """Split a path in keys and list indexes.
+
+    Integer segments are list indexes, double quoted segments are keys
+    (for example: 'data."0"').
+
+    :param str path: Dot separated path (for example: "rxInfo.0.time").
+    :returns tuple: Keys (str) and list indexes (int).
+    :raises ValueError: When path is not valid.
+    """
+    if not path:
+        raise ValueError("Empty payload path!")
+    parsed = []
+    for segment in path.split(PATH_SEPARATOR):
+        if len(segment) >= 2 and segment[0] == segment[-1] == KEY_QUOTE:
+            segment = segment[1:-1]
+        elif segment.isdecimal() and segment.isascii():
+            segment = int(segment)
+        if segment == "":
+            raise ValueError(f"Invalid payload path: {path}")
+        parsed.append(segment)
+    return tuple(parsed)
+
+
+def _accessor_code(var_name, segments):
+    # repr of keys and indexes: payload paths can not inject code.
+    return var_name + "".join(f"[{x!r}]" for x in segments)
+
+
+def compile_extractor(timestamp_path, fields):
+    """Compile a payload extractor function.
+
+    The extractor takes a (projected) JSON payload and returns its raw
+    timestamp and a dict of its fields values. Missing (or invalid) values
+    are skipped.
+
+    :param str timestamp_path: Path to timestamp (ISO 8601 string).
+    :param list fields: `(name, path, value_type)` tuples.
+    :returns tuple: Top level keys needed and extractor function.
+    :raises ValueError: When a path or a value type is not valid.
+    """
+    timestamp_segments = parse_path(timestamp_path)
+    fields_segments = []
+    for name, path, value_type in fields:
+        if value_type not in _COERCIONS:
+            raise ValueError(f"Invalid value type: {value_type}")
+        fields_segments.append(
+            (name, parse_path(path or name), _COERCIONS[value_type]))
+
+    # Top level values, decoded when a path goes through an embedded JSON.
+    keys = []
+    nested_keys = set()
+    for segments in [timestamp_segments] + [x[1] for x in fields_segments]:
+        if not isinstance(segments[0], str):
+            raise ValueError("Payload path must start with a key!")
+        if segments[0] not in keys:
+            keys.append(segments[0])
+        if len(segments) > 1:
+            nested_keys.add(segments[0])
+
+    lines = ["def extract(payload):"]
+    for idx, key in enumerate(keys):
+        lines.append(f"    v{idx} = payload.get({key!r})")
+        if key in nested_keys:
+            lines.append(
+                f"    if v{idx}.__class__ is str: v{idx} = loads(v{idx})")
+    var_names = {key: f"v{idx}" for idx, key in enumerate(keys)}
+    lines.append(
+        "    timestamp = " + _accessor_code(
+            var_names[timestamp_segments[0]], timestamp_segments[1:]))
+    lines.append("    values = {}")
+    for name, segments, coercion in fields_segments:
+        accessor = _accessor_code(var_names[segments[0]], segments[1:])
+        lines.extend([
+            "    try:",
+            f"        values[{name!r}] = {coercion}({accessor})",
+            "    except (LookupError, TypeError, ValueError):",
+            "        pass",
+        ])
+    lines.append("    return timestamp, values")
+
+    namespace = {"loads": loads, "_to_bool": _to_bool}
+    exec(compile("\n".join(lines), "<payload extractor>", "exec"), namespace)
+    return tuple(keys), namespace["extract"]
+
+
+class PayloadDecoderDeclarativeBase(PayloadDecoderBase):
+    """Base class of decoders compiled from a declarative description."""
+
+    _json_projection = None
+    _extract = None
+
+    def _decode(self, raw_payload):
+        super()._decode(raw_payload)
+        timestamp, values = self._decode_raw(raw_payload)
+        return parse_timestamp(timestamp), values
+
+    def _decode_raw(self, raw_payload):
+        try:
+            return self._extract(self._json_projection(raw_payload))
+        except (LookupError, TypeError) as exc:
+            raise PayloadDecoderError(f"Payload timestamp not found: {exc}")
+
+
+def make_decoder_cls(name, timestamp_path, fields, *, description=None):
+    """Compile a declarative payload decoder class.
+
+    :param str name: Unique name of payload decoder.
+    :param str timestamp_path: Path to timestamp (ISO 8601 string).
+    :param list fields: `(name, path, value_type)` tuples. If path is None,
+        the field is a top level key named as the field.
+    :param str description: (optional, default None)
+        Text to describe the payload decoder.
+    :returns PayloadDecoderDeclarativeBase: Payload decoder class.
+    :raises ValueError: When a path or a value type is not valid.
+    """
+    keys, extract = compile_extractor(timestamp_path, fields)
+    return type(
+        f"PayloadDecoderDeclarative_{name}",
+        (PayloadDecoderDeclarativeBase,),
+        {
+            "name": name,
+            "description": description,
+            "fields": [x[0] for x in fields],
+            "_json_projection": JSONProjection(keys),
+            "_extract": staticmethod(extract),
+        },
+    )
@@ -0,0 +1,99 @@
+"""JSON decoding for payload decoders
+
+JSON payloads are decoded by a pluggable backend: orjson or ujson when
+installed, else standard library json.
+
+Payload decoders only need a few top level keys of payloads
+(`JSONProjection`). Whatever the backend, the whole payload is decoded:
+with standard library json, finding and decoding keys one by one in
+payload text is slower than its C scanner decoding the whole payload.
+"""
+
+import json
+
+from bemserver_service_acquisition_mqtt.exceptions import (
+    PayloadDecoderError, JSONBackendNotFoundError)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+JSON_BACKEND_STDLIB = "json"
+
+# Available backends, from fastest to slowest.
+_JSON_BACKENDS = {}
+if orjson is not None:
+    _JSON_BACKENDS["orjson"] = orjson.loads
+if ujson is not None:
+    _JSON_BACKENDS["ujson"] = ujson.loads
+_JSON_BACKENDS[JSON_BACKEND_STDLIB] = json.loads
+
+_backend_name = next(iter(_JSON_BACKENDS))
+_backend_loads = _JSON_BACKENDS[_backend_name]
+
+
+def get_backend():
+    """Get the name of the JSON backend in use."""
+    return _backend_name
+
+
+def set_backend(backend_name=None):
+    """Set the JSON backend used to decode payloads.
+
+    :param str backend_name: (optional, default None)
+        "orjson", "ujson" or "json". If None, the fastest available.
+    :raises JSONBackendNotFoundError: When JSON backend is not available.
+    """
+    global _backend_name, _backend_loads
+    if backend_name is None:
+        backend_name = next(iter(_JSON_BACKENDS))
+    try:
+        _backend_loads = _JSON_BACKENDS[backend_name]
+    except KeyError:
+        raise JSONBackendNotFoundError(
+            f"{backend_name} JSON backend not available!")
+    _backend_name = backend_name
+
+
+def loads(data):
+    """Decode a JSON document with the JSON backend in use.
+
+    :param bytes|str data: JSON document.
+    :raises PayloadDecoderError: When data is not valid JSON.
+    """
+    try:
+        return _backend_loads(data)
+    except ValueError as exc:
+        # Backends errors (including UnicodeDecodeError) are ValueError.
+        raise PayloadDecoderError(str(exc))
+
+
+class JSONProjection:
+    """Decodes a JSON object and keeps some of its keys.
+
+    Projected keys are expected at payload (object) top level only: nested
+    keys are ignored.
+
+    :param tuple keys: Top level keys to keep.
+    """
+
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+
+    def __call__(self, data):
+        """Decode a JSON object and keep projected keys.
+
+        :param bytes|str data: JSON object.
+        :returns dict: Projected keys found, with their decoded values.
+        :raises PayloadDecoderError: When data is not a valid JSON object.
+        """
+        json_payload = loads(data)
+        if not isinstance(json_payload, dict):
+            raise PayloadDecoderError("JSON payload is not an object!")
+        return {x: json_payload[x] for x in self.keys if x in json_payload}
@@ -0,0 +1,137 @@
+"""Decoders for binary LoRaWAN frames of Chirpstack uplinks
+
+Chirpstack uplink payloads hold the raw device frame (base64 `data`) beside
+the values decoded by Chirpstack device codec (`objectJSON`). Decoding the
+frame here instead allows to disable codecs on the network server.
+
+Frames layouts are precompiled `struct.Struct`.
+"""
+
+import abc
+import base64
+import binascii
+import struct
+
+from bemserver_service_acquisition_mqtt.exceptions import PayloadDecoderError
+
+from .chirpstack import PayloadDecoderChirpstackBase
+from .jsonlib import JSONProjection
+
+
+class PayloadDecoderChirpstackFrameBase(PayloadDecoderChirpstackBase):
+
+    _json_projection = JSONProjection(("rxInfo", "data",))
+
+    def _decode_raw(self, raw_payload):
+        json_payload = self._json_projection(raw_payload)
+        try:
+            frame = base64.b64decode(json_payload["data"], validate=True)
+        except KeyError:
+            raise PayloadDecoderError("No frame data in payload!")
+        except (binascii.Error, TypeError, ValueError) as exc:
+            raise PayloadDecoderError(f"Invalid frame data: {exc}")
+        return json_payload["rxInfo"][0]["time"], self._decode_frame(frame)
+
+    @abc.abstractmethod
+    def _decode_frame(self, frame):
+        """Decode values of a device frame.
+
+        :param bytes frame: Device frame.
+        :returns dict: Decoded values, by field.
+        :raises PayloadDecoderError: When frame is not valid.
+        """
+
+
+class PayloadDecoderChirpstackMilesightBase(PayloadDecoderChirpstackFrameBase):
+    """Milesight frames: a list of channel ID, channel type and value.
+
+    Channels without field (device information sent after power on...) are
+    skipped. A channel not in `_CHANNELS` makes the frame invalid, as its
+    value size, thus the rest of frame, is unknown.
+    """
+
+    # (channel ID, channel type): field (None if skipped), channel layout
+    #  (value first) and scale.
+    _CHANNELS = {
+        (0x01, 0x75): ("battery", struct.Struct("<B"), 1),
+        (0x03, 0x67): ("temperature", struct.Struct("<h"), 0.1),
+        (0x04, 0x68): ("humidity", struct.Struct("<B"), 0.5),
+        # Temperature and alarm type (threshold, mutation...).
+        (0x83, 0x67): ("temperature", struct.Struct("<hB"), 0.1),
+        # History: timestamp, temperature and humidity.
+        (0x20, 0xce): (None, struct.Struct("<IhB"), 1),
+        # Device information: protocol version, power on, hardware and
+        #  firmware versions, device class, serial number.
+        (0xff, 0x01): (None, struct.Struct("<B"), 1),
+        (0xff, 0x0b): (None, struct.Struct("<B"), 1),
+        (0xff, 0x09): (None, struct.Struct("<H"), 1),
+        (0xff, 0x0a): (None, struct.Struct("<H"), 1),
+        (0xff, 0x0f): (None, struct.Struct("<B"), 1),
+        (0xff, 0x16): (None, struct.Struct("8s"), 1),
+    }
+
+    def _decode_frame(self, frame):
+        values = {}
+        idx = 0
+        frame_len = len(frame)
+        while idx + 2 <= frame_len:
+            try:
+                field, layout, scale = self._CHANNELS[
+                    (frame[idx], frame[idx + 1])]
+            except KeyError:
+                # Value size unknown: the rest of frame can not be read.
+                raise PayloadDecoderError(
+                    f"Unknown channel {frame[idx]:#04x}"
+                    f" (type {frame[idx + 1]:#04x})!")
+            idx += 2
+            if idx + layout.size > frame_len:
+                raise PayloadDecoderError("Truncated frame!")
+            if field in self.fields:
+                value = layout.unpack_from(frame, idx)[0]
+                values[field] = round(value * scale, 2)
+            idx += layout.size
+        if idx != frame_len:
+            raise PayloadDecoderError("Truncated frame!")
+        return values
+
+
+class PayloadDecoderChirpstackFrameEM300TH868(
+        PayloadDecoderChirpstackMilesightBase):
+
+    name = "chirpstack_frame_EM300-TH-868"
+    description = (
+        "Chirpstack payload decoder for EM300-TH-868 devices (binary frame)")
+    fields = ["temperature", "humidity", "battery"]
+
+
+class PayloadDecoderChirpstackFrameUC11(
+        PayloadDecoderChirpstackFrameEM300TH868):
+
+    name = "chirpstack_frame_UC11"
+    description = "Chirpstack payload decoder for UC11 devices (binary frame)"
+
+
+class PayloadDecoderChirpstackFrameARF8200AA(
+        PayloadDecoderChirpstackFrameBase):
+
+    name = "chirpstack_frame_ARF8200AA"
+    description = (
+        "Chirpstack payload decoder for ARF8200AA devices (binary frame)")
+    fields = ["channelA", "channelB"]
+
+    # Data frame: code, status, then state and value of each channel.
+    _DATA_FRAME_CODE = 0x42
+    _DATA_FRAME = struct.Struct(">BBBfBf")
+
+    def _decode_frame(self, frame):
+        if not frame or frame[0] != self._DATA_FRAME_CODE:
+            # Other frames (keep alive, configuration...) have no values.
+            return {}
+        try:
+            _, _, _, channel_a, _, channel_b = self._DATA_FRAME.unpack(frame)
+        except struct.error:
+            raise PayloadDecoderError("Invalid data frame length!")
+        return {
+            "channelA": round(channel_a, 3),
+            "channelB": round(channel_b, 3),
+        }
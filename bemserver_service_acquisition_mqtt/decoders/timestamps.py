@@ -0,0 +1,95 @@
+"""Timestamps parsing for payload decoders
+
+Payload timestamps are mostly ISO 8601 strings, in UTC:
+`YYYY-MM-DDTHH:MM:SS(.ffffff)Z` (or `+00:00`). Timestamps without time zone
+are assumed to be in UTC: parsed timestamps are always aware, whatever the
+path (one message or a batch).
+
+CPython `datetime.fromisoformat` (implemented in C) is the fast path: since
+Python 3.11 it parses "Z" suffix and any number of fraction digits directly.
+Older versions need "Z" to be replaced and fraction to have 3 or 6 digits:
+other strings are normalized then parsed again.
+"""
+
+import re
+import sys
+import datetime as dt
+
+from bemserver_service_acquisition_mqtt.exceptions import PayloadDecoderError
+
+
+_EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+_MICROSECOND = dt.timedelta(microseconds=1)
+
+# Fraction of seconds (any number of digits) and "Z" UTC designator.
+_ISO8601_RE = re.compile(
+    r"^(?P<datetime>\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2})"
+    r"(?:[.,](?P<fraction>\d+))?"
+    r"(?P<tz>Z|z|[+-]\d{2}:?\d{2})?$")
+
+_fromisoformat = dt.datetime.fromisoformat
+_HAS_FULL_ISOFORMAT = sys.version_info >= (3, 11)
+
+
+def _parse_normalized(timestamp):
+    match = _ISO8601_RE.match(timestamp.strip())
+    if match is None:
+        raise PayloadDecoderError(f"Invalid timestamp: {timestamp}")
+    fraction = match.group("fraction") or ""
+    tz = match.group("tz") or ""
+    if tz in ("Z", "z"):
+        tz = "+00:00"
+    elif len(tz) == 5:
+        tz = f"{tz[:3]}:{tz[3:]}"
+    # Microseconds resolution: extra digits are truncated.
+    fraction = f".{fraction[:6]:0<6}" if fraction else ""
+    try:
+        return _fromisoformat(f"{match.group('datetime')}{fraction}{tz}")
+    except ValueError as exc:
+        raise PayloadDecoderError(str(exc))
+
+
+def parse_timestamp(timestamp):
+    """Parse an ISO 8601 timestamp.
+
+    :param str timestamp: ISO 8601 timestamp
+        (for example: "2021-04-16T14:03:13.432986Z").
+    :returns datetime: Aware timestamp (UTC if it had no time zone).
+    :raises PayloadDecoderError: When timestamp is not valid.
+    """
+    try:
+        if _HAS_FULL_ISOFORMAT:
+            parsed = _fromisoformat(timestamp)
+        elif timestamp[-1:] == "Z":
+            parsed = _fromisoformat(f"{timestamp[:-1]}+00:00")
+        else:
+            parsed = _fromisoformat(timestamp)
+    except ValueError:
+        # Less common shape (fraction digits, lower case "z"...).
+        parsed = _parse_normalized(timestamp)
+    except TypeError:
+        raise PayloadDecoderError(f"Invalid timestamp: {timestamp}")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=dt.timezone.utc)
+    return parsed
+
+
+def to_epoch_us(timestamp):
+    """Get the number of microseconds since Unix epoch of a timestamp.
+
+    :param datetime timestamp: Aware timestamp.
+    :returns int: Microseconds since 1970-01-01T00:00:00Z.
+    """
+    return (timestamp - _EPOCH) // _MICROSECOND
+
+
+def parse_timestamps_epoch_us(timestamps):
+    """Parse ISO 8601 timestamps to microseconds since Unix epoch.
+
+    Integer timestamps avoid keeping datetime instances for bulk writes.
+
+    :param iterable timestamps: ISO 8601 timestamps (UTC if no time zone).
+    :returns list: Microseconds since 1970-01-01T00:00:00Z, as integers.
+    :raises PayloadDecoderError: When a timestamp is not valid.
+    """
+    return [(parse_timestamp(x) - _EPOCH) // _MICROSECOND for x in timestamps]
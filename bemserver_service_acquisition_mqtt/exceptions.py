@@ -15,3 +15,15 @@ class PayloadDecoderRegistrationError(PayloadDecoderError):
 
 class PayloadDecoderNotFoundError(PayloadDecoderError):
     """Payload decoder class does not exist."""
+
+
+class TimeseriesDataWriterError(Exception):
+    """Timeseries data writer error."""
+
+
+class TimeseriesDataWriterNotFoundError(TimeseriesDataWriterError):
+    """Timeseries data writer class does not exist."""
+
+
+class JSONBackendNotFoundError(PayloadDecoderError):
+    """JSON backend is not available."""
@@ -0,0 +1,38 @@
+"""Timeseries data ingestion"""
+
+from bemserver_service_acquisition_mqtt.exceptions import (
+    TimeseriesDataWriterNotFoundError,
+)
+
+from .writers import (  # noqa
+    ON_CONFLICT_DO_NOTHING, ON_CONFLICT_DO_UPDATE, ON_CONFLICT_ACTIONS,
+    TimeseriesDataWriterBase, TimeseriesDataWriterInsert,
+    TimeseriesDataWriterCopyCSV, TimeseriesDataWriterCopyBinary)
+from .buffer import TimeseriesDataBuffer  # noqa
+from .workers import TimeseriesDataWriterPool  # noqa
+from .spool import TimeseriesDataSpool  # noqa
+from .cache import TimeseriesLastTimestampCache  # noqa
+
+
+_TIMESERIES_DATA_WRITERS = {
+    x.name: x for x in [
+        TimeseriesDataWriterInsert,
+        TimeseriesDataWriterCopyCSV,
+        TimeseriesDataWriterCopyBinary,
+    ]
+}
+
+
+def get_writer_cls(writer_name):
+    """Get a timeseries data writer class from its name.
+
+    :param str writer_name: Name of writer (ingestion strategy) to find.
+    :returns TimeseriesDataWriterBase: Timeseries data writer class found.
+    :raises TimeseriesDataWriterNotFoundError:
+        When timeseries data writer class does not exist.
+    """
+    try:
+        return _TIMESERIES_DATA_WRITERS[writer_name]
+    except KeyError:
+        raise TimeseriesDataWriterNotFoundError(
+            f"{writer_name} timeseries data writer not found!")
@@ -0,0 +1,317 @@
+"""Write-behind buffer for timeseries data"""
+
+import logging
+import threading
+import time
+
+from bemserver_service_acquisition_mqtt import SERVICE_LOGNAME
+from .writers import (
+    TimeseriesDataWriterInsert, ON_CONFLICT_DO_NOTHING, ON_CONFLICT_DO_UPDATE,
+    ON_CONFLICT_ACTIONS)
+
+
+logger = logging.getLogger(SERVICE_LOGNAME)
+
+
+class TimeseriesDataBuffer:
+    """Collects decoded values and writes them in database by batches.
+
+    Values are `(timeseries_id, timestamp, value)` tuples, appended by
+    payload decoders (from MQTT network threads). A background thread flushes
+    them as soon as the buffer holds `max_size` values or its oldest value
+    has been waiting for `max_age` seconds.
+    Values already in database are skipped or updated, depending on the
+    on conflict action they have been appended with.
+
+    With a spool, values that can not be written (database down) are
+    spooled instead of being lost, as are values appended while too many are
+    waiting (database writes falling behind). Spooled values are replayed
+    by batches after successful writes, or when buffer is idle. While values
+    are spooled, values to update are spooled too, so that older spooled
+    values do not overwrite them when replayed.
+
+    With a timestamp cache, timeseries of values lost (write failed without
+    spool, or spool full) are forgotten by the cache, so that those values
+    are written when sent again.
+
+    :param int max_size: (optional, default 1000)
+        Number of buffered values that triggers a flush.
+    :param float max_age: (optional, default 1.0)
+        Time, in seconds, a value can wait in buffer before being flushed.
+    :param TimeseriesDataWriterBase writer: (optional, default None)
+        Writer used to save values in database. Multi-row INSERT if None.
+    :param TimeseriesDataSpool spool: (optional, default None)
+        Spool of values that can not be written at once.
+    :param int max_pending: (optional, default None)
+        With a spool, number of buffered values above which values appended
+        are spooled. If None, 10 times max size.
+    :param float replay_retry_delay: (optional, default 10.0)
+        Time, in seconds, before replaying spool again after a failure.
+    :param TimeseriesLastTimestampCache timestamp_cache: (optional)
+        Timestamp cache values appended were filtered with.
+    """
+
+    def __init__(self, *, max_size=1000, max_age=1.0, writer=None,
+                 spool=None, max_pending=None, replay_retry_delay=10.0,
+                 timestamp_cache=None):
+        if max_size < 1:
+            raise ValueError("Invalid buffer max size!")
+        if max_age <= 0:
+            raise ValueError("Invalid buffer max age!")
+        self.max_size = max_size
+        self.max_age = max_age
+        self._writer = writer or TimeseriesDataWriterInsert()
+        self.spool = spool
+        self.max_pending = max_pending or max_size * 10
+        self.replay_retry_delay = replay_retry_delay
+        self.timestamp_cache = timestamp_cache
+        # Time (monotonic) before which spool is not replayed.
+        self._timestamp_replay = 0.0
+
+        self._rows = {x: [] for x in ON_CONFLICT_ACTIONS}
+        self._nb_rows = 0
+        self._timestamp_oldest_row = None
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._is_running = False
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "flush_count": 0,
+            "values_written": 0,
+            "values_skipped": 0,
+            "values_failed": 0,
+            "values_spooled": 0,
+            "last_flush_size": 0,
+            "last_flush_duration": 0.0,
+            "max_flush_duration": 0.0,
+            "total_flush_duration": 0.0,
+        }
+
+    @property
+    def _log_header(self):
+        return f"[Buffer {self._writer.name}]"
+
+    @property
+    def is_running(self):
+        return self._is_running
+
+    @property
+    def stats(self):
+        """Flush statistics (counts, batch size and latency in seconds).
+
+        With a spool, spool statistics are added (prefixed with "spool_").
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        if self.spool is not None:
+            stats.update(
+                {f"spool_{k}": v for k, v in self.spool.stats.items()})
+        return stats
+
+    def __len__(self):
+        return self._nb_rows
+
+    @property
+    def must_flush(self):
+        """Whether size or age threshold is reached."""
+        if self._nb_rows >= self.max_size:
+            return True
+        return self.time_before_flush <= 0
+
+    @property
+    def time_before_flush(self):
+        """Time, in seconds, before oldest value reaches max age."""
+        if self._timestamp_oldest_row is None:
+            return self.max_age
+        return self._timestamp_oldest_row + self.max_age - time.monotonic()
+
+    def extend(self, rows, *, on_conflict=ON_CONFLICT_DO_NOTHING):
+        """Append values to buffer.
+
+        :param list rows: List of `(timeseries_id, timestamp, value)` tuples.
+        :param str on_conflict: (optional, default "nothing")
+            What to do with values already in database ("nothing" or
+            "update").
+        :returns bool: Whether size threshold is reached.
+        """
+        if len(rows) <= 0:
+            return False
+        if self.spool is not None and self._nb_rows >= self.max_pending:
+            # Writes fall behind: do not keep growing in memory.
+            self._spool(rows, on_conflict)
+            return False
+        with self._cond:
+            if self._timestamp_oldest_row is None:
+                self._timestamp_oldest_row = time.monotonic()
+            self._rows[on_conflict].extend(rows)
+            self._nb_rows += len(rows)
+            if self._nb_rows >= self.max_size:
+                self._cond.notify()
+                return True
+        return False
+
+    def start(self):
+        """Start the background flushing thread."""
+        if self._is_running:
+            return
+        self._is_running = True
+        self._thread = threading.Thread(
+            target=self._run, name="TimeseriesDataBuffer", daemon=True)
+        self._thread.start()
+        logger.debug(f"{self._log_header} started")
+
+    def stop(self):
+        """Stop the background flushing thread and flush remaining values."""
+        if not self._is_running:
+            return
+        with self._cond:
+            self._is_running = False
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+        logger.debug(f"{self._log_header} stopped")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._is_running and not self.must_flush:
+                    if self.must_replay:
+                        break
+                    timeout = self.time_before_flush
+                    if self.spool is not None and len(self.spool) > 0:
+                        timeout = min(
+                            timeout,
+                            self._timestamp_replay - time.monotonic())
+                    self._cond.wait(max(timeout, 0))
+                if not self._is_running:
+                    return
+            try:
+                if self.must_flush:
+                    self.flush()
+                # Catch up with spooled values, one batch at a time (not
+                #  only when idle, to drain spool under steady traffic).
+                if self.must_replay:
+                    self.replay()
+            except Exception:
+                # Keep the flushing thread alive, whatever happens.
+                logger.exception(f"{self._log_header} flush failed")
+
+    @property
+    def must_replay(self):
+        """Whether spooled values are waiting and may be replayed."""
+        return (
+            self.spool is not None and len(self.spool) > 0
+            and time.monotonic() >= self._timestamp_replay
+        )
+
+    def replay(self, *, connection=None):
+        """Write a batch of spooled values in database.
+
+        :param sqlalchemy.engine.Connection connection: (optional)
+            Database connection to use. If None, one is taken from pool.
+        :returns int: Number of values replayed.
+        """
+        if self.spool is None:
+            return 0
+        max_values = self.max_size * 10
+        nb_replayed = self.spool.replay(
+            self._writer, max_values=max_values, connection=connection)
+        if nb_replayed < min(max_values, nb_replayed + len(self.spool)):
+            # Replay failed: retry later.
+            self._timestamp_replay = (
+                time.monotonic() + self.replay_retry_delay)
+        return nb_replayed
+
+    def _spool(self, rows, on_conflict):
+        nb_spooled = self._spool_append(rows, on_conflict)
+        with self._stats_lock:
+            self._stats["values_spooled"] += nb_spooled
+            self._stats["values_failed"] += len(rows) - nb_spooled
+
+    def _spool_append(self, rows, on_conflict):
+        nb_spooled = self.spool.append(rows, on_conflict=on_conflict)
+        if nb_spooled < len(rows):
+            # Spool full: values dropped.
+            self._forget(rows[nb_spooled:])
+        return nb_spooled
+
+    def _forget(self, rows):
+        if self.timestamp_cache is not None:
+            self.timestamp_cache.forget(rows)
+
+    def flush(self, *, connection=None):
+        """Write all buffered values in database.
+
+        Values are written in one transaction for each on conflict action.
+
+        :param sqlalchemy.engine.Connection connection: (optional)
+            Database connection to use. If None, one is taken from pool.
+        :returns int: Number of values written.
+        """
+        with self._flush_lock:
+            with self._cond:
+                rows_by_action = self._rows
+                nb_rows = self._nb_rows
+                self._rows = {x: [] for x in ON_CONFLICT_ACTIONS}
+                self._nb_rows = 0
+                self._timestamp_oldest_row = None
+            if nb_rows <= 0:
+                return 0
+
+            nb_written = 0
+            nb_failed = 0
+            nb_spooled = 0
+            t_start = time.perf_counter()
+            for on_conflict, rows in rows_by_action.items():
+                if len(rows) <= 0:
+                    continue
+                if (on_conflict == ON_CONFLICT_DO_UPDATE
+                        and self.spool is not None and len(self.spool) > 0):
+                    # Keep updates order: written after spooled values.
+                    spooled = self._spool_append(rows, on_conflict)
+                    nb_spooled += spooled
+                    nb_failed += len(rows) - spooled
+                    continue
+                try:
+                    nb_written += self._writer.write(
+                        rows, on_conflict=on_conflict, connection=connection)
+                except Exception as exc:
+                    logger.error(
+                        f"{self._log_header} failed to write {len(rows)}"
+                        f" values: {str(exc)}")
+                    if self.spool is None:
+                        nb_failed += len(rows)
+                        self._forget(rows)
+                        continue
+                    spooled = self._spool_append(rows, on_conflict)
+                    nb_spooled += spooled
+                    nb_failed += len(rows) - spooled
+                    # Database is likely down: do not replay at once.
+                    self._timestamp_replay = (
+                        time.monotonic() + self.replay_retry_delay)
+            duration = time.perf_counter() - t_start
+            nb_skipped = nb_rows - nb_written - nb_failed - nb_spooled
+
+            with self._stats_lock:
+                self._stats["flush_count"] += 1
+                self._stats["values_written"] += nb_written
+                self._stats["values_skipped"] += nb_skipped
+                self._stats["values_failed"] += nb_failed
+                self._stats["values_spooled"] += nb_spooled
+                self._stats["last_flush_size"] = nb_rows
+                self._stats["last_flush_duration"] = duration
+                self._stats["max_flush_duration"] = max(
+                    self._stats["max_flush_duration"], duration)
+                self._stats["total_flush_duration"] += duration
+
+            logger.debug(
+                f"{self._log_header} {nb_written}/{nb_rows} values"
+                f" written in {duration * 1000:.1f} ms")
+            if nb_skipped > 0:
+                logger.info(
+                    f"{self._log_header} {nb_skipped} values skipped"
+                    " (already in database)")
+            return nb_written
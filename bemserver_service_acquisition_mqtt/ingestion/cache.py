@@ -0,0 +1,169 @@
+"""Last timestamp cache of timeseries data
+
+On each (re)connection, brokers send retained messages again and redeliver
+QoS 1 messages not acknowledged: their values are most likely already in
+database. The cache keeps, for each timeseries, the timestamp of the last
+value written (or being written), to drop those values before any database
+work. Timeseries whose values could not be written (nor spooled) are
+forgotten, so that those values are not dropped when sent again.
+"""
+
+import logging
+import threading
+import datetime as dt
+import sqlalchemy as sqla
+
+from bemserver_core.database import db
+from bemserver_core.model import TimeseriesData
+from bemserver_service_acquisition_mqtt import SERVICE_LOGNAME
+from .writers import ON_CONFLICT_DO_UPDATE
+
+
+logger = logging.getLogger(SERVICE_LOGNAME)
+
+
+class TimeseriesLastTimestampCache:
+    """In-memory last timestamp of each timeseries.
+
+    Values of retained or redelivered messages that are not newer than the
+    last timestamp of their timeseries are dropped. Values of other messages
+    are dropped only when they have the last timestamp (duplicates): older
+    ones may be late values, not in database yet.
+    Values to overwrite (on conflict "update") are never dropped.
+
+    Timestamps are aware: payload decoders set UTC on naive timestamps, as
+    does `seed` on those loaded from database.
+    """
+
+    def __init__(self):
+        self._timestamps = {}
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "values_passed": 0,
+            "suppressed_retained": 0,
+            "suppressed_redelivered": 0,
+            "suppressed_duplicate": 0,
+        }
+
+    @property
+    def _log_header(self):
+        return "[Last timestamp cache]"
+
+    @property
+    def stats(self):
+        """Counts of values passed and suppressed, by cause."""
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    def get(self, timeseries_id):
+        """Get the last timestamp of a timeseries, or None."""
+        return self._timestamps.get(timeseries_id)
+
+    def seed(self, timeseries_ids=None, *, connection=None):
+        """Load last timestamps from database, in one query.
+
+        :param list timeseries_ids: (optional, default None)
+            IDs of timeseries to load. If None, all timeseries.
+        :param sqlalchemy.engine.Connection connection: (optional)
+            Database connection to use. If None, one is taken from pool.
+        :returns int: Number of timeseries loaded.
+        """
+        stmt = sqla.select(
+            TimeseriesData.timeseries_id,
+            sqla.func.max(TimeseriesData.timestamp))
+        if timeseries_ids is not None:
+            timeseries_ids = list(timeseries_ids)
+            if len(timeseries_ids) <= 0:
+                return 0
+            stmt = stmt.filter(
+                TimeseriesData.timeseries_id.in_(timeseries_ids))
+        stmt = stmt.group_by(TimeseriesData.timeseries_id)
+        if connection is None:
+            with db.engine.connect() as conn:
+                rows = conn.execute(stmt).all()
+        else:
+            rows = connection.execute(stmt).all()
+        with self._lock:
+            for timeseries_id, timestamp in rows:
+                if timestamp.tzinfo is None:
+                    # Not a "timestamp with time zone" column: UTC.
+                    timestamp = timestamp.replace(tzinfo=dt.timezone.utc)
+                last = self._timestamps.get(timeseries_id)
+                if last is None or timestamp > last:
+                    self._timestamps[timeseries_id] = timestamp
+        logger.debug(
+            f"{self._log_header} {len(rows)} timeseries last timestamps"
+            " loaded")
+        return len(rows)
+
+    def forget(self, rows):
+        """Forget last timestamps of values that could not be written.
+
+        Last timestamp of a timeseries is forgotten when not older than one
+        of its values, so that the value is not dropped when sent again
+        (retained or redelivered message).
+
+        :param list rows: List of `(timeseries_id, timestamp, value)` tuples.
+        :returns int: Number of timeseries forgotten.
+        """
+        nb_forgotten = 0
+        with self._lock:
+            for timeseries_id, timestamp, _ in rows:
+                last = self._timestamps.get(timeseries_id)
+                if last is not None and last >= timestamp:
+                    del self._timestamps[timeseries_id]
+                    nb_forgotten += 1
+        if nb_forgotten > 0:
+            logger.debug(
+                f"{self._log_header} {nb_forgotten} timeseries last"
+                " timestamps forgotten (values not written)")
+        return nb_forgotten
+
+    def filter(self, rows, *, on_conflict, retain=False, dup=False):
+        """Drop values already in database, and update last timestamps.
+
+        Values returned must be written: if they can not be, see `forget`.
+
+        :param list rows: List of `(timeseries_id, timestamp, value)` tuples.
+        :param str on_conflict: On conflict action of values.
+        :param bool retain: (optional, default False)
+            Whether values come from a retained message.
+        :param bool dup: (optional, default False)
+            Whether values come from a redelivered message.
+        :returns list: Values to write.
+        """
+        if on_conflict == ON_CONFLICT_DO_UPDATE:
+            with self._lock:
+                for timeseries_id, timestamp, _ in rows:
+                    last = self._timestamps.get(timeseries_id)
+                    if last is None or timestamp > last:
+                        self._timestamps[timeseries_id] = timestamp
+            with self._stats_lock:
+                self._stats["values_passed"] += len(rows)
+            return rows
+
+        kept = []
+        with self._lock:
+            for row in rows:
+                timeseries_id, timestamp, _ = row
+                last = self._timestamps.get(timeseries_id)
+                if last is None or timestamp > last:
+                    self._timestamps[timeseries_id] = timestamp
+                elif retain or dup or timestamp == last:
+                    continue
+                kept.append(row)
+        nb_suppressed = len(rows) - len(kept)
+        with self._stats_lock:
+            self._stats["values_passed"] += len(kept)
+            if nb_suppressed > 0:
+                if retain:
+                    self._stats["suppressed_retained"] += nb_suppressed
+                elif dup:
+                    self._stats["suppressed_redelivered"] += nb_suppressed
+                else:
+                    self._stats["suppressed_duplicate"] += nb_suppressed
+        return kept
@@ -0,0 +1,382 @@
+"""Durable on-disk spool for timeseries data
+
+When the database is down (or writes fall behind), decoded values are
+appended to a local spool instead of being lost, then replayed in database
+by batches once it is available again.
+
+The spool is an append-only log split in fixed size segment files, memory
+mapped. Each segment has a header (magic, number of records written, number
+of records replayed) followed by fixed size binary records:
+    - timeseries ID: int32
+    - timestamp: int64, microseconds since Unix epoch
+    - value: float64 (NaN for None)
+    - on conflict action: uint8 (index in `ON_CONFLICT_ACTIONS`)
+
+Records count is updated after records are written: records of an
+interrupted append are ignored. Fully replayed segments are deleted (or
+reused when it is the segment being written).
+"""
+
+import logging
+import math
+import mmap
+import struct
+import threading
+import time
+import datetime as dt
+from pathlib import Path
+
+from bemserver_service_acquisition_mqtt import SERVICE_LOGNAME
+from .writers import ON_CONFLICT_DO_NOTHING, ON_CONFLICT_ACTIONS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+logger = logging.getLogger(SERVICE_LOGNAME)
+
+
+_MAGIC = b"BSACQSP1"
+_HEADER = struct.Struct("<8sQQ")
+_RECORD = struct.Struct("<iqdB")
+_RECORD_DTYPE = None if np is None else np.dtype([
+    ("timeseries_id", "<i4"), ("timestamp", "<i8"), ("value", "<f8"),
+    ("on_conflict", "u1"),
+])
+
+_EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+# Naive timestamps are in UTC.
+_NAIVE_EPOCH = dt.datetime(1970, 1, 1)
+_US = dt.timedelta(microseconds=1)
+
+SEGMENT_SUFFIX = ".seg"
+
+
+class _Segment:
+    """Memory mapped segment file."""
+
+    def __init__(self, filepath, size, *, create=False):
+        self.filepath = filepath
+        with open(filepath, "w+b" if create else "r+b") as f:
+            if create:
+                f.truncate(size)
+            self._mmap = mmap.mmap(f.fileno(), 0)
+        self.size = len(self._mmap)
+        if create:
+            self._write_header(0, 0)
+        magic = None
+        if self.size >= _HEADER.size:
+            magic, self.nb_written, self.nb_replayed = _HEADER.unpack_from(
+                self._mmap)
+        if magic != _MAGIC:
+            self.close()
+            raise ValueError(f"Invalid spool segment: {filepath}")
+        # Interrupted reset (see `reset`).
+        self.nb_replayed = min(self.nb_replayed, self.nb_written)
+
+    @property
+    def capacity(self):
+        return (self.size - _HEADER.size) // _RECORD.size
+
+    @property
+    def nb_pending(self):
+        return self.nb_written - self.nb_replayed
+
+    def _write_header(self, nb_written, nb_replayed):
+        _HEADER.pack_into(self._mmap, 0, _MAGIC, nb_written, nb_replayed)
+
+    def _offset(self, record_index):
+        return _HEADER.size + record_index * _RECORD.size
+
+    def append(self, records):
+        """Append packed records (not more than remaining capacity)."""
+        offset = self._offset(self.nb_written)
+        self._mmap[offset:offset + len(records)] = records
+        self.nb_written += len(records) // _RECORD.size
+        self._write_header(self.nb_written, self.nb_replayed)
+
+    def read(self, max_records):
+        """Read pending records (packed), from oldest."""
+        nb_records = min(self.nb_pending, max_records)
+        offset = self._offset(self.nb_replayed)
+        return self._mmap[offset:offset + nb_records * _RECORD.size]
+
+    def mark_replayed(self, nb_records):
+        self.nb_replayed += nb_records
+        self._write_header(self.nb_written, self.nb_replayed)
+
+    def reset(self):
+        self.nb_written = 0
+        self.nb_replayed = 0
+        self._write_header(0, 0)
+
+    def sync(self):
+        self._mmap.flush()
+
+    def close(self):
+        self._mmap.close()
+
+
+class TimeseriesDataSpool:
+    """Append-only on-disk log of timeseries data values.
+
+    Values are `(timeseries_id, timestamp, value)` tuples, as in buffers
+    (naive timestamps are in UTC).
+    When spool is full, values appended are dropped (and counted).
+
+    :param str|Path dirpath: Directory of spool segment files (created if
+        needed). Segments already there (previous run) are replayed.
+    :param int segment_size: (optional, default 64 MiB)
+        Size, in bytes, of each segment file.
+    :param int max_size: (optional, default 1 GiB)
+        Maximum size, in bytes, of all segment files.
+    :param bool sync: (optional, default True)
+        Whether appended values are flushed to disk at once (else by OS).
+    """
+
+    def __init__(self, dirpath, *, segment_size=64 * 1024 ** 2,
+                 max_size=1024 ** 3, sync=True):
+        if segment_size < _HEADER.size + _RECORD.size:
+            raise ValueError("Invalid spool segment size!")
+        if max_size < segment_size:
+            raise ValueError("Invalid spool max size!")
+        self.dirpath = Path(dirpath)
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.sync = sync
+
+        self._lock = threading.Lock()
+        # Only one replay at a time, appends allowed meanwhile.
+        self._replay_lock = threading.Lock()
+        self._segments = []
+        self._next_seq = 0
+        self._is_open = False
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "values_spooled": 0,
+            "values_dropped": 0,
+            "values_replayed": 0,
+            "values_replay_failed": 0,
+            "replay_count": 0,
+            "total_replay_duration": 0.0,
+            "last_replay_rate": 0.0,
+        }
+
+        self.open()
+
+    @property
+    def _log_header(self):
+        return f"[Spool {self.dirpath}]"
+
+    @property
+    def stats(self):
+        """Spool statistics (counts, replay duration and rate in values per
+        second)."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["values_pending"] = len(self)
+        stats["size"] = self.size
+        return stats
+
+    @property
+    def size(self):
+        """Size, in bytes, of segment files."""
+        return sum(x.size for x in self._segments)
+
+    def __len__(self):
+        return sum(x.nb_pending for x in self._segments)
+
+    def _segment_filepath(self, seq):
+        return self.dirpath / f"{seq:010d}{SEGMENT_SUFFIX}"
+
+    def open(self):
+        """Load segment files (after `close`, values pending are loaded
+        again). Done at creation."""
+        with self._lock:
+            if self._is_open:
+                return
+            self.dirpath.mkdir(parents=True, exist_ok=True)
+            self._load()
+            self._is_open = True
+
+    def _load(self):
+        for filepath in sorted(self.dirpath.glob(f"*{SEGMENT_SUFFIX}")):
+            try:
+                segment = _Segment(filepath, self.segment_size)
+            except ValueError as exc:
+                logger.error(f"{self._log_header} {str(exc)}")
+                filepath.rename(filepath.with_suffix(".corrupt"))
+                continue
+            self._segments.append(segment)
+            self._next_seq = max(self._next_seq, int(filepath.stem) + 1)
+        for segment in list(self._segments):
+            self._release(segment)
+        if len(self) > 0:
+            logger.warning(
+                f"{self._log_header} {len(self)} values to replay"
+                " from a previous run")
+
+    def _new_segment(self):
+        segment = _Segment(
+            self._segment_filepath(self._next_seq), self.segment_size,
+            create=True)
+        self._next_seq += 1
+        self._segments.append(segment)
+        return segment
+
+    @staticmethod
+    def _pack(rows, on_conflict):
+        action = ON_CONFLICT_ACTIONS.index(on_conflict)
+        pack = _RECORD.pack
+        return b"".join(
+            pack(
+                ts_id,
+                (timestamp - (
+                    _NAIVE_EPOCH if timestamp.tzinfo is None else _EPOCH)
+                 ) // _US,
+                math.nan if value is None else float(value), action)
+            for ts_id, timestamp, value in rows
+        )
+
+    def append(self, rows, *, on_conflict=ON_CONFLICT_DO_NOTHING):
+        """Append values to spool.
+
+        :param list rows: List of `(timeseries_id, timestamp, value)` tuples.
+        :param str on_conflict: (optional, default "nothing")
+            What to do with values already in database, when replayed.
+        :returns int: Number of values spooled (others are dropped, when
+            spool is full).
+        """
+        if len(rows) <= 0:
+            return 0
+        records = memoryview(self._pack(rows, on_conflict))
+        nb_spooled = 0
+        with self._lock:
+            while len(records) > 0:
+                segment = self._segments[-1] if self._segments else None
+                if segment is None or segment.nb_written >= segment.capacity:
+                    if self.size + self.segment_size > self.max_size:
+                        break
+                    if segment is not None:
+                        segment.sync()
+                    segment = self._new_segment()
+                nb_records = min(
+                    segment.capacity - segment.nb_written,
+                    len(records) // _RECORD.size)
+                segment.append(records[:nb_records * _RECORD.size])
+                records = records[nb_records * _RECORD.size:]
+                nb_spooled += nb_records
+            if self.sync and self._segments:
+                self._segments[-1].sync()
+        nb_dropped = len(rows) - nb_spooled
+        with self._stats_lock:
+            self._stats["values_spooled"] += nb_spooled
+            self._stats["values_dropped"] += nb_dropped
+        if nb_dropped > 0:
+            logger.error(
+                f"{self._log_header} full ({self.max_size} bytes):"
+                f" {nb_dropped} values dropped!")
+        return nb_spooled
+
+    def replay(self, writer, *, max_values=None, connection=None):
+        """Write spooled values in database, from oldest, by batches.
+
+        Values are removed from spool once written. On write failure,
+        replay stops and values are kept for next replay.
+
+        :param TimeseriesDataWriterBase writer: Writer used to save values.
+        :param int max_values: (optional, default None)
+            Maximum number of values to replay. If None, all values.
+        :param sqlalchemy.engine.Connection connection: (optional)
+            Database connection to use. If None, one is taken from pool.
+        :returns int: Number of values replayed.
+        """
+        with self._replay_lock:
+            nb_replayed = 0
+            t_start = time.perf_counter()
+            while max_values is None or nb_replayed < max_values:
+                with self._lock:
+                    segment = next(
+                        (x for x in self._segments if x.nb_pending > 0),
+                        None)
+                    if segment is None:
+                        break
+                    max_records = segment.nb_pending
+                    if max_values is not None:
+                        max_records = min(
+                            max_records, max_values - nb_replayed)
+                    # Copied: segment may be closed meanwhile.
+                    records = bytes(segment.read(max_records))
+                nb_records = len(records) // _RECORD.size
+                try:
+                    self._write(writer, records, connection)
+                except Exception as exc:
+                    logger.error(
+                        f"{self._log_header} failed to replay {nb_records}"
+                        f" values: {str(exc)}")
+                    with self._stats_lock:
+                        self._stats["values_replay_failed"] += nb_records
+                    break
+                with self._lock:
+                    segment.mark_replayed(nb_records)
+                    self._release(segment)
+                nb_replayed += nb_records
+            duration = time.perf_counter() - t_start
+
+        if nb_replayed > 0:
+            rate = nb_replayed / duration if duration > 0 else 0.0
+            with self._stats_lock:
+                self._stats["values_replayed"] += nb_replayed
+                self._stats["replay_count"] += 1
+                self._stats["total_replay_duration"] += duration
+                self._stats["last_replay_rate"] = rate
+            logger.info(
+                f"{self._log_header} {nb_replayed} values replayed in"
+                f" {duration:.3f} s ({rate:.0f} values/s),"
+                f" {len(self)} pending")
+        return nb_replayed
+
+    def _release(self, segment):
+        if segment.nb_pending > 0:
+            return
+        if segment is self._segments[-1]:
+            # Segment being written: reused.
+            segment.reset()
+        else:
+            segment.close()
+            segment.filepath.unlink()
+            self._segments.remove(segment)
+
+    @staticmethod
+    def _write(writer, records, connection):
+        if np is not None:
+            array = np.frombuffer(records, dtype=_RECORD_DTYPE)
+            for idx, on_conflict in enumerate(ON_CONFLICT_ACTIONS):
+                values = array[array["on_conflict"] == idx]
+                if len(values) > 0:
+                    writer.write_arrays(
+                        values["timeseries_id"], values["timestamp"],
+                        values["value"], on_conflict=on_conflict,
+                        connection=connection)
+            return
+        rows_by_action = {x: [] for x in ON_CONFLICT_ACTIONS}
+        for ts_id, timestamp, value, action in _RECORD.iter_unpack(records):
+            rows_by_action[ON_CONFLICT_ACTIONS[action]].append((
+                ts_id, _EPOCH + timestamp * _US,
+                None if math.isnan(value) else value))
+        for on_conflict, rows in rows_by_action.items():
+            if len(rows) > 0:
+                writer.write(
+                    rows, on_conflict=on_conflict, connection=connection)
+
+    def close(self):
+        """Flush segments to disk and close them (see `open`)."""
+        with self._lock:
+            for segment in self._segments:
+                segment.sync()
+                segment.close()
+            self._segments = []
+            self._is_open = False
@@ -0,0 +1,234 @@
+"""Pool of workers decoding messages and writing timeseries data"""
+
+import logging
+import queue
+import threading
+
+from bemserver_core.database import db
+from bemserver_service_acquisition_mqtt import SERVICE_LOGNAME
+from .buffer import TimeseriesDataBuffer
+from .writers import ON_CONFLICT_DO_NOTHING
+
+
+logger = logging.getLogger(SERVICE_LOGNAME)
+
+
+# Queue item asking a worker to stop.
+_STOP = object()
+# Queue item waking up a worker whose buffer is full.
+_FLUSH = object()
+
+
+class _Worker:
+    """Decodes queued messages and writes its partition of values.
+
+    Worker thread owns a database connection, used to flush its buffer.
+    """
+
+    def __init__(self, index, *, queue_size, buffer_size, buffer_max_age,
+                 writer, spool, timestamp_cache):
+        self.index = index
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.buffer = TimeseriesDataBuffer(
+            max_size=buffer_size, max_age=buffer_max_age, writer=writer,
+            spool=spool, timestamp_cache=timestamp_cache)
+        self._thread = None
+
+    @property
+    def _log_header(self):
+        return f"[Writer worker #{self.index}]"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name=f"TimeseriesDataWriter-{self.index}",
+            daemon=True)
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        with db.engine.connect() as connection:
+            while True:
+                try:
+                    item = self.queue.get(
+                        timeout=max(self.buffer.time_before_flush, 0))
+                except queue.Empty:
+                    item = None
+                if item is _STOP:
+                    break
+                if item is not None and item is not _FLUSH:
+                    self._process(*item)
+                try:
+                    self._flush(connection, is_idle=item is None)
+                except Exception:
+                    # Keep the worker alive, whatever happens.
+                    logger.exception(f"{self._log_header} flush failed")
+            self.buffer.flush(connection=connection)
+
+    def _flush(self, connection, *, is_idle):
+        is_flushed = False
+        if self.buffer.must_flush:
+            self.buffer.flush(connection=connection)
+            is_flushed = True
+        if (is_flushed or is_idle) and self.buffer.must_replay:
+            # After a flush (replay is delayed if it failed) or when idle:
+            #  catch up with a batch of spooled values.
+            self.buffer.replay(connection=connection)
+
+    def _process(self, route, client, userdata, msg):
+        try:
+            route.decoder.on_message(client, userdata, msg)
+        except Exception as exc:
+            # Keep the worker alive, whatever happens.
+            logger.error(
+                f"{self._log_header} failed to process message from"
+                f" {msg.topic}: {str(exc)}")
+
+
+class TimeseriesDataWriterPool:
+    """Decodes messages and writes values in parallel, out of MQTT threads.
+
+    MQTT network threads only enqueue messages (see `submit`), so that a
+    slow database write does not block socket reads.
+    Values are partitioned between workers by timeseries ID: values of a
+    timeseries are always written, in order, by the same worker while
+    workers write in parallel. Messages of a topic are all decoded by the
+    worker of its first linked timeseries.
+
+    Payload decoders must use the pool as their buffer.
+
+    :param int nb_workers: (optional, default 4)
+        Number of workers (threads with their own database connection).
+    :param int queue_size: (optional, default 10000)
+        Maximum number of messages waiting for each worker. When a queue is
+        full, MQTT network thread waits (and broker is slowed down).
+    :param int buffer_size: (optional, default 1000)
+        Number of values buffered by each worker that triggers a write.
+    :param float buffer_max_age: (optional, default 1.0)
+        Time, in seconds, a value can be buffered before database write.
+    :param TimeseriesDataWriterBase writer: (optional, default None)
+        Writer used to save values in database. Multi-row INSERT if None.
+    :param list spools: (optional, default None)
+        Spool of each worker (`TimeseriesDataSpool`), for values that can
+        not be written at once.
+    :param TimeseriesLastTimestampCache timestamp_cache: (optional)
+        Timestamp cache values appended were filtered with.
+    """
+
+    def __init__(self, nb_workers=4, *, queue_size=10000, buffer_size=1000,
+                 buffer_max_age=1.0, writer=None, spools=None,
+                 timestamp_cache=None):
+        if nb_workers < 1:
+            raise ValueError("Invalid number of writer workers!")
+        if spools is not None and len(spools) != nb_workers:
+            raise ValueError("Invalid number of writer workers spools!")
+        self._workers = [
+            _Worker(
+                i, queue_size=queue_size, buffer_size=buffer_size,
+                buffer_max_age=buffer_max_age, writer=writer,
+                spool=None if spools is None else spools[i],
+                timestamp_cache=timestamp_cache)
+            for i in range(nb_workers)
+        ]
+        self._is_running = False
+
+    @property
+    def nb_workers(self):
+        return len(self._workers)
+
+    @property
+    def is_running(self):
+        return self._is_running
+
+    @property
+    def timestamp_cache(self):
+        """Timestamp cache values appended were filtered with (see
+        `TimeseriesDataBuffer`)."""
+        return self._workers[0].buffer.timestamp_cache
+
+    @timestamp_cache.setter
+    def timestamp_cache(self, timestamp_cache):
+        for worker in self._workers:
+            worker.buffer.timestamp_cache = timestamp_cache
+
+    @property
+    def queue_size(self):
+        """Maximum number of messages waiting for each worker."""
+        return self._workers[0].queue.maxsize
+
+    @property
+    def queue_depths(self):
+        """Number of messages waiting, for each worker."""
+        return [x.queue.qsize() for x in self._workers]
+
+    @property
+    def stats(self):
+        """Flush statistics, summed over workers."""
+        stats = {}
+        for worker in self._workers:
+            for key, value in worker.buffer.stats.items():
+                if key.startswith("max_"):
+                    stats[key] = max(stats.get(key, value), value)
+                elif key.startswith("last_"):
+                    continue
+                else:
+                    stats[key] = stats.get(key, 0) + value
+        stats["queue_depths"] = self.queue_depths
+        return stats
+
+    def _partition(self, timeseries_id):
+        return hash(timeseries_id) % len(self._workers)
+
+    def start(self):
+        """Start workers."""
+        if self._is_running:
+            return
+        for worker in self._workers:
+            worker.start()
+        self._is_running = True
+        logger.debug(f"Writer pool started ({self.nb_workers} workers)")
+
+    def stop(self):
+        """Stop workers, once queued messages are processed, and write
+        remaining values."""
+        if not self._is_running:
+            return
+        for worker in self._workers:
+            worker.queue.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+        # Workers may have buffered values for workers already stopped.
+        for worker in self._workers:
+            worker.buffer.flush()
+        self._is_running = False
+        logger.debug("Writer pool stopped")
+
+    def submit(self, route, client, userdata, msg):
+        """Enqueue a message to be decoded and written by a worker.
+
+        :param Route route: Route of message topic.
+        """
+        key = route.links[0].timeseries_id if route.links else msg.topic
+        self._workers[self._partition(key)].queue.put(
+            (route, client, userdata, msg))
+
+    def extend(self, rows, *, on_conflict=ON_CONFLICT_DO_NOTHING):
+        """Append values to the buffers of workers, by timeseries ID.
+
+        :param list rows: List of `(timeseries_id, timestamp, value)` tuples.
+        :param str on_conflict: (optional, default "nothing")
+            What to do with values already in database.
+        """
+        partitions = {}
+        for row in rows:
+            partitions.setdefault(self._partition(row[0]), []).append(row)
+        for index, partition_rows in partitions.items():
+            worker = self._workers[index]
+            if worker.buffer.extend(partition_rows, on_conflict=on_conflict):
+                # Wake up worker, if not busy, to write its full buffer.
+                try:
+                    worker.queue.put_nowait(_FLUSH)
+                except queue.Full:
+                    pass
@@ -0,0 +1,347 @@
+"""Timeseries data writers
+
+A writer saves a batch of decoded values in database, in one transaction.
+Each value is a `(timeseries_id, timestamp, value)` tuple.
+"""
+
+import io
+import math
+import struct
+import logging
+import abc
+import time
+import datetime as dt
+import sqlalchemy as sqla
+
+from bemserver_core.database import db
+from bemserver_core.model import TimeseriesData
+from bemserver_service_acquisition_mqtt import SERVICE_LOGNAME
+from bemserver_service_acquisition_mqtt import metrics
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+logger = logging.getLogger(SERVICE_LOGNAME)
+
+
+# Actions when a value already exists in database (same timestamp).
+ON_CONFLICT_DO_NOTHING = "nothing"
+ON_CONFLICT_DO_UPDATE = "update"
+ON_CONFLICT_ACTIONS = (ON_CONFLICT_DO_NOTHING, ON_CONFLICT_DO_UPDATE,)
+
+
+_EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+
+
+def _insert_sql(source, on_conflict):
+    """Set-based INSERT of values selected from source, handling conflicts.
+
+    A value already in database (same timeseries and timestamp) is either
+    skipped or updated, instead of rejecting the whole statement.
+    """
+    sql = (
+        f"INSERT INTO {TimeseriesData.__table__.name}"
+        ' (timeseries_id, "timestamp", value)'
+        f' SELECT timeseries_id, "timestamp", value FROM {source}'
+        ' ON CONFLICT (timeseries_id, "timestamp")'
+    )
+    if on_conflict == ON_CONFLICT_DO_UPDATE:
+        # Do not count (nor rewrite) values that did not change.
+        return (
+            f"{sql} DO UPDATE SET value = excluded.value"
+            f" WHERE {TimeseriesData.__table__.name}.value"
+            " IS DISTINCT FROM excluded.value"
+        )
+    return f"{sql} DO NOTHING"
+
+
+def _rows_from_arrays(timeseries_ids, timestamps, values):
+    """Convert values arrays to `(timeseries_id, timestamp, value)` tuples."""
+    return [
+        (
+            ts_id,
+            _EPOCH + dt.timedelta(microseconds=timestamp),
+            None if math.isnan(value) else value,
+        )
+        for ts_id, timestamp, value in zip(
+            timeseries_ids.tolist(), timestamps.tolist(), values.tolist())
+    ]
+
+
+class TimeseriesDataWriterBase(abc.ABC):
+
+    name = None
+    description = None
+
+    @property
+    def _log_header(self):
+        return f"[Timeseries data writer {self.name}]"
+
+    def write(self, rows, *, on_conflict=ON_CONFLICT_DO_NOTHING,
+              connection=None):
+        """Write timeseries data values in database, in one transaction.
+
+        :param list rows: List of `(timeseries_id, timestamp, value)` tuples.
+        :param str on_conflict: (optional, default "nothing")
+            What to do with values already in database: "nothing" to skip
+            them or "update" to overwrite them.
+        :param sqlalchemy.engine.Connection connection: (optional)
+            Database connection to use. If None, one is taken from pool.
+        :returns int: Number of values actually written (inserted or
+            updated). Values skipped are not counted.
+        :raises ValueError: When on conflict action is not valid.
+        """
+        if on_conflict not in ON_CONFLICT_ACTIONS:
+            raise ValueError("Invalid on conflict action!")
+        if len(rows) <= 0:
+            return 0
+        if on_conflict == ON_CONFLICT_DO_UPDATE:
+            # A statement can not update the same value twice: keep last.
+            rows = list({(x[0], x[1]): x for x in rows}.values())
+        return self._transaction(
+            self._write, rows, on_conflict, connection=connection)
+
+    def write_arrays(self, timeseries_ids, timestamps, values, *,
+                     on_conflict=ON_CONFLICT_DO_NOTHING, connection=None):
+        """Write timeseries data values arrays in database, in one transaction.
+
+        Columnar counterpart of `write`, for decoded batches
+        (see `PayloadDecoderBase.decode_batch`). Requires numpy.
+
+        :param numpy.ndarray timeseries_ids: Timeseries IDs.
+        :param numpy.ndarray timestamps: Timestamps, as int64 microseconds
+            since Unix epoch.
+        :param numpy.ndarray values: Values, as float64 (NaN is NULL).
+        :param str on_conflict: (optional, default "nothing")
+            What to do with values already in database: "nothing" to skip
+            them or "update" to overwrite them.
+        :param sqlalchemy.engine.Connection connection: (optional)
+            Database connection to use. If None, one is taken from pool.
+        :returns int: Number of values actually written (inserted or
+            updated). Values skipped are not counted.
+        :raises ValueError: When on conflict action is not valid or arrays
+            lengths differ.
+        """
+        if on_conflict not in ON_CONFLICT_ACTIONS:
+            raise ValueError("Invalid on conflict action!")
+        if not len(timeseries_ids) == len(timestamps) == len(values):
+            raise ValueError("Arrays lengths differ!")
+        if len(timeseries_ids) <= 0:
+            return 0
+        timeseries_ids = np.asarray(timeseries_ids, dtype=np.int64)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        if on_conflict == ON_CONFLICT_DO_UPDATE:
+            # A statement can not update the same value twice: keep last.
+            keys = np.stack((timeseries_ids, timestamps), axis=1)[::-1]
+            _, last = np.unique(keys, axis=0, return_index=True)
+            last = np.sort(len(keys) - 1 - last)
+            timeseries_ids = timeseries_ids[last]
+            timestamps = timestamps[last]
+            values = values[last]
+        return self._transaction(
+            self._write_arrays, timeseries_ids, timestamps, values,
+            on_conflict, connection=connection)
+
+    def _transaction(self, write_func, *args, connection=None):
+        """Call a write function in a transaction, and update metrics."""
+        t_start = time.perf_counter()
+        try:
+            if connection is None:
+                with db.engine.begin() as conn:
+                    nb_written = write_func(conn, *args)
+            else:
+                with connection.begin():
+                    nb_written = write_func(connection, *args)
+        except Exception:
+            metrics.WRITE_FAILURES.labels(self.name).inc()
+            raise
+        metrics.WRITE_DURATION.labels(self.name).observe(
+            time.perf_counter() - t_start)
+        metrics.VALUES_WRITTEN.labels(self.name).inc(nb_written)
+        return nb_written
+
+    @abc.abstractmethod
+    def _write(self, conn, rows, on_conflict):
+        """Write values using an opened database connection (transaction).
+
+        :returns int: Number of values actually written.
+        """
+
+    def _write_arrays(self, conn, timeseries_ids, timestamps, values,
+                      on_conflict):
+        """Write values arrays using an opened database connection.
+
+        Values are converted to rows by default.
+
+        :returns int: Number of values actually written.
+        """
+        return self._write(
+            conn, _rows_from_arrays(timeseries_ids, timestamps, values),
+            on_conflict)
+
+
+class TimeseriesDataWriterInsert(TimeseriesDataWriterBase):
+
+    name = "insert"
+    description = "Set-based INSERT of timeseries data values"
+
+    _SOURCE = (
+        "unnest("
+        "CAST(:timeseries_ids AS integer[]),"
+        " CAST(:timestamps AS timestamptz[]),"
+        " CAST(:values AS double precision[])"
+        ') AS source (timeseries_id, "timestamp", value)'
+    )
+
+    def __init__(self):
+        self._stmts = {
+            x: sqla.text(_insert_sql(self._SOURCE, x))
+            for x in ON_CONFLICT_ACTIONS
+        }
+
+    def _write(self, conn, rows, on_conflict):
+        # Values are sent as 3 arrays, for the whole batch in one statement.
+        result = conn.execute(self._stmts[on_conflict], {
+            "timeseries_ids": [x[0] for x in rows],
+            "timestamps": [x[1] for x in rows],
+            "values": [None if x[2] is None else float(x[2]) for x in rows],
+        })
+        return result.rowcount
+
+
+class TimeseriesDataWriterCopyBase(TimeseriesDataWriterBase):
+    """Streams values in database with PostgreSQL `COPY FROM STDIN`."""
+
+    copy_format = None
+
+    # COPY can not handle conflicts: values are copied in a staging table
+    #  (emptied at each commit) then inserted from it.
+    _STAGING_TABLE = "mqtt_timeseries_data_staging"
+    _STAGING_SQL = sqla.text(
+        f"CREATE TEMPORARY TABLE IF NOT EXISTS {_STAGING_TABLE}"
+        ' (timeseries_id integer, "timestamp" timestamptz,'
+        " value double precision)"
+        " ON COMMIT DELETE ROWS"
+    )
+
+    def __init__(self):
+        self._copy_sql = (
+            f"COPY {self._STAGING_TABLE} (timeseries_id, \"timestamp\", value)"
+            f" FROM STDIN WITH (FORMAT {self.copy_format})"
+        )
+        self._stmts = {
+            x: sqla.text(_insert_sql(self._STAGING_TABLE, x))
+            for x in ON_CONFLICT_ACTIONS
+        }
+
+    def _write(self, conn, rows, on_conflict):
+        return self._copy(conn, self._serialize(rows), on_conflict)
+
+    def _copy(self, conn, data, on_conflict):
+        conn.execute(self._STAGING_SQL)
+        with conn.connection.cursor() as cursor:
+            cursor.copy_expert(self._copy_sql, data)
+        return conn.execute(self._stmts[on_conflict]).rowcount
+
+    @abc.abstractmethod
+    def _serialize(self, rows):
+        """Serialize values in COPY format.
+
+        :param list rows: List of `(timeseries_id, timestamp, value)` tuples.
+        :returns io.IOBase: File-like object of COPY data.
+        """
+
+
+class TimeseriesDataWriterCopyCSV(TimeseriesDataWriterCopyBase):
+
+    name = "copy_csv"
+    description = "PostgreSQL COPY (CSV format) of timeseries data values"
+    copy_format = "csv"
+
+    @staticmethod
+    def _format_value(value):
+        # An empty unquoted field is NULL in COPY CSV format.
+        if value is None:
+            return ""
+        value = float(value)
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "Infinity" if value > 0 else "-Infinity"
+        return repr(value)
+
+    def _serialize(self, rows):
+        return io.StringIO("".join(
+            f"{ts_id},{timestamp.isoformat()},{self._format_value(value)}\n"
+            for ts_id, timestamp, value in rows
+        ))
+
+
+class TimeseriesDataWriterCopyBinary(TimeseriesDataWriterCopyBase):
+
+    name = "copy_binary"
+    description = "PostgreSQL COPY (binary format) of timeseries data values"
+    copy_format = "binary"
+
+    # Binary COPY file layout, see "Binary Format" section of:
+    #  https://www.postgresql.org/docs/current/sql-copy.html
+    _HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+    _TRAILER = struct.pack("!h", -1)
+    # Tuples: field count, then each field length and data.
+    #  (int4 timeseries_id, timestamptz timestamp, float8 value)
+    _ROW = struct.Struct("!hiiiqid")
+    _ROW_NULL_VALUE = struct.Struct("!hiiiqi")
+    # timestamptz is stored as microseconds since PostgreSQL epoch.
+    _PG_EPOCH = dt.datetime(2000, 1, 1, tzinfo=dt.timezone.utc)
+    _US = dt.timedelta(microseconds=1)
+    _PG_EPOCH_OFFSET_US = (_PG_EPOCH - _EPOCH) // _US
+    # Tuples as a numpy record (same layout as _ROW), to serialize arrays.
+    _ROW_DTYPE = None if np is None else np.dtype([
+        ("nb_fields", ">i2"),
+        ("timeseries_id_len", ">i4"), ("timeseries_id", ">i4"),
+        ("timestamp_len", ">i4"), ("timestamp", ">i8"),
+        ("value_len", ">i4"), ("value", ">f8"),
+    ])
+
+    def _serialize(self, rows):
+        data = io.BytesIO()
+        data.write(self._HEADER)
+        for ts_id, timestamp, value in rows:
+            pg_timestamp = (timestamp - self._PG_EPOCH) // self._US
+            if value is None:
+                data.write(self._ROW_NULL_VALUE.pack(
+                    3, 4, ts_id, 8, pg_timestamp, -1))
+            else:
+                data.write(self._ROW.pack(
+                    3, 4, ts_id, 8, pg_timestamp, 8, float(value)))
+        data.write(self._TRAILER)
+        data.seek(0)
+        return data
+
+    def _write_arrays(self, conn, timeseries_ids, timestamps, values,
+                      on_conflict):
+        return self._copy(
+            conn,
+            self._serialize_arrays(timeseries_ids, timestamps, values),
+            on_conflict)
+
+    def _serialize_arrays(self, timeseries_ids, timestamps, values):
+        nulls = np.isnan(values)
+        if nulls.any():
+            # NULL values have no data: tuples are not all the same size.
+            return self._serialize(
+                _rows_from_arrays(timeseries_ids, timestamps, values))
+        tuples = np.empty(len(values), dtype=self._ROW_DTYPE)
+        tuples["nb_fields"] = 3
+        tuples["timeseries_id_len"] = 4
+        tuples["timeseries_id"] = timeseries_ids
+        tuples["timestamp_len"] = 8
+        tuples["timestamp"] = timestamps - self._PG_EPOCH_OFFSET_US
+        tuples["value_len"] = 8
+        tuples["value"] = values
+        return io.BytesIO(
+            b"".join((self._HEADER, tuples.tobytes(), self._TRAILER)))
@@ -0,0 +1,116 @@
+"""Topology change listener
+
+`TopologyListener` waits, in a thread, for the notifications sent by
+PostgreSQL when topology tables change (LISTEN/NOTIFY, see `model.notify`),
+on a connection of its own. It does not access topology: it only calls a
+callback (which requests a topology reload, see `Service.reload`).
+"""
+
+import select
+import logging
+import threading
+
+from bemserver_core.database import db
+from bemserver_service_acquisition_mqtt import SERVICE_LOGNAME
+from bemserver_service_acquisition_mqtt.model import TOPOLOGY_CHANNEL
+from bemserver_service_acquisition_mqtt.exceptions import ServiceError
+
+
+logger = logging.getLogger(SERVICE_LOGNAME)
+
+
+class TopologyListener:
+    """Listen to topology change notifications, in a thread.
+
+    When database connection is lost, listener connects again (after
+    `retry_delay`) and calls `on_change`, as changes may have been missed
+    meanwhile.
+
+    :param callable on_change: Called (in listener thread) with the names of
+        the tables changed.
+    :param float poll_interval: (optional, default 1.0)
+        Maximum time, in seconds, to wait for notifications before checking
+        whether listener is stopped.
+    :param float retry_delay: (optional, default 10.0)
+        Time, in seconds, before connecting again to database.
+    """
+
+    def __init__(self, on_change, *, poll_interval=1.0, retry_delay=10.0):
+        self._on_change = on_change
+        self._poll_interval = poll_interval
+        self._retry_delay = retry_delay
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @property
+    def _log_header(self):
+        return f"[Topology listener {TOPOLOGY_CHANNEL}]"
+
+    @property
+    def is_running(self):
+        return self._thread is not None
+
+    def start(self):
+        """Start listening.
+
+        :raises ServiceError: When database is not PostgreSQL.
+        """
+        if self._thread is not None:
+            return
+        if db.engine.dialect.name != "postgresql":
+            raise ServiceError(
+                "Topology change notifications require PostgreSQL!")
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="TopologyListener", daemon=True)
+        self._thread.start()
+        logger.debug(f"{self._log_header} started")
+
+    def stop(self):
+        """Stop listening."""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        logger.debug(f"{self._log_header} stopped")
+
+    def _run(self):
+        is_reconnection = False
+        while not self._stop_event.is_set():
+            try:
+                self._listen(is_reconnection)
+            except Exception as exc:
+                logger.error(
+                    f"{self._log_header} listening failed: {str(exc)}")
+            is_reconnection = True
+            self._stop_event.wait(self._retry_delay)
+
+    def _listen(self, is_reconnection):
+        # A connection of its own, out of the pool: autocommit is set on it.
+        conn = db.engine.raw_connection()
+        conn.detach()
+        try:
+            dbapi_conn = conn.connection
+            dbapi_conn.autocommit = True
+            cursor = dbapi_conn.cursor()
+            cursor.execute(f"LISTEN {TOPOLOGY_CHANNEL}")
+            cursor.close()
+            if is_reconnection:
+                logger.info(f"{self._log_header} listening again")
+                self._on_change(set())
+            while not self._stop_event.is_set():
+                readable, _, _ = select.select(
+                    [dbapi_conn], [], [], self._poll_interval)
+                if not readable:
+                    continue
+                dbapi_conn.poll()
+                if dbapi_conn.notifies:
+                    tables = {x.payload for x in dbapi_conn.notifies}
+                    dbapi_conn.notifies.clear()
+                    logger.debug(
+                        f"{self._log_header} tables changed:"
+                        f" {', '.join(sorted(tables))}")
+                    self._on_change(tables)
+        finally:
+            conn.close()
@@ -0,0 +1,245 @@
+"""Single network loop for MQTT clients
+
+By default, each subscriber MQTT client runs its own network loop thread
+(paho `loop_start`). Instead, `NetworkLoop` drives the sockets of all clients
+from one selector in one thread, using paho external loop interface
+(`loop_read`, `loop_write`, `loop_misc` and socket callbacks). Thread count
+then no longer depends on the number of subscribers.
+"""
+
+import time
+import socket
+import logging
+import threading
+import selectors
+import paho.mqtt.client as mqttc
+
+from bemserver_service_acquisition_mqtt import SERVICE_LOGNAME
+
+
+logger = logging.getLogger(SERVICE_LOGNAME)
+
+
+# Network loop modes.
+NETWORK_LOOP_THREADED = "threaded"
+NETWORK_LOOP_SELECTOR = "selector"
+NETWORK_LOOP_MODES = (NETWORK_LOOP_THREADED, NETWORK_LOOP_SELECTOR,)
+
+
+class NetworkLoop:
+    """Network loop of several MQTT clients, in one thread.
+
+    Clients must be added (see `add`) before connecting them, for their
+    socket to be watched as soon as it is opened.
+    A client whose connection is lost is reconnected (with an increasing
+    delay), until it is removed (see `remove`). Reconnections run in their
+    own thread: a broker slow to accept connection does not stall other
+    clients.
+
+    :param float misc_interval: (optional, default 1.0)
+        Time interval, in seconds, between keepalive and retry checks
+        (`loop_misc`) of clients.
+    :param float reconnect_delay_min: (optional, default 1.0)
+        Time, in seconds, before the first reconnection attempt.
+    :param float reconnect_delay_max: (optional, default 120.0)
+        Maximum time, in seconds, between two reconnection attempts.
+    """
+
+    def __init__(self, *, misc_interval=1.0, reconnect_delay_min=1.0,
+                 reconnect_delay_max=120.0):
+        self._misc_interval = misc_interval
+        self._reconnect_delay_min = reconnect_delay_min
+        self._reconnect_delay_max = reconnect_delay_max
+        self._selector = None
+        # Clients to reconnect, with their name and their next reconnection
+        #  time and delay.
+        self._clients = {}
+        # Clients removed, whose socket is still open (disconnecting).
+        self._removed = set()
+        self._lock = threading.Lock()
+        self._wakeup_r = None
+        self._wakeup_w = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @property
+    def _log_header(self):
+        return "[Network loop]"
+
+    @property
+    def is_running(self):
+        return self._thread is not None
+
+    def __len__(self):
+        return len(self._clients) + len(self._removed)
+
+    def start(self):
+        """Start the network loop thread."""
+        if self._thread is not None:
+            return
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="MQTTNetworkLoop", daemon=True)
+        self._thread.start()
+        logger.debug(f"{self._log_header} started")
+
+    def stop(self):
+        """Stop the network loop thread.
+
+        Clients should be disconnected (and removed) before.
+        """
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._wakeup()
+        self._thread.join()
+        self._thread = None
+        self._selector.close()
+        self._selector = None
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        logger.debug(f"{self._log_header} stopped")
+
+    def add(self, client, *, name=None):
+        """Drive a client from this loop.
+
+        :param paho.mqtt.client.Client client: Client, not connected yet.
+        :param str name: (optional, default None)
+            Name of client in log messages.
+        """
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        with self._lock:
+            self._removed.discard(client)
+            self._clients[client] = [
+                name or str(client), 0.0, self._reconnect_delay_min]
+
+    def remove(self, client):
+        """Stop reconnecting a client (to call before disconnecting it).
+
+        Client socket is watched until it is closed.
+        """
+        with self._lock:
+            self._clients.pop(client, None)
+            if client.socket() is not None:
+                self._removed.add(client)
+
+    # Socket callbacks are called by paho in network loop thread or in the
+    #  thread calling client methods (connect, subscribe, disconnect...).
+    def _on_socket_open(self, client, userdata, sock):
+        with self._lock:
+            if self._selector is None:
+                # Reconnected while loop stopped.
+                return
+            self._selector.register(sock, selectors.EVENT_READ, client)
+        self._wakeup()
+
+    def _on_socket_close(self, client, userdata, sock):
+        with self._lock:
+            try:
+                self._selector.unregister(sock)
+            except KeyError:
+                pass
+            self._removed.discard(client)
+            reconnect_state = self._clients.get(client)
+            if reconnect_state is not None:
+                logger.warning(
+                    f"{self._log_header} {reconnect_state[0]} connection lost")
+                reconnect_state[1] = time.monotonic() + reconnect_state[2]
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        with self._lock:
+            try:
+                self._selector.modify(
+                    sock, selectors.EVENT_READ | selectors.EVENT_WRITE,
+                    client)
+            except KeyError:
+                # Socket already closed.
+                return
+        self._wakeup()
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        with self._lock:
+            try:
+                self._selector.modify(sock, selectors.EVENT_READ, client)
+            except (KeyError, ValueError):
+                # Socket already closed.
+                pass
+
+    def _wakeup(self):
+        # Break out of select, to watch new sockets or events right away.
+        try:
+            self._wakeup_w.send(b"\0")
+        except (AttributeError, OSError):
+            pass
+
+    def _run(self):
+        next_misc = time.monotonic() + self._misc_interval
+        while not self._stop_event.is_set():
+            timeout = max(next_misc - time.monotonic(), 0)
+            for key, mask in self._selector.select(timeout):
+                if key.fileobj is self._wakeup_r:
+                    try:
+                        self._wakeup_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                client = key.data
+                try:
+                    if mask & selectors.EVENT_READ:
+                        client.loop_read()
+                    if mask & selectors.EVENT_WRITE:
+                        client.loop_write()
+                except Exception as exc:
+                    logger.error(
+                        f"{self._log_header} network error: {str(exc)}")
+            if time.monotonic() >= next_misc:
+                self._loop_misc()
+                next_misc = time.monotonic() + self._misc_interval
+
+    def _loop_misc(self):
+        now = time.monotonic()
+        with self._lock:
+            clients = list(self._clients.items())
+        for client, reconnect_state in clients:
+            if client.socket() is not None:
+                client.loop_misc()
+            elif reconnect_state[1] > 0 and now >= reconnect_state[1]:
+                # Not scheduled again until reconnection is over.
+                with self._lock:
+                    reconnect_state[1] = 0.0
+                threading.Thread(
+                    target=self._reconnect, args=(client, reconnect_state),
+                    name="MQTTReconnect", daemon=True).start()
+
+    def _reconnect(self, client, reconnect_state):
+        name = reconnect_state[0]
+        logger.info(f"{self._log_header} {name} reconnecting...")
+        try:
+            # Blocks until socket is connected (or connection timeout).
+            client.reconnect()
+        except (socket.error, OSError, mqttc.WebsocketConnectionError) as exc:
+            logger.error(
+                f"{self._log_header} {name} reconnection failed: {str(exc)}")
+            self._reconnect_later(reconnect_state)
+        except Exception:
+            # Unexpected error (invalid host...): must not stop reconnecting.
+            logger.exception(f"{self._log_header} {name} reconnection failed")
+            self._reconnect_later(reconnect_state)
+        else:
+            with self._lock:
+                reconnect_state[2] = self._reconnect_delay_min
+
+    def _reconnect_later(self, reconnect_state):
+        # Try again later, waiting longer.
+        with self._lock:
+            reconnect_state[2] = min(
+                reconnect_state[2] * 2, self._reconnect_delay_max)
+            reconnect_state[1] = time.monotonic() + reconnect_state[2]
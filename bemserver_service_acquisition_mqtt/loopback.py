@@ -0,0 +1,431 @@
+"""In-process loopback MQTT transport
+
+A broker whose transport is "loopback" is not reached through a socket: its
+subscribers' MQTT clients are `LoopbackClient` instances, attached to an
+in-process `LoopbackBroker` (one per host and port). Messages published to
+the loopback broker are dispatched at once, in the publishing thread, to the
+message callbacks of subscribed clients (`message_callback_add` handlers,
+else `on_message`), as paho would from its network thread. Topic aliases
+requested by MQTT v5 clients (`TopicAliasMaximum`) are used, as a broker
+would.
+
+No broker is needed and no network jitter is involved: tests, benchmarks of
+the decode and write pipeline at its ceiling, scale tests (100k topics...).
+
+    broker = loopback.get_broker("localhost", 1883)
+    broker.publish("bemserver/test/1", payload, qos=1)
+"""
+
+import itertools
+import logging
+import threading
+import paho.mqtt.client as mqttc
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.reasoncodes import ReasonCodes
+
+from bemserver_service_acquisition_mqtt import SERVICE_LOGNAME
+
+
+logger = logging.getLogger(SERVICE_LOGNAME)
+
+
+TRANSPORT_LOOPBACK = "loopback"
+
+_SHARE_PREFIX = "$share/"
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def get_broker(host="localhost", port=1883):
+    """Get the loopback broker of a host and port (created if needed).
+
+    :param str host: (optional, default "localhost") Broker host name.
+    :param int port: (optional, default 1883) Broker port.
+    :returns LoopbackBroker: Loopback broker.
+    """
+    with _brokers_lock:
+        broker = _brokers.get((host, port))
+        if broker is None:
+            broker = LoopbackBroker(host, port)
+            _brokers[(host, port)] = broker
+        return broker
+
+
+def _has_wildcard(topic_filter):
+    return "+" in topic_filter or "#" in topic_filter
+
+
+def _split_shared(topic_filter):
+    # "$share/<group>/<filter>" -> (group, filter)
+    if topic_filter.startswith(_SHARE_PREFIX):
+        group, _, topic_filter = topic_filter[len(_SHARE_PREFIX):].partition(
+            "/")
+        return group, topic_filter
+    return None, topic_filter
+
+
+class _Subscriptions:
+    """Topic filters: exact ones by topic, wildcard ones in a list.
+
+    Lookups of exact filters do not depend on the number of filters.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._wildcards = {}
+
+    def __len__(self):
+        return len(self._exact) + len(self._wildcards)
+
+    def set(self, topic_filter, value):
+        if _has_wildcard(topic_filter):
+            self._wildcards[topic_filter] = value
+        else:
+            self._exact[topic_filter] = value
+
+    def get(self, topic_filter, default=None):
+        if _has_wildcard(topic_filter):
+            return self._wildcards.get(topic_filter, default)
+        return self._exact.get(topic_filter, default)
+
+    def pop(self, topic_filter, default=None):
+        if _has_wildcard(topic_filter):
+            return self._wildcards.pop(topic_filter, default)
+        return self._exact.pop(topic_filter, default)
+
+    def items(self):
+        yield from self._exact.items()
+        yield from self._wildcards.items()
+
+    def matches(self, topic):
+        """Iterate `(topic_filter, value)` of filters matching a topic."""
+        value = self._exact.get(topic)
+        if value is not None:
+            yield topic, value
+        for topic_filter, value in list(self._wildcards.items()):
+            if mqttc.topic_matches_sub(topic_filter, topic):
+                yield topic_filter, value
+
+
+class LoopbackBroker:
+    """In-process broker, dispatching messages to loopback clients.
+
+    Retained messages are kept and sent to new subscriptions. Messages of a
+    shared subscription group are sent to its members in turn.
+
+    :param str host: Broker host name.
+    :param int port: Broker port.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        # Subscribed clients (and QoS), by topic filter.
+        self._subscriptions = _Subscriptions()
+        # Shared subscriptions: members list and turn, by (group, filter).
+        self._shared = {}
+        self._retained = {}
+        self._lock = threading.Lock()
+
+    @property
+    def _log_header(self):
+        return f"[Loopback broker {self.host}:{self.port}]"
+
+    @property
+    def nb_subscriptions(self):
+        """Number of topic filters subscribed."""
+        return len(self._subscriptions) + len(self._shared)
+
+    def subscribe(self, client, topic_filter, qos):
+        """Subscribe a client to a topic filter.
+
+        :returns list: Retained messages to send, as `(topic, payload, qos)`.
+        """
+        group, topic_filter = _split_shared(topic_filter)
+        with self._lock:
+            if group is not None:
+                members, _ = self._shared.setdefault(
+                    (group, topic_filter), ({}, itertools.count()))
+                members[client] = qos
+            else:
+                clients = self._subscriptions.get(topic_filter)
+                if clients is None:
+                    clients = {}
+                    self._subscriptions.set(topic_filter, clients)
+                clients[client] = qos
+            return [
+                (topic, payload, min(qos, msg_qos))
+                for topic, (payload, msg_qos) in self._retained.items()
+                if mqttc.topic_matches_sub(topic_filter, topic)
+            ]
+
+    def unsubscribe(self, client, topic_filter):
+        group, topic_filter = _split_shared(topic_filter)
+        with self._lock:
+            if group is not None:
+                members, _ = self._shared.get(
+                    (group, topic_filter), ({}, None))
+                members.pop(client, None)
+                if not members:
+                    self._shared.pop((group, topic_filter), None)
+                return
+            clients = self._subscriptions.get(topic_filter, {})
+            clients.pop(client, None)
+            if not clients:
+                self._subscriptions.pop(topic_filter)
+
+    def disconnect(self, client):
+        """Remove all subscriptions of a client."""
+        with self._lock:
+            for topic_filter, clients in list(self._subscriptions.items()):
+                clients.pop(client, None)
+                if not clients:
+                    self._subscriptions.pop(topic_filter)
+            for key, (members, _) in list(self._shared.items()):
+                members.pop(client, None)
+                if not members:
+                    del self._shared[key]
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """Publish a message, dispatched at once to subscribed clients.
+
+        Message callbacks are called in the calling thread.
+
+        :param str topic: Message topic.
+        :param bytes|str payload: (optional, default None) Message payload.
+        :param int qos: (optional, default 0) Message QoS.
+        :param bool retain: (optional, default False)
+            Whether broker keeps message for next subscriptions. An empty
+            payload clears the retained message of topic.
+        :returns int: Number of clients the message is sent to.
+        """
+        if payload is None:
+            payload = b""
+        elif isinstance(payload, str):
+            payload = payload.encode()
+        targets = []
+        with self._lock:
+            if retain:
+                if payload:
+                    self._retained[topic] = (payload, qos)
+                else:
+                    self._retained.pop(topic, None)
+            for _, clients in self._subscriptions.matches(topic):
+                targets.extend(clients.items())
+            for (_, topic_filter), (members, turn) in self._shared.items():
+                if members and mqttc.topic_matches_sub(topic_filter, topic):
+                    clients = list(members.items())
+                    targets.append(clients[next(turn) % len(clients)])
+        for client, sub_qos in targets:
+            client._deliver(topic, payload, min(qos, sub_qos), False)
+        return len(targets)
+
+
+class LoopbackClient:
+    """MQTT client attached to a loopback broker, instead of a socket.
+
+    Same interface as `paho.mqtt.client.Client` (what the service uses).
+    """
+
+    def __init__(self, client_id="", clean_session=None, userdata=None,
+                 protocol=mqttc.MQTTv311, transport=TRANSPORT_LOOPBACK):
+        self._client_id = client_id
+        self._userdata = userdata
+        self._protocol = protocol
+        self._broker = None
+        self._is_connected = False
+        self._mid = itertools.count(1)
+        self._callbacks = _Subscriptions()
+        self._callbacks_lock = threading.Lock()
+        # Topic aliases sent to client, by topic (MQTT v5).
+        self._topic_alias_maximum = 0
+        self._topic_aliases = {}
+        self._topic_aliases_lock = threading.Lock()
+        self._logger = None
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_subscribe = None
+        self.on_unsubscribe = None
+        self.on_message = None
+        self.on_log = None
+        # Set by network loop, never called: there is no socket.
+        self.on_socket_open = None
+        self.on_socket_close = None
+        self.on_socket_register_write = None
+        self.on_socket_unregister_write = None
+        # Connection is immediate: no socket connection timeout.
+        self.connect_timeout = None
+
+    def _reason_code(self, packet_type):
+        if self._protocol == mqttc.MQTTv5:
+            return ReasonCodes(packet_type, "Success")
+        return 0
+
+    def user_data_set(self, userdata):
+        self._userdata = userdata
+
+    def enable_logger(self, logger=None):
+        self._logger = logger
+
+    def disable_logger(self):
+        self._logger = None
+
+    def username_pw_set(self, username, password=None):
+        # No authentication.
+        pass
+
+    def tls_set(self, *args, **kwargs):
+        # No encryption.
+        pass
+
+    def max_inflight_messages_set(self, inflight):
+        # Messages are published at once.
+        pass
+
+    def max_queued_messages_set(self, queue_size):
+        # Messages are published at once.
+        pass
+
+    def socket(self):
+        return None
+
+    def is_connected(self):
+        return self._is_connected
+
+    def connect(self, host, port=1883, keepalive=60, bind_address="",
+                bind_port=0, clean_start=None, properties=None):
+        self._broker = get_broker(host, port)
+        self._topic_alias_maximum = 0
+        if self._protocol == mqttc.MQTTv5 and properties is not None:
+            self._topic_alias_maximum = getattr(
+                properties, "TopicAliasMaximum", None) or 0
+        return self.reconnect()
+
+    def reconnect(self):
+        self._is_connected = True
+        with self._topic_aliases_lock:
+            self._topic_aliases.clear()
+        if self.on_connect is not None:
+            if self._protocol == mqttc.MQTTv5:
+                self.on_connect(
+                    self, self._userdata, {"session present": 0},
+                    self._reason_code(PacketTypes.CONNACK), None)
+            else:
+                self.on_connect(
+                    self, self._userdata, {"session present": 0}, 0)
+        return mqttc.MQTT_ERR_SUCCESS
+
+    def disconnect(self, reasoncode=None, properties=None):
+        if not self._is_connected:
+            return mqttc.MQTT_ERR_NO_CONN
+        self._broker.disconnect(self)
+        self._is_connected = False
+        if self.on_disconnect is not None:
+            if self._protocol == mqttc.MQTTv5:
+                self.on_disconnect(
+                    self, self._userdata,
+                    self._reason_code(PacketTypes.DISCONNECT), None)
+            else:
+                self.on_disconnect(self, self._userdata, 0)
+        return mqttc.MQTT_ERR_SUCCESS
+
+    def loop_start(self):
+        return mqttc.MQTT_ERR_SUCCESS
+
+    def loop_stop(self, force=False):
+        return mqttc.MQTT_ERR_SUCCESS
+
+    def loop_misc(self):
+        return mqttc.MQTT_ERR_SUCCESS
+
+    def subscribe(self, topic, qos=0, options=None, properties=None):
+        """Subscribe to a topic filter, or a list of `(filter, qos)`."""
+        if not self._is_connected:
+            return mqttc.MQTT_ERR_NO_CONN, None
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+        mid = next(self._mid)
+        retained = []
+        for topic_filter, topic_qos in topics:
+            retained.extend(
+                self._broker.subscribe(self, topic_filter, topic_qos))
+        if self.on_subscribe is not None:
+            granted_qos = [x[1] for x in topics]
+            if self._protocol == mqttc.MQTTv5:
+                self.on_subscribe(
+                    self, self._userdata, mid,
+                    [ReasonCodes(PacketTypes.SUBACK, identifier=x)
+                     for x in granted_qos], None)
+            else:
+                self.on_subscribe(
+                    self, self._userdata, mid, tuple(granted_qos))
+        for retained_topic, payload, retained_qos in retained:
+            self._deliver(retained_topic, payload, retained_qos, True)
+        return mqttc.MQTT_ERR_SUCCESS, mid
+
+    def unsubscribe(self, topic, properties=None):
+        if not self._is_connected:
+            return mqttc.MQTT_ERR_NO_CONN, None
+        topics = topic if isinstance(topic, list) else [topic]
+        mid = next(self._mid)
+        for topic_filter in topics:
+            self._broker.unsubscribe(self, topic_filter)
+        if self.on_unsubscribe is not None:
+            if self._protocol == mqttc.MQTTv5:
+                self.on_unsubscribe(
+                    self, self._userdata, mid, None,
+                    [ReasonCodes(PacketTypes.UNSUBACK)
+                     for _ in topics])
+            else:
+                self.on_unsubscribe(self, self._userdata, mid)
+        return mqttc.MQTT_ERR_SUCCESS, mid
+
+    def publish(self, topic, payload=None, qos=0, retain=False,
+                properties=None):
+        """Publish a message to loopback broker (dispatched at once)."""
+        info = mqttc.MQTTMessageInfo(next(self._mid))
+        if not self._is_connected:
+            info.rc = mqttc.MQTT_ERR_NO_CONN
+            return info
+        self._broker.publish(topic, payload, qos=qos, retain=retain)
+        info.rc = mqttc.MQTT_ERR_SUCCESS
+        info._set_as_published()
+        return info
+
+    def message_callback_add(self, sub, callback):
+        with self._callbacks_lock:
+            self._callbacks.set(sub, callback)
+
+    def message_callback_remove(self, sub):
+        with self._callbacks_lock:
+            self._callbacks.pop(sub)
+
+    def _deliver(self, topic, payload, qos, retain):
+        msg = mqttc.MQTTMessage(topic=topic.encode())
+        msg.payload = payload
+        msg.qos = qos
+        msg.retain = retain
+        if not self._topic_alias_maximum:
+            self._dispatch(topic, msg)
+            return
+        # Aliased messages must be received after the one setting alias.
+        with self._topic_aliases_lock:
+            alias = self._topic_aliases.get(topic)
+            msg.properties = Properties(PacketTypes.PUBLISH)
+            if alias is not None:
+                msg.topic = b""
+                msg.properties.TopicAlias = alias
+            elif len(self._topic_aliases) < self._topic_alias_maximum:
+                alias = self._topic_aliases[topic] = (
+                    len(self._topic_aliases) + 1)
+                msg.properties.TopicAlias = alias
+            self._dispatch(topic, msg)
+
+    def _dispatch(self, topic, msg):
+        matched = False
+        for _, callback in self._callbacks.matches(topic):
+            matched = True
+            callback(self, self._userdata, msg)
+        if not matched and self.on_message is not None:
+            self.on_message(self, self._userdata, msg)
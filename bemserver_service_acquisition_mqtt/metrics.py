@@ -0,0 +1,428 @@
+"""Service metrics, exposed to Prometheus
+
+Counters, gauges and histograms are updated from MQTT network threads,
+writer workers... Updates do not take a lock: each thread updates its own
+cell of a metric (a thread only ever writes its cells), cells are summed
+when metrics are collected. A lock is only taken the first time a thread
+updates a metric (labels).
+
+Metrics are collected in Prometheus text format, by an optional HTTP server
+(see `MetricsServer`):
+    GET http://<host>:<port>/metrics
+"""
+
+import bisect
+import logging
+import math
+import threading
+import http.server
+
+from bemserver_service_acquisition_mqtt import SERVICE_LOGNAME
+
+
+logger = logging.getLogger(SERVICE_LOGNAME)
+
+_get_ident = threading.get_ident
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Latency buckets, in seconds.
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0,
+)
+
+
+def _escape(value):
+    return (
+        str(value).replace("\\", "\\\\").replace("\n", "\\n")
+        .replace('"', '\\"'))
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = [
+        f'{name}="{_escape(value)}"'
+        for name, value in list(zip(labelnames, labelvalues)) + list(extra)
+    ]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _CounterChild:
+
+    __slots__ = ("_cells", "_lock")
+
+    def __init__(self):
+        # Value of each thread, by thread ID.
+        self._cells = {}
+        self._lock = threading.Lock()
+
+    def _cell(self):
+        ident = _get_ident()
+        cell = self._cells.get(ident)
+        if cell is None:
+            with self._lock:
+                cell = self._cells.setdefault(ident, [0])
+        return cell
+
+    def inc(self, amount=1):
+        """Increment counter.
+
+        :param int|float amount: (optional, default 1) Positive increment.
+        """
+        self._cell()[0] += amount
+
+    @property
+    def value(self):
+        return sum(x[0] for x in list(self._cells.values()))
+
+
+class _GaugeChild:
+
+    __slots__ = ("_value", "_function")
+
+    def __init__(self):
+        self._value = 0
+        self._function = None
+
+    def set(self, value):
+        """Set gauge value."""
+        self._value = value
+
+    def set_function(self, function):
+        """Get gauge value from a function, called when collected."""
+        self._function = function
+
+    @property
+    def value(self):
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception:
+                return math.nan
+        return self._value
+
+
+class _HistogramChild:
+
+    __slots__ = ("_buckets", "_cells", "_lock")
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+        # Counts of each bucket (and +Inf), sum, for each thread.
+        self._cells = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Observe a value (a latency, in seconds...)."""
+        ident = _get_ident()
+        cell = self._cells.get(ident)
+        if cell is None:
+            with self._lock:
+                cell = self._cells.setdefault(
+                    ident, [0] * (len(self._buckets) + 2))
+        cell[bisect.bisect_left(self._buckets, value)] += 1
+        cell[-1] += value
+
+    @property
+    def value(self):
+        """Bucket counts (not cumulative, last one is +Inf) and sum."""
+        total = [0] * (len(self._buckets) + 2)
+        for cell in list(self._cells.values()):
+            for idx, x in enumerate(cell):
+                total[idx] += x
+        return total[:-1], total[-1]
+
+
+class _Metric:
+
+    type_name = None
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *labelvalues):
+        """Get the child metric of label values.
+
+        :param labelvalues: Values of labels, in labels order.
+        """
+        child = self._children.get(labelvalues)
+        if child is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError(f"Invalid labels for {self.name} metric!")
+            with self._lock:
+                child = self._children.setdefault(
+                    labelvalues, self._new_child())
+        return child
+
+    def remove(self, *labelvalues):
+        """Remove the child metric of label values."""
+        with self._lock:
+            self._children.pop(labelvalues, None)
+
+    def collect(self):
+        """Get metric samples, in Prometheus text format.
+
+        :returns list: Lines.
+        """
+        lines = [
+            f"# HELP {self.name} {_escape(self.description)}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        for labelvalues, child in sorted(list(self._children.items())):
+            lines.extend(self._collect_child(labelvalues, child))
+        return lines
+
+    def _collect_child(self, labelvalues, child):
+        labels = _format_labels(self.labelnames, labelvalues)
+        return [f"{self.name}{labels} {_format_value(child.value)}"]
+
+
+class Counter(_Metric):
+    """Counter, only increasing (messages received...).
+
+    :param str name: Metric name.
+    :param str description: Metric help text.
+    :param tuple labelnames: (optional) Names of labels.
+    """
+
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        """Increment counter (without labels)."""
+        self._children[()].inc(amount)
+
+
+class Gauge(_Metric):
+    """Gauge, a value that can go up and down (queue depth...).
+
+    :param str name: Metric name.
+    :param str description: Metric help text.
+    :param tuple labelnames: (optional) Names of labels.
+    """
+
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        """Set gauge value (without labels)."""
+        self._children[()].set(value)
+
+    def set_function(self, function):
+        """Get gauge value (without labels) from a function."""
+        self._children[()].set_function(function)
+
+
+class Histogram(_Metric):
+    """Histogram of observed values (latencies...).
+
+    :param str name: Metric name.
+    :param str description: Metric help text.
+    :param tuple labelnames: (optional) Names of labels.
+    :param tuple buckets: (optional) Upper bounds of buckets, sorted.
+    """
+
+    type_name = "histogram"
+
+    def __init__(self, name, description, labelnames=(), *,
+                 buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, description, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        """Observe a value (without labels)."""
+        self._children[()].observe(value)
+
+    def _collect_child(self, labelvalues, child):
+        counts, total = child.value
+        lines = []
+        cumulated = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulated += count
+            labels = _format_labels(
+                self.labelnames, labelvalues,
+                extra=(("le", _format_value(bound)),))
+            lines.append(f"{self.name}_bucket{labels} {cumulated}")
+        labels = _format_labels(self.labelnames, labelvalues)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulated}")
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of metrics, collected together."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"{metric.name} metric already registered!")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, labelnames=()):
+        """Create and register a counter."""
+        return self._register(Counter(name, description, labelnames))
+
+    def gauge(self, name, description, labelnames=()):
+        """Create and register a gauge."""
+        return self._register(Gauge(name, description, labelnames))
+
+    def histogram(self, name, description, labelnames=(), *,
+                  buckets=DEFAULT_BUCKETS):
+        """Create and register a histogram."""
+        return self._register(
+            Histogram(name, description, labelnames, buckets=buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def collect(self):
+        """Get all metrics, in Prometheus text format.
+
+        :returns str: Metrics samples.
+        """
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+MESSAGES_RECEIVED = REGISTRY.counter(
+    "bemserver_mqtt_messages_received_total",
+    "MQTT messages received", ("subscriber", "topic"))
+DECODE_FAILURES = REGISTRY.counter(
+    "bemserver_mqtt_decode_failures_total",
+    "Payloads that could not be decoded", ("decoder",))
+VALUES_WRITTEN = REGISTRY.counter(
+    "bemserver_mqtt_values_written_total",
+    "Timeseries data values written in database", ("writer",))
+WRITE_FAILURES = REGISTRY.counter(
+    "bemserver_mqtt_write_failures_total",
+    "Database writes (transactions) that failed", ("writer",))
+WRITE_DURATION = REGISTRY.histogram(
+    "bemserver_mqtt_write_duration_seconds",
+    "Duration of database writes (transactions)", ("writer",))
+QUEUE_DEPTH = REGISTRY.gauge(
+    "bemserver_mqtt_queue_depth",
+    "Messages waiting for a writer worker", ("worker",))
+BUFFERED_VALUES = REGISTRY.gauge(
+    "bemserver_mqtt_buffered_values",
+    "Values waiting in write-behind buffer")
+SUBSCRIBER_CONNECTED = REGISTRY.gauge(
+    "bemserver_mqtt_subscriber_connected",
+    "Whether subscriber MQTT client is connected", ("subscriber",))
+SUBSCRIBER_DISCONNECTIONS = REGISTRY.counter(
+    "bemserver_mqtt_subscriber_disconnections_total",
+    "Unexpected disconnections of subscriber MQTT client", ("subscriber",))
+SUBSCRIPTIONS = REGISTRY.counter(
+    "bemserver_mqtt_subscriptions_total",
+    "Subscriptions acknowledged by broker", ("subscriber",))
+CLIENT_LOG_MESSAGES = REGISTRY.counter(
+    "bemserver_mqtt_client_log_messages_total",
+    "MQTT client warnings and errors", ("subscriber", "level"))
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    registry = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.collect().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"[Metrics server] {format % args}")
+
+
+class MetricsServer:
+    """HTTP server exposing metrics to Prometheus, in a background thread.
+
+    :param str host: (optional, default "127.0.0.1")
+        Host address to listen to.
+    :param int port: (optional, default 9108) Port to listen to (0 for any
+        free port).
+    :param MetricsRegistry registry: (optional, default None)
+        Metrics to expose. If None, service metrics.
+    """
+
+    def __init__(self, host="127.0.0.1", port=9108, *, registry=None):
+        self.host = host
+        self.port = port
+        self.registry = registry or REGISTRY
+        self._server = None
+        self._thread = None
+
+    @property
+    def _log_header(self):
+        return f"[Metrics server {self.host}:{self.port}]"
+
+    @property
+    def is_running(self):
+        return self._server is not None
+
+    def start(self):
+        """Start serving metrics.
+
+        :raises OSError: When address is not available.
+        """
+        if self._server is not None:
+            return
+        handler_cls = type(
+            "MetricsRequestHandler", (_MetricsRequestHandler,),
+            {"registry": self.registry})
+        self._server = http.server.ThreadingHTTPServer(
+            (self.host, self.port), handler_cls)
+        self._server.daemon_threads = True
+        # Actual port, when any free port is asked.
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="MetricsServer",
+            daemon=True)
+        self._thread.start()
+        logger.info(f"{self._log_header} serving metrics")
+
+    def stop(self):
+        """Stop serving metrics."""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
+        logger.debug(f"{self._log_header} stopped")
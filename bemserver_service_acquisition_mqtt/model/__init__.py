@@ -8,4 +8,6 @@ A subscriber can:
 from .broker import Broker  # noqa
 from .subscriber import Subscriber  # noqa
 from .payload_decoder import PayloadDecoder, PayloadField  # noqa
-from .topic import Topic, TopicLink, TopicByBroker, TopicBySubscriber  # noqa
+from .topic import (  # noqa
+    Topic, TopicLink, TopicDeviceLink, TopicByBroker, TopicBySubscriber)
+from .notify import TOPOLOGY_CHANNEL, install_topology_triggers  # noqa
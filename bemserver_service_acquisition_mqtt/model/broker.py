@@ -23,7 +23,8 @@ class Broker(Base, BaseMixin):
     :param int protocol_version: (default 5)
         MQTT protocol version required by the broker.
     :param str transport: (default "tcp")
-        Transport mode used for the connection to the broker.
+        Transport mode used for the connection to the broker ("tcp",
+        "websockets" or "loopback", an in-process broker).
     :param str description: (optional, default None)
         Text to describe the broker.
     :param bool is_auth_required: (default False)
@@ -41,6 +42,8 @@ class Broker(Base, BaseMixin):
     class Transport(enum.Enum):
         tcp = "tcp"
         websockets = "websockets"
+        # In-process broker, for tests and benchmarks (see `loopback`).
+        loopback = "loopback"
 
     id = sqla.Column(sqla.Integer, primary_key=True)
     host = sqla.Column(sqla.String(250), nullable=False)
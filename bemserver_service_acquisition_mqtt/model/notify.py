@@ -0,0 +1,82 @@
+"""Topology change notifications
+
+PostgreSQL triggers notify a channel when topology tables (brokers,
+subscribers, topics, links...) change, so that the running service reloads
+its topology (see `listener.TopologyListener`). Notification payload is the
+name of the table changed.
+
+Triggers are created with tables. `install_topology_triggers` creates them in
+a database created by a previous version.
+"""
+
+import sqlalchemy as sqla
+
+from bemserver_core.database import db
+from .broker import Broker
+from .subscriber import Subscriber
+from .topic import Topic, TopicLink, TopicDeviceLink, TopicBySubscriber
+
+
+TOPOLOGY_CHANNEL = "mqtt_topology"
+
+# Columns updated by the service itself (connection and subscription
+#  states): updating them is not a topology change.
+_STATE_COLUMNS = {
+    "is_connected", "timestamp_last_connection",
+    "is_subscribed", "timestamp_last_subscription",
+}
+
+_TOPOLOGY_TABLES = (
+    Broker.__table__,
+    Subscriber.__table__,
+    Topic.__table__,
+    TopicLink.__table__,
+    TopicDeviceLink.__table__,
+    TopicBySubscriber.__table__,
+)
+
+_FUNCTION_DDL = f"""
+CREATE OR REPLACE FUNCTION mqtt_topology_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{TOPOLOGY_CHANNEL}', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def _trigger_ddl(table):
+    # One notification by statement, whatever the number of rows.
+    columns = ", ".join(
+        x.name for x in table.columns if x.name not in _STATE_COLUMNS)
+    return [
+        f"DROP TRIGGER IF EXISTS mqtt_topology_notify ON {table.name}",
+        (
+            f"CREATE TRIGGER mqtt_topology_notify"
+            f" AFTER INSERT OR DELETE OR TRUNCATE OR UPDATE OF {columns}"
+            f" ON {table.name}"
+            " FOR EACH STATEMENT EXECUTE PROCEDURE mqtt_topology_notify()"
+        ),
+    ]
+
+
+def install_topology_triggers():
+    """Create (or replace) topology notification triggers in database.
+
+    Only PostgreSQL databases are supported.
+    """
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(_FUNCTION_DDL)
+        for table in _TOPOLOGY_TABLES:
+            for statement in _trigger_ddl(table):
+                conn.exec_driver_sql(statement)
+
+
+for _table in _TOPOLOGY_TABLES:
+    sqla.event.listen(
+        _table, "after_create",
+        sqla.DDL(_FUNCTION_DDL).execute_if(dialect="postgresql"))
+    for _statement in _trigger_ddl(_table):
+        sqla.event.listen(
+            _table, "after_create",
+            sqla.DDL(_statement).execute_if(dialect="postgresql"))
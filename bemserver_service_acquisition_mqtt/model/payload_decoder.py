@@ -17,6 +17,12 @@ class PayloadField(Base, BaseMixin):
 
     :param int payload_decoder_id: Relation to a payload decoder unique ID.
     :param str name: Field name in payload.
+    :param str path: (optional, default None)
+        Declarative decoders only: path to value in payload (for example:
+        "objectJSON.channelA.value"). If None, the field name.
+    :param str value_type: (default "float")
+        Declarative decoders only: type of value ("float", "int" or "bool",
+        see `decoders.declarative.ValueType`).
     """
     __tablename__ = "mqtt_payload_field"
     __table_args__ = (
@@ -30,6 +36,10 @@ class PayloadField(Base, BaseMixin):
         nullable=False,
     )
     name = sqla.Column(sqla.String(80), nullable=False)
+    path = sqla.Column(sqla.String(250))
+    value_type = sqla.Column(
+        sqla.String, nullable=False,
+        default=decoders.declarative.ValueType.float.value)
 
     payload_decoder = sqla.orm.relationship(
         "PayloadDecoder", back_populates="fields")
@@ -37,6 +47,9 @@ class PayloadField(Base, BaseMixin):
     topic_links = sqla.orm.relationship(
         "TopicLink", back_populates="payload_field", cascade="all,delete",
         passive_deletes=True)
+    topic_device_links = sqla.orm.relationship(
+        "TopicDeviceLink", back_populates="payload_field",
+        cascade="all,delete", passive_deletes=True)
 
     @classmethod
     def get(cls, payload_decoder_id, field_name):
@@ -55,35 +68,100 @@ class PayloadField(Base, BaseMixin):
         except sqla.exc.NoResultFound:
             return None
 
+    def _verify_consistency(self):
+        if self.value_type and self.value_type not in tuple(
+                x.value for x in decoders.declarative.ValueType):
+            raise ValueError("Invalid payload field value type!")
+        if self.path is not None:
+            decoders.declarative.parse_path(self.path)
+
 
 class PayloadDecoder(Base, BaseMixin):
     """Decribes a payload decoder, with the fields it contains.
 
+    A payload decoder is either implemented by a registered class (see
+    `register_from_class`) or declarative: described by paths to timestamp
+    and fields values in JSON payloads, then compiled to a class.
+
     :param str name: Unique name of payload decoder.
     :param str description: (optional, default None)
         Text to describe the payload decoder.
+    :param str timestamp_path: (optional, default None)
+        Declarative decoders only: path to ISO 8601 timestamp in payload (for
+        example: "rxInfo.0.time").
     """
     __tablename__ = "mqtt_payload_decoder"
 
     id = sqla.Column(sqla.Integer, primary_key=True)
     name = sqla.Column(sqla.String(250), unique=True, nullable=False)
     description = sqla.Column(sqla.String(250))
+    timestamp_path = sqla.Column(sqla.String(250))
 
     topics = sqla.orm.relationship("Topic", back_populates="payload_decoder")
     fields = sqla.orm.relationship(
         "PayloadField", back_populates="payload_decoder", cascade="all,delete",
         passive_deletes=True)
 
-    def add_field(self, field_name):
+    @property
+    def is_declarative(self):
+        return self.timestamp_path is not None
+
+    def _verify_consistency(self):
+        if self.timestamp_path is not None:
+            decoders.declarative.parse_path(self.timestamp_path)
+
+    def add_field(self, field_name, *, path=None, value_type=None):
         """Add a payload field to this payload decoder.
 
         :param str field_name: Unique field name (for this decoder).
+        :param str path: (optional, default None)
+            Declarative decoders only: path to value in payload.
+        :param str value_type: (optional, default None)
+            Declarative decoders only: type of value. If None, "float".
         :returns PayloadField: Instance of created `PayloadField`.
         """
-        field = PayloadField(payload_decoder_id=self.id, name=field_name)
+        field = PayloadField(
+            payload_decoder_id=self.id, name=field_name, path=path,
+            value_type=value_type)
         field.save()
         return field
 
+    def compile_cls(self):
+        """Compile a declarative payload decoder to a decoder class.
+
+        :returns PayloadDecoderBase: Payload decoder class.
+        :raises PayloadDecoderRegistrationError:
+            When payload decoder is not declarative or not valid.
+        """
+        if not self.is_declarative:
+            raise PayloadDecoderRegistrationError(
+                f"{self.name} payload decoder is not declarative!")
+        try:
+            return decoders.declarative.make_decoder_cls(
+                self.name, self.timestamp_path,
+                [
+                    (
+                        x.name, x.path,
+                        x.value_type
+                        or decoders.declarative.ValueType.float.value,
+                    )
+                    for x in self.fields
+                ],
+                description=self.description)
+        except ValueError as exc:
+            raise PayloadDecoderRegistrationError(
+                f"{self.name} payload decoder is not valid: {exc}")
+
+    @classmethod
+    def get_declarative_list(cls):
+        """Find in database all declarative payload decoders.
+
+        :returns list: Instances of declarative `PayloadDecoder`.
+        """
+        stmt = sqla.select(cls).filter(cls.timestamp_path.is_not(None))
+        stmt = stmt.order_by(cls.id)
+        return [x[0] for x in db.session.execute(stmt).all()]
+
     def remove_field(self, *, field_id=None, field_name=None):
         """Remove a payload field from this payload decoder.
 
@@ -1,6 +1,7 @@
 """MQTT subscriber"""
 
 import logging
+import threading
 import time
 import datetime as dt
 import sqlalchemy as sqla
@@ -9,11 +10,56 @@ import paho.mqtt.properties as mqtt_props
 
 from bemserver_core.database import Base, BaseMixin, db
 from bemserver_service_acquisition_mqtt import SERVICE_LOGNAME
+from bemserver_service_acquisition_mqtt import metrics
+from bemserver_service_acquisition_mqtt import loopback
+from bemserver_service_acquisition_mqtt.routing import TopicAliases
 from bemserver_service_acquisition_mqtt.model import Broker
+from bemserver_service_acquisition_mqtt.model.topic import (
+    Topic, TopicLink, TopicDeviceLink, TopicBySubscriber, verify_share_group,
+    shared_topic_name)
 
 
 logger = logging.getLogger(SERVICE_LOGNAME)
 
+# Time, in seconds, to wait for a broker to accept (or end) a connection.
+CONNECTION_TIMEOUT = 30
+
+# Maximum number of topic filters by SUBSCRIBE (or UNSUBSCRIBE) packet.
+SUBSCRIPTIONS_CHUNK_SIZE = 100
+
+# Bounds of MQTT v5 CONNECT flow control properties (two byte integers).
+RECEIVE_MAXIMUM_MAX = 65535
+TOPIC_ALIAS_MAXIMUM_MAX = 65535
+# Largest MQTT packet: 256 MiB of remaining length, plus fixed header.
+MAXIMUM_PACKET_SIZE_MAX = 268435460
+
+_CLIENT_LOG_LEVELS = {
+    mqttc.MQTT_LOG_WARNING: "warning",
+    mqttc.MQTT_LOG_ERR: "error",
+}
+
+
+class _Client(mqttc.Client):
+    """paho MQTT client whose broker socket connection has its own timeout.
+
+    paho (1.5) uses keepalive (60 s by default) as socket connection timeout,
+    which can exceed connection timeout when broker is unreachable.
+    """
+
+    # Time, in seconds, to open a socket to broker. If None, keepalive.
+    connect_timeout = None
+
+    def _create_socket_connection(self):
+        if self.connect_timeout is None:
+            return super()._create_socket_connection()
+        # Only used as socket timeout here: CONNECT packet is sent after.
+        keepalive = self._keepalive
+        self._keepalive = self.connect_timeout
+        try:
+            return super()._create_socket_connection()
+        finally:
+            self._keepalive = keepalive
+
 
 class Subscriber(Base, BaseMixin):
     """The scubscriber describe how to connect to a broker.
@@ -41,6 +87,29 @@ class Subscriber(Base, BaseMixin):
         Username that authenticates subscriber with the broker, if required.
     :param str password: (optional, default None)
         Password that authenticates subscriber with the broker, if required.
+    :param str share_group: (optional, default None)
+        Name of the share group used to subscribe to topics (shared
+        subscriptions, "$share/<share_group>/<topic>"). Messages are then
+        load-balanced between clients of the group (several service
+        instances). Can be overridden for a topic (see `TopicBySubscriber`).
+    :param int receive_maximum: (optional, default None)
+        MQTT v5 only. Maximum number of QoS 1 and 2 messages the broker
+        sends without waiting for their acknowledgement (1 to 65535). When
+        messages are queued for writer workers, it does not exceed the
+        queue size (see `connect`). If None, broker default (65535).
+    :param int topic_alias_maximum: (optional, default None)
+        MQTT v5 only. Number of topic aliases the broker may use to send
+        topic names as numbers (0 to 65535), to save bandwidth on long topic
+        names. If None (or 0), no topic aliases.
+    :param int maximum_packet_size: (optional, default None)
+        MQTT v5 only. Largest packet, in bytes, accepted from the broker,
+        which drops larger messages. If None, no limit.
+    :param int max_inflight_messages: (optional, default None)
+        Maximum number of QoS 1 and 2 messages published by client being
+        sent at once (0 for no limit). If None, paho default (20).
+    :param int max_queued_messages: (optional, default None)
+        Maximum number of outgoing messages waiting to be sent (0 for no
+        limit). If None, paho default (no limit).
     :param int broker_id: Relation to a broker unique ID.
     :param bool is_connected: (optional, default False)
         Field auto-updated by `connect` and `disconnect` methods.
@@ -60,6 +129,12 @@ class Subscriber(Base, BaseMixin):
     description = sqla.Column(sqla.String(250))
     username = sqla.Column(sqla.String)
     password = sqla.Column(sqla.String)
+    share_group = sqla.Column(sqla.String(250))
+    receive_maximum = sqla.Column(sqla.Integer)
+    topic_alias_maximum = sqla.Column(sqla.Integer)
+    maximum_packet_size = sqla.Column(sqla.Integer)
+    max_inflight_messages = sqla.Column(sqla.Integer)
+    max_queued_messages = sqla.Column(sqla.Integer)
     broker_id = sqla.Column(
         sqla.Integer,
         sqla.ForeignKey('mqtt_broker.id'),
@@ -79,8 +154,20 @@ class Subscriber(Base, BaseMixin):
 
     @property
     def _log_header(self):
+        if self._client_log_header is not None:
+            # Not read from database in MQTT network threads.
+            return self._client_log_header
         return f"[Subscriber #{self.id} @{self.broker.host}]"
 
+    @property
+    def is_connection_changed(self):
+        """Whether connection settings (broker, authentication, session...)
+        changed since client connected. Client must then connect again.
+        """
+        return (
+            self._client_settings is not None
+            and self._client_settings != self._connection_settings())
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._init_on_load()
@@ -90,6 +177,31 @@ class Subscriber(Base, BaseMixin):
         self._client_id = None
         self._client = None
         self._client_session_present = False
+        self._on_message = None
+        self._network_loop = None
+        # Upper bound of receive maximum (message queue size).
+        self._receive_maximum = None
+        # Inbound topic aliases of client connection, if requested.
+        self._topic_aliases = None
+        # Metrics label (not read from database in MQTT network threads).
+        self._metrics_label = None
+        self._client_log_header = None
+        # Connection settings used by client (see `is_connection_changed`).
+        self._client_settings = None
+        self._connect_kwargs = None
+        # Subscriptions sent at connection: (topic ID, filter, QoS) tuples,
+        #  then the ones confirmed by broker, by chunk.
+        self._pending_subscriptions = []
+        self._confirmed_subscriptions = []
+        # Subscriptions acknowledged by broker: (filter, QoS), by topic ID.
+        self._subscriptions = {}
+        # Broker acknowledgements (SUBACK, UNSUBACK), by message ID.
+        self._acks = {}
+        self._acks_condition = threading.Condition()
+        # Connection readiness, from client callbacks.
+        self._client_connect_rc = None
+        self._connack_event = threading.Event()
+        self._disconnect_event = threading.Event()
 
     def _client_create(self):
         # Initialize paho MQTT client.
@@ -97,20 +209,43 @@ class Subscriber(Base, BaseMixin):
         client_kwargs = {
             "protocol": self.broker.protocol_version,
             "transport": self.broker.transport,
+            # Identifies subscriber in message callbacks (metrics).
+            "userdata": self._metrics_label,
         }
         if self._client_id is not None:
             client_kwargs["client_id"] = self._client_id
         if self.broker.protocol_version in (mqttc.MQTTv31, mqttc.MQTTv311,):
             client_kwargs["clean_session"] = not self.use_persistent_session
+        self._topic_aliases = None
+        if (self.topic_alias_maximum
+                and self.broker.protocol_version == mqttc.MQTTv5):
+            if self._on_message is not None:
+                self._topic_aliases = TopicAliases(self.topic_alias_maximum)
+            else:
+                # Topic callbacks would never receive aliased messages.
+                logger.warning(
+                    f"{self._log_header} topic aliases require a message"
+                    " callback: not requested.")
         logger.debug(
             f"{self._log_header} MQTT client parameters: {client_kwargs}")
-        client = mqttc.Client(**client_kwargs)
+        if self.broker.transport == Broker.Transport.loopback.value:
+            client = loopback.LoopbackClient(**client_kwargs)
+        else:
+            client = _Client(**client_kwargs)
         # Set client callbacks.
         client.on_connect = self._on_connect
         client.on_disconnect = self._on_disconnect
         client.on_subscribe = self._on_subscribe
         client.on_unsubscribe = self._on_unsubscribe
         client.on_log = self._on_log
+        if self._topic_aliases is not None:
+            client.on_message = self._on_aliased_message
+        elif self._on_message is not None:
+            client.on_message = self._on_message
+        if self.max_inflight_messages is not None:
+            client.max_inflight_messages_set(self.max_inflight_messages)
+        if self.max_queued_messages is not None:
+            client.max_queued_messages_set(self.max_queued_messages)
         return client
 
     def _client_apply_security(self):
@@ -128,8 +263,7 @@ class Subscriber(Base, BaseMixin):
                 cert_reqs=self.broker.tls_verifymode,
                 tls_version=self.broker.tls_version)
 
-    def _client_connect(self):
-        logger.debug(f"{self._log_header} connecting MQTT client...")
+    def _client_connect_kwargs(self):
         # Set client connection properties.
         cli_conn_kwargs = {
             "host": self.broker.host,
@@ -140,41 +274,157 @@ class Subscriber(Base, BaseMixin):
             cli_conn_kwargs["clean_start"] = not self.use_persistent_session
             conn_props = mqtt_props.Properties(mqtt_props.PacketTypes.CONNECT)
             conn_props.SessionExpiryInterval = self.session_expiry
+            receive_maximum = self.receive_maximum
+            if self._receive_maximum is not None:
+                # Broker is throttled before messages queue is full.
+                receive_maximum = min(
+                    receive_maximum or RECEIVE_MAXIMUM_MAX,
+                    self._receive_maximum)
+            if receive_maximum is not None:
+                conn_props.ReceiveMaximum = receive_maximum
+            if self._topic_aliases is not None:
+                conn_props.TopicAliasMaximum = self.topic_alias_maximum
+            if self.maximum_packet_size is not None:
+                conn_props.MaximumPacketSize = self.maximum_packet_size
             cli_conn_kwargs["properties"] = conn_props
-        # Connect the client.
-        self._client.connect(**cli_conn_kwargs)
-        # TODO: raise or log errors
-
-    def connect(self, client_id=None, *, logger=None):
+        return cli_conn_kwargs
+
+    def _connection_settings(self):
+        return (
+            self.broker.host, self.broker.port, self.broker.protocol_version,
+            self.broker.transport, self.broker.is_auth_required,
+            self.broker.use_tls, self.broker.tls_version,
+            self.broker.tls_verifymode, self.broker.tls_certificate,
+            self.keep_alive, self.use_persistent_session,
+            self.session_expiry, self.username, self.password,
+            self.receive_maximum, self.topic_alias_maximum,
+            self.maximum_packet_size, self.max_inflight_messages,
+            self.max_queued_messages,
+        )
+
+    def connect(self, client_id=None, *, logger=None, on_message=None,
+                network_loop=None, receive_maximum=None,
+                timeout=CONNECTION_TIMEOUT):
         """Instantiate the MQTT client and connect it to its broker.
 
+        Chains `connect_prepare`, `connect_network` and `connect_finish`.
+
         :param str client_id: (optional, default None)
             Client ID to use, especially when using a persistent session.
         :param logging.Logger logger: (optional, default None)
             The logger to use for subscriber MQTT client.
+        :param callable on_message: (optional, default None)
+            Callback receiving all messages, whatever the topic. If None,
+            each topic payload decoder receives its topic messages.
+        :param NetworkLoop network_loop: (optional, default None)
+            Network loop (shared with other subscribers) driving the MQTT
+            client. If None, client runs its own network loop thread.
+        :param int receive_maximum: (optional, default None)
+            Upper bound of subscriber `receive_maximum`: size of the queue
+            `on_message` submits messages to, if any. The broker then stops
+            sending messages while the queue is full (MQTT v5).
+        :param float timeout: (optional, default 30)
+            Time, in seconds, to wait for the broker to accept connection.
+        :returns bool: Whether client is connected.
         :raises ssl.SSLError: When TLS certificate is not valid.
         :raises ssl.SSLCertVerificationError: When TLS certificate expired.
         """
+        self.connect_prepare(
+            client_id, logger=logger, on_message=on_message,
+            network_loop=network_loop, receive_maximum=receive_maximum)
+        is_connected = self.connect_network(timeout)
+        self.connect_finish(is_connected)
+        return is_connected
+
+    def connect_prepare(self, client_id=None, *, logger=None, on_message=None,
+                        network_loop=None, receive_maximum=None):
+        """Instantiate the MQTT client, before connecting it to its broker.
+
+        Reads what the connection needs from database: must be called in
+        the thread owning the database session. See `connect` parameters.
+        """
         self._client_id = client_id
+        self._on_message = on_message
+        self._network_loop = network_loop
+        self._receive_maximum = receive_maximum
+        self._metrics_label = str(self.id)
+        self._client_log_header = None
+        self._client_log_header = self._log_header
+        self._client_settings = self._connection_settings()
         self._client = self._client_create()
         self._client.enable_logger(logger)
         self._client_apply_security()
-        self._client_connect()
-
-        # It is important that subscriptions occurs before starting the
-        #  waiting messages loop in order to receive stored messages for
-        #  a persistent session.
-        self.subscribe_all()
-        # Run a threaded interface to the network loop in the background.
-        #  (messages are received in this loop)
-        self._client.loop_start()
-
-        # TODO: Improve this in case to avoid infinite loop.
-        # Wait for the connection to be effective.
-        while (not self._client.is_connected()):
-            time.sleep(0.1)
-        self.is_connected = True
-        self.timestamp_last_connection = dt.datetime.now(dt.timezone.utc)
+        self._connect_kwargs = self._client_connect_kwargs()
+        self._pending_subscriptions = self._subscriptions_prepare()
+
+    def connect_network(self, timeout=CONNECTION_TIMEOUT):
+        """Connect the MQTT client to its broker and subscribe to topics.
+
+        Does not access database: connections of several subscribers can be
+        opened concurrently, in other threads (see `Service.run`). Waits for
+        the broker to acknowledge connection, at most `timeout` seconds.
+        Client is closed if connection fails.
+
+        :param float timeout: (optional, default 30)
+            Time, in seconds, to wait for the broker to accept connection.
+        :returns bool: Whether client is connected.
+        :raises ssl.SSLError: When TLS handshake fails.
+        """
+        deadline = time.monotonic() + timeout
+        self._connack_event.clear()
+        self._disconnect_event.clear()
+        self._client_connect_rc = None
+        if self._network_loop is not None:
+            # Client socket must be watched as soon as it is opened.
+            self._network_loop.add(self._client, name=self._log_header)
+        try:
+            logger.debug(f"{self._log_header} connecting MQTT client...")
+            with self._acks_condition:
+                self._acks.clear()
+            self._confirmed_subscriptions = []
+            # Broker socket connection (or reconnection) can not exceed
+            #  connection timeout.
+            self._client.connect_timeout = timeout
+            self._client.connect(**self._connect_kwargs)
+            # It is important that subscriptions occurs before starting the
+            #  waiting messages loop in order to receive stored messages for
+            #  a persistent session.
+            chunks = self._client_subscribe(self._pending_subscriptions)
+            if self._network_loop is None:
+                # Run a threaded interface to the network loop in the
+                #  background. (messages are received in this loop)
+                self._client.loop_start()
+        except Exception:
+            self._client_close()
+            raise
+
+        # Connection is effective once broker acknowledged it (event set by
+        #  `_on_connect`, or by `_on_disconnect` if connection is lost).
+        self._connack_event.wait(max(deadline - time.monotonic(), 0))
+        if self._client_connect_rc != 0:
+            logger.error(
+                f"{self._log_header} connection failed"
+                + (" (timeout)" if self._client_connect_rc is None else ""))
+            self._client_close()
+            return False
+        # Topics are subscribed once broker acknowledged them.
+        self._confirmed_subscriptions = self._wait_acks(
+            chunks, max(deadline - time.monotonic(), 0))
+        return True
+
+    def connect_finish(self, is_connected):
+        """Save connection state in database, after `connect_network`.
+
+        :param bool is_connected: Whether client is connected.
+        """
+        if is_connected:
+            self._update_subscriptions(self._confirmed_subscriptions, True)
+            self.is_connected = True
+            self.timestamp_last_connection = dt.datetime.now(dt.timezone.utc)
+        else:
+            self.is_connected = False
+        self._pending_subscriptions = []
+        self._confirmed_subscriptions = []
         self.save()
 
     def _on_connect(
@@ -190,82 +440,321 @@ class Subscriber(Base, BaseMixin):
                 f"{mqttc.connack_string(reason_code)}")
 
         self._client_session_present = bool(flags.get("session present", 0))
+        metrics.SUBSCRIBER_CONNECTED.labels(self._metrics_label).set(
+            int(reason_code == 0))
+        self._client_connect_rc = reason_code
+        if self._topic_aliases is not None:
+            # Aliases are set again by broker at each connection.
+            self._topic_aliases.clear()
+        self._connack_event.set()
 
         # TODO: publish message on subscriber client status topic (->online)?
 
-    def disconnect(self):
-        """Disconnect the MQTT client from its broker."""
+    def disconnect(self, *, timeout=CONNECTION_TIMEOUT):
+        """Disconnect the MQTT client from its broker.
+
+        Chains `disconnect_network` and `disconnect_finish`.
+
+        :param float timeout: (optional, default 30)
+            Time, in seconds, to wait for the disconnection.
+        :returns bool: Whether client disconnected cleanly (else its network
+            loop was stopped anyway).
+        """
+        is_disconnected = self.disconnect_network(timeout)
+        self.disconnect_finish()
+        return is_disconnected
+
+    def disconnect_network(self, timeout=CONNECTION_TIMEOUT):
+        """Disconnect the MQTT client from its broker.
+
+        Does not access database: several subscribers can be disconnected
+        concurrently, in other threads (see `Service.stop`). Waits for the
+        disconnection, at most `timeout` seconds, then stops client network
+        loop anyway.
+
+        :param float timeout: (optional, default 30)
+            Time, in seconds, to wait for the disconnection.
+        :returns bool: Whether client disconnected cleanly.
+        """
+        self._disconnect_event.clear()
+        if self._network_loop is not None:
+            # Do not reconnect client once disconnected.
+            self._network_loop.remove(self._client)
+        is_disconnected = True
+        if self._client.disconnect() == mqttc.MQTT_ERR_SUCCESS:
+            # Wait for the disconnection to be effective.
+            is_disconnected = self._disconnect_event.wait(timeout)
+            if not is_disconnected:
+                logger.error(f"{self._log_header} disconnection timeout")
+        self._client_close()
+        return is_disconnected
+
+    def disconnect_finish(self):
+        """Save disconnection state in database, after `disconnect_network`.
+        """
         # At each disconnection, client subscriptions are lost event when
         #  persistent session is used. Persistent session just means that
         #  broker will keep messages for the subscriber when it reconnects
         #  and re-subscribes to those topics.
         # Update topics' subscription states in database.
-        for topic in self.topics:
-            topic.update_subscription(self.id, False)
-
-        self._client.disconnect()
-        self._client.disable_logger()
-
-        # TODO: Improve this in case to avoid infinite loop.
-        # Wait for the disconnection to be effective.
-        while (self._client.is_connected()):
-            time.sleep(0.1)
+        TopicBySubscriber.update_subscriptions(self.id, None, False)
+        self._subscriptions = {}
+        self._client_settings = None
         self.is_connected = False
         self.save()
 
+    def _client_close(self):
+        # Stop driving client, whatever its connection state.
+        if self._network_loop is not None:
+            self._network_loop.remove(self._client)
+        self._client.disconnect()
+        self._client.disable_logger()
         # Kill the network loop that receives messages.
-        self._client.loop_stop()
+        if self._network_loop is None:
+            self._client.loop_stop()
+        self._network_loop = None
 
     def _on_disconnect(self, client, userdata, reasonCode, properties=None):
+        metrics.SUBSCRIBER_CONNECTED.labels(self._metrics_label).set(0)
         if reasonCode != 0:
+            metrics.SUBSCRIBER_DISCONNECTIONS.labels(
+                self._metrics_label).inc()
             logger.error(
                 f"{self._log_header} disconnection error reason: "
                 f"{mqttc.connack_string(reasonCode)}")
+        self._disconnect_event.set()
+        # Stop waiting for a connection acknowledgement that will not come.
+        self._connack_event.set()
 
         # TODO: publish message on subscriber client status topic (->offline)?
 
-    def subscribe(self, topic):
+    def _subscription_names(self, topics):
+        # Get topic filters: (topic ID, filter, QoS) tuples. Filters are
+        #  prefixed if topic subscription is shared.
+        share_groups = TopicBySubscriber.get_share_groups(self.id)
+        return [
+            (
+                topic.id,
+                shared_topic_name(
+                    topic.name, share_groups.get(topic.id, self.share_group)),
+                topic.qos,
+            )
+            for topic in topics
+        ]
+
+    def _subscriptions_prepare(self, topics=None):
+        # Get subscriptions from database, register message callbacks.
+        if topics is None:
+            topics = self.topics
+            logger.info(f"{self._log_header} subscribing to all topics"
+                        f" ({len(topics)})...")
+        if self._on_message is None:
+            for topic in topics:
+                # Messages of shared subscriptions are received from real
+                #  topic.
+                self._client.message_callback_add(
+                    topic.name, topic.payload_decoder_instance.on_message)
+        return self._subscription_names(topics)
+
+    def _client_subscribe(self, subscriptions, *, unsubscribe=False):
+        # Send subscriptions (or unsubscriptions) by chunks, one packet each.
+        #  Returns (message ID, subscriptions) of chunks sent.
+        chunks = []
+        for idx in range(0, len(subscriptions), SUBSCRIPTIONS_CHUNK_SIZE):
+            chunk = subscriptions[idx:idx + SUBSCRIPTIONS_CHUNK_SIZE]
+            if unsubscribe:
+                rc, mid = self._client.unsubscribe([x[1] for x in chunk])
+            else:
+                rc, mid = self._client.subscribe([x[1:] for x in chunk])
+            if rc != mqttc.MQTT_ERR_SUCCESS:
+                logger.error(
+                    f"{self._log_header} {len(chunk)} topics"
+                    f" {'unsubscription' if unsubscribe else 'subscription'}"
+                    f" failed: {mqttc.error_string(rc)}")
+                continue
+            chunks.append((mid, chunk))
+        return chunks
+
+    def _ack(self, mid, reason_codes):
+        # Called in MQTT network threads.
+        with self._acks_condition:
+            self._acks[mid] = reason_codes
+            self._acks_condition.notify_all()
+
+    def _wait_acks(self, chunks, timeout):
+        # Wait for broker acknowledgements of chunks, at most timeout
+        #  seconds. Returns subscriptions accepted by broker, by chunk.
+        with self._acks_condition:
+            self._acks_condition.wait_for(
+                lambda: all(mid in self._acks for mid, _ in chunks), timeout)
+            acks = [self._acks.pop(mid, None) for mid, _ in chunks]
+        confirmed = []
+        for (_, chunk), reason_codes in zip(chunks, acks):
+            if reason_codes is None:
+                logger.error(
+                    f"{self._log_header} {len(chunk)} topics not"
+                    " acknowledged by broker (timeout)")
+                continue
+            if len(reason_codes) > 0:
+                # Failure reason codes are 0x80 or more.
+                chunk = [
+                    subscription
+                    for subscription, reason_code in zip(chunk, reason_codes)
+                    if reason_code < 0x80
+                ]
+                if len(chunk) < len(reason_codes):
+                    logger.error(
+                        f"{self._log_header}"
+                        f" {len(reason_codes) - len(chunk)} topics"
+                        " refused by broker")
+            confirmed.append(chunk)
+        return confirmed
+
+    def _update_subscriptions(self, confirmed, is_subscribed):
+        # One UPDATE by chunk, one commit. Returns the number of topics
+        #  confirmed (topics removed meanwhile have no status to update).
+        nb_confirmed = 0
+        for chunk in confirmed:
+            TopicBySubscriber.update_subscriptions(
+                self.id, [x[0] for x in chunk], is_subscribed, commit=False)
+            for topic_id, topic_filter, qos in chunk:
+                if is_subscribed:
+                    self._subscriptions[topic_id] = (topic_filter, qos)
+                else:
+                    self._subscriptions.pop(topic_id, None)
+            nb_confirmed += len(chunk)
+        db.session.commit()
+        return nb_confirmed
+
+    def subscribe(self, topic, *, timeout=CONNECTION_TIMEOUT):
         """Make the MQTT client subscribe to the defined topic.
 
         :param Topic topic: Topic instance to subscribe to.
+        :param float timeout: (optional, default 30)
+            Time, in seconds, to wait for the broker to acknowledge
+            subscription.
+        :returns bool: Whether topic has been subscribed.
         """
-        self._client.message_callback_add(
-            topic.name, topic.payload_decoder_instance.on_message)
-        self._client.subscribe(topic.name, topic.qos)
-        topic.update_subscription(self.id, True)
-
-    def subscribe_all(self):
-        """Automatically make the MQTT client subscribe to all its topics."""
-        logger.info(f"{self._log_header} subscribing to all topics"
-                    f" ({len(self.topics)})...")
-        for topic in self.topics:
-            self.subscribe(topic)
+        chunks = self._client_subscribe(self._subscriptions_prepare([topic]))
+        return self._update_subscriptions(
+            self._wait_acks(chunks, timeout), True) > 0
+
+    def subscribe_all(self, *, timeout=CONNECTION_TIMEOUT):
+        """Automatically make the MQTT client subscribe to all its topics.
+
+        Topics are subscribed by chunks, in multi-topic SUBSCRIBE packets.
+        Topics subscription status is updated once broker acknowledged them,
+        with one database UPDATE by chunk.
+
+        :param float timeout: (optional, default 30)
+            Time, in seconds, to wait for the broker to acknowledge
+            subscriptions.
+        :returns int: Number of topics subscribed.
+        """
+        chunks = self._client_subscribe(self._subscriptions_prepare())
+        return self._update_subscriptions(
+            self._wait_acks(chunks, timeout), True)
 
     def _on_subscribe(
             self, client, userdata, mid, granted_qos, properties=None):
-        pass
-
-    def unsubscribe(self, topic):
+        metrics.SUBSCRIPTIONS.labels(self._metrics_label).inc()
+        # Granted QoS or failure, by topic filter.
+        #  /!\ MQTTv5 gives reason codes.
+        self._ack(mid, [
+            x.value if isinstance(x, mqttc.ReasonCodes) else x
+            for x in granted_qos
+        ])
+
+    def unsubscribe(self, topic, *, timeout=CONNECTION_TIMEOUT):
         """Make the MQTT client unsubscribe from the defined topic.
 
         :param Topic topic: Topic instance to unsubscribe from.
+        :param float timeout: (optional, default 30)
+            Time, in seconds, to wait for the broker to acknowledge
+            unsubscription.
+        :returns bool: Whether topic has been unsubscribed.
         """
-        self._client.unsubscribe(topic.name)
-        topic.update_subscription(self.id, False)
+        chunks = self._client_subscribe(
+            self._subscription_names([topic]), unsubscribe=True)
+        return self._update_subscriptions(
+            self._wait_acks(chunks, timeout), False) > 0
 
-    def unsubscribe_all(self):
+    def unsubscribe_all(self, *, timeout=CONNECTION_TIMEOUT):
         """Automatically make the MQTT client unsubscribe from all its topics.
+
+        As `subscribe_all`, by chunks of topics.
+
+        :param float timeout: (optional, default 30)
+            Time, in seconds, to wait for the broker to acknowledge
+            unsubscriptions.
+        :returns int: Number of topics unsubscribed.
         """
         logger.info(f"{self._log_header} unsubscribing from all topics"
                     f" ({len(self.topics)})...")
-        for topic in self.topics:
-            self.unsubscribe(topic)
-
-    def _on_unsubscribe(self, client, userdata, mid, properties, reasonCode):
-        pass
+        chunks = self._client_subscribe(
+            self._subscription_names(self.topics), unsubscribe=True)
+        return self._update_subscriptions(
+            self._wait_acks(chunks, timeout), False)
+
+    def sync_subscriptions(self, *, timeout=CONNECTION_TIMEOUT):
+        """Apply changes of subscriber topics to client subscriptions.
+
+        Unsubscribes from topics removed (or renamed...) since subscribed,
+        subscribes to topics added (or whose QoS or share group changed).
+        Other subscriptions are left as is: their messages keep flowing.
+
+        :param float timeout: (optional, default 30)
+            Time, in seconds, to wait for the broker to acknowledge
+            subscription changes.
+        :returns tuple: Numbers of topics subscribed and unsubscribed.
+        """
+        wanted = {x[0]: x for x in self._subscription_names(self.topics)}
+        unsubscriptions = [
+            (topic_id, *subscription)
+            for topic_id, subscription in self._subscriptions.items()
+            if topic_id not in wanted or wanted[topic_id][1] != subscription[0]
+        ]
+        chunks = self._client_subscribe(unsubscriptions, unsubscribe=True)
+        nb_unsubscribed = self._update_subscriptions(
+            self._wait_acks(chunks, timeout), False)
+        topics = [
+            x for x in self.topics
+            if self._subscriptions.get(x.id) != wanted[x.id][1:]]
+        nb_subscribed = 0
+        if len(topics) > 0:
+            chunks = self._client_subscribe(
+                self._subscriptions_prepare(topics))
+            nb_subscribed = self._update_subscriptions(
+                self._wait_acks(chunks, timeout), True)
+        if nb_subscribed > 0 or nb_unsubscribed > 0:
+            logger.info(
+                f"{self._log_header} {nb_subscribed} topics subscribed,"
+                f" {nb_unsubscribed} unsubscribed")
+        return nb_subscribed, nb_unsubscribed
+
+    def _on_unsubscribe(
+            self, client, userdata, mid, properties=None, reasonCodes=None):
+        # MQTTv3 gives no reason codes: all topic filters are unsubscribed.
+        if reasonCodes is None:
+            reasonCodes = []
+        elif isinstance(reasonCodes, mqttc.ReasonCodes):
+            # paho gives a single reason code for a single topic filter.
+            reasonCodes = [reasonCodes]
+        self._ack(mid, [x.value for x in reasonCodes])
+
+    def _on_aliased_message(self, client, userdata, msg):
+        # Give messages their topic name back before routing them.
+        if self._topic_aliases.resolve(msg) is None:
+            logger.warning(
+                f"{self._log_header} message dropped: unknown topic alias")
+            return
+        self._on_message(client, userdata, msg)
 
     def _on_log(self, client, userdata, level, buf):
-        pass
+        # Only warnings and errors are counted: called for each packet.
+        if level in _CLIENT_LOG_LEVELS:
+            metrics.CLIENT_LOG_MESSAGES.labels(
+                self._metrics_label, _CLIENT_LOG_LEVELS[level]).inc()
 
     def _verify_consistency(self):
         broker = Broker.get_by_id(self.broker_id)
@@ -276,16 +765,62 @@ class Subscriber(Base, BaseMixin):
             logger.warning(
                 f"{self._log_header} authentication data (username...)"
                 " is useless as broker do not require it.")
+        verify_share_group(self.share_group)
+        if (self.share_group is not None
+                and broker.protocol_version != mqttc.MQTTv5):
+            logger.warning(
+                f"{self._log_header} shared subscriptions are defined in"
+                " MQTT v5, broker may not support them.")
+        if self.receive_maximum is not None and not (
+                0 < self.receive_maximum <= RECEIVE_MAXIMUM_MAX):
+            raise ValueError("Invalid subscriber receive maximum!")
+        if self.topic_alias_maximum is not None and not (
+                0 <= self.topic_alias_maximum <= TOPIC_ALIAS_MAXIMUM_MAX):
+            raise ValueError("Invalid subscriber topic alias maximum!")
+        if self.maximum_packet_size is not None and not (
+                0 < self.maximum_packet_size <= MAXIMUM_PACKET_SIZE_MAX):
+            raise ValueError("Invalid subscriber maximum packet size!")
+        if (self.max_inflight_messages is not None
+                and self.max_inflight_messages < 0):
+            raise ValueError("Invalid subscriber max inflight messages!")
+        if (self.max_queued_messages is not None
+                and self.max_queued_messages < 0):
+            raise ValueError("Invalid subscriber max queued messages!")
+        if broker.protocol_version != mqttc.MQTTv5 and any(
+                x is not None for x in (
+                    self.receive_maximum, self.topic_alias_maximum,
+                    self.maximum_packet_size)):
+            logger.warning(
+                f"{self._log_header} flow control properties (receive"
+                " maximum...) are defined in MQTT v5, they are ignored.")
 
     @classmethod
-    def get_list(cls, is_enabled=None):
+    def get_list(cls, is_enabled=None, *, load_topology=False):
         """List all subscribers stored in database.
 
         :param bool is_enabled: (optional, default None)
             Filter subscribers on `is_enabled` field value. Ignored if `None`.
+        :param bool load_topology: (optional, default False)
+            If True, also load what the service needs at startup: brokers,
+            topics, their payload decoders, links (and device links) and
+            payload fields. This takes a constant number of queries (one by
+            relationship level, see `sqlalchemy.orm.subqueryload`) instead of
+            a few queries by topic. Subscribers already loaded are refreshed
+            (topology reload).
         :returns list: The list of subscribers found.
         """
         stmt = sqla.select(cls)
+        if load_topology:
+            # Select-in loading would issue a query by 500 topics.
+            topics = sqla.orm.subqueryload(cls.topics)
+            stmt = stmt.execution_options(populate_existing=True).options(
+                sqla.orm.joinedload(cls.broker),
+                topics.joinedload(Topic.payload_decoder),
+                topics.subqueryload(Topic.links).joinedload(
+                    TopicLink.payload_field),
+                topics.subqueryload(Topic.device_links).joinedload(
+                    TopicDeviceLink.payload_field),
+            )
         if is_enabled is not None:
             stmt = stmt.filter(cls.is_enabled == is_enabled)
         stmt = stmt.order_by(cls.id)
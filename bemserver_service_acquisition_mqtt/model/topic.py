@@ -1,16 +1,78 @@
 """MQTT topic"""
 
+import enum
 import logging
 import datetime as dt
 import sqlalchemy as sqla
 
 from bemserver_core.database import Base, BaseMixin, db
-from bemserver_service_acquisition_mqtt import decoders, SERVICE_LOGNAME
+from bemserver_service_acquisition_mqtt import (
+    decoders, ingestion, SERVICE_LOGNAME)
 
 
 logger = logging.getLogger(SERVICE_LOGNAME)
 
 
+# Shared subscriptions (MQTT v5): messages of a topic subscribed by several
+#  clients in the same share group are load-balanced between them.
+SHARED_SUBSCRIPTION_PREFIX = "$share"
+
+
+def verify_share_group(share_group):
+    """Check a share group name.
+
+    :param str share_group: Share group name, or None (not shared).
+    :raises ValueError: When share group name is not valid.
+    """
+    if share_group is None:
+        return
+    if share_group == "" or any(x in share_group for x in ("/", "+", "#",)):
+        raise ValueError("Invalid share group name!")
+
+
+def is_wildcard_topic(topic_name):
+    """Whether a topic name holds wildcards ("+" or "#" levels).
+
+    :param str topic_name: Name of topic (for example: "sensors/+/temp").
+    :returns bool:
+    """
+    return any(x in ("+", "#",) for x in topic_name.split("/"))
+
+
+def verify_topic_name(topic_name, device_segment=None):
+    """Check a topic name, that can hold wildcards: "+" for a whole level,
+    "#" for the whole last level.
+
+    :param str topic_name: Name of topic (for example: "sensors/+/temp").
+    :param int device_segment: (optional, default None)
+        Level identifying a device, which must be a "+" level.
+    :raises ValueError: When topic name or device segment is not valid.
+    """
+    levels = topic_name.split("/")
+    for idx, level in enumerate(levels):
+        if level == "#" and idx < len(levels) - 1:
+            raise ValueError("Invalid topic wildcard!")
+        if level not in ("+", "#",) and ("+" in level or "#" in level):
+            raise ValueError("Invalid topic wildcard!")
+    if device_segment is not None and (
+            not 0 <= device_segment < len(levels)
+            or levels[device_segment] != "+"):
+        raise ValueError("Invalid topic device segment!")
+
+
+def shared_topic_name(topic_name, share_group):
+    """Get the topic filter to subscribe to a topic in a share group.
+
+    :param str topic_name: Name of topic (for example: "sensors/temp/1").
+    :param str share_group: Share group name, or None.
+    :returns str: "$share/<share_group>/<topic_name>" or topic name if no
+        share group.
+    """
+    if share_group is None:
+        return topic_name
+    return f"{SHARED_SUBSCRIPTION_PREFIX}/{share_group}/{topic_name}"
+
+
 class TopicByBroker(Base, BaseMixin):
     """Describes the association between Topic and Broker.
 
@@ -51,6 +113,9 @@ class TopicBySubscriber(Base, BaseMixin):
         This allows to known the last topic subscription timestamp.
     :param bool is_enabled: (optional, default True)
         Active/deactivate the link between topic and subscriber.
+    :param str share_group: (optional, default None)
+        Name of the share group used to subscribe to topic (shared
+        subscription). Overrides subscriber's share group if not None.
     """
     __tablename__ = "mqtt_topic_by_subscriber"
     __table_args__ = (
@@ -68,6 +133,7 @@ class TopicBySubscriber(Base, BaseMixin):
         nullable=False,
     )
     is_enabled = sqla.Column(sqla.Boolean, nullable=False, default=True)
+    share_group = sqla.Column(sqla.String(250))
 
     # TODO: see if an overrided qos will be needed here or not
     # qos = sqla.Column(sqla.Integer, nullable=False, default=1)
@@ -91,6 +157,58 @@ class TopicBySubscriber(Base, BaseMixin):
             f"[Topic {self.topic.name}] status updated to "
             f"{'subscribed' if is_subscribed else 'unsubscribed'}")
 
+    @classmethod
+    def update_subscriptions(
+            cls, subscriber_id, topic_ids, is_subscribed, *, commit=True):
+        """Update subscription status of topics for a subscriber, in one
+        UPDATE statement.
+
+        :param int subscriber_id: Unique subscriber ID.
+        :param list topic_ids: Unique IDs of subscribed/unsubscribed topics.
+            If None, all topics of subscriber.
+        :param bool is_subscribed: Whether topics have been subscribed or not.
+        :param bool commit: (optional, default True)
+            Whether to commit the update. Each commit expires objects loaded
+            in session: commit once after many updates.
+        :returns int: Number of topics updated.
+        """
+        if topic_ids is not None and len(topic_ids) <= 0:
+            return 0
+        values = {"is_subscribed": is_subscribed}
+        if is_subscribed:
+            # Only update this field value at subscription time.
+            values["timestamp_last_subscription"] = dt.datetime.now(
+                dt.timezone.utc)
+        stmt = sqla.update(cls).where(cls.subscriber_id == subscriber_id)
+        if topic_ids is not None:
+            stmt = stmt.where(cls.topic_id.in_(topic_ids))
+        # Objects in session are refreshed after commit.
+        stmt = stmt.values(**values).execution_options(
+            synchronize_session=False)
+        nb_updated = db.session.execute(stmt).rowcount
+        if commit:
+            db.session.commit()
+        logger.info(
+            f"[Subscriber #{subscriber_id}] {nb_updated} topics status"
+            f" updated to {'subscribed' if is_subscribed else 'unsubscribed'}")
+        return nb_updated
+
+    @classmethod
+    def get_share_groups(cls, subscriber_id):
+        """Get share groups of topics subscribed by a subscriber.
+
+        :param int subscriber_id: Unique subscriber ID.
+        :returns dict: Share group, by topic ID (topics without share group
+            are not in result).
+        """
+        stmt = sqla.select(cls.topic_id, cls.share_group).filter(
+            cls.subscriber_id == subscriber_id,
+            cls.share_group.isnot(None))
+        return dict(db.session.execute(stmt).all())
+
+    def _verify_consistency(self):
+        verify_share_group(self.share_group)
+
 
 class TopicLink(Base, BaseMixin):
     """Describers the links between topic, payload fields and timeseries.
@@ -147,10 +265,60 @@ class TopicLink(Base, BaseMixin):
             return None
 
 
+class TopicDeviceLink(Base, BaseMixin):
+    """Describes the links between the devices of a wildcard topic, payload
+    fields and timeseries.
+
+    A device is identified by the level of topic name at topic
+    `device_segment` (for example the devEUI, in "application/+/device/+/rx"
+    with device segment 3).
+
+    :param int topic_id: Relation to a (wildcard) topic unique ID.
+    :param str device: Device, as in topic name.
+    :param int payload_field_id: Relation to a payload field unique ID.
+    :param int timeseries_id: Relation to a timeseries unique ID.
+    """
+    __tablename__ = "mqtt_topic_device_link"
+    __table_args__ = (
+        sqla.PrimaryKeyConstraint("topic_id", "device", "payload_field_id"),
+        sqla.UniqueConstraint("topic_id", "device", "timeseries_id"),
+    )
+
+    topic_id = sqla.Column(
+        sqla.Integer,
+        sqla.ForeignKey("mqtt_topic.id", ondelete="CASCADE"),
+        nullable=False,
+    )
+    device = sqla.Column(sqla.String(250), nullable=False)
+    payload_field_id = sqla.Column(
+        sqla.Integer,
+        sqla.ForeignKey("mqtt_payload_field.id", ondelete="CASCADE"),
+        nullable=False,
+    )
+    timeseries_id = sqla.Column(
+        sqla.Integer,
+        sqla.ForeignKey("timeseries.id"),
+        nullable=False,
+    )
+
+    topic = sqla.orm.relationship("Topic", back_populates="device_links")
+    payload_field = sqla.orm.relationship(
+        "PayloadField", back_populates="topic_device_links")
+    timeseries = sqla.orm.relationship("Timeseries", backref=__tablename__)
+
+    def _verify_consistency(self):
+        if self.device is not None and (
+                self.device == "" or any(x in self.device for x in "/+#")):
+            raise ValueError("Invalid topic device!")
+
+
 class Topic(Base, BaseMixin):
     """Describes how topics should be subscribed and how payload is decoded.
 
     :param str name: Topic name (for example: "sensors/temperature/1").
+        Wildcards are allowed ("+" for a level, "#" for the last levels):
+        messages of all matching topics are then decoded and linked the same
+        way, or by device (see `device_segment`).
     :param int qos: (default 1)
         Level of Quality of Service (QoS) used for this topic.
     :param str description: (optional, default None)
@@ -158,9 +326,20 @@ class Topic(Base, BaseMixin):
     :param int payload_decoder_id: Relation to a payload decoder unique ID.
     :param bool is_enabled: (optional, default True)
         Active/deactivate the topic.
+    :param str on_conflict: (default "nothing")
+        What to do when a received value is already in database (same
+        timestamp): "nothing" skips it, "update" overwrites stored value.
+    :param int device_segment: (optional, default None)
+        Level of a wildcard topic name ("+" level, from 0) identifying a
+        device: messages of each device are linked to their own timeseries
+        (see `TopicDeviceLink`) instead of topic links.
     """
     __tablename__ = "mqtt_topic"
 
+    class OnConflict(enum.Enum):
+        nothing = ingestion.ON_CONFLICT_DO_NOTHING
+        update = ingestion.ON_CONFLICT_DO_UPDATE
+
     id = sqla.Column(sqla.Integer, primary_key=True)
     name = sqla.Column(sqla.String(250), unique=True, nullable=False)
     qos = sqla.Column(sqla.Integer, nullable=False, default=1)
@@ -171,12 +350,18 @@ class Topic(Base, BaseMixin):
         nullable=False,
     )
     is_enabled = sqla.Column(sqla.Boolean, nullable=False, default=True)
+    on_conflict = sqla.Column(
+        sqla.String, nullable=False, default=OnConflict.nothing.value)
+    device_segment = sqla.Column(sqla.Integer)
 
     payload_decoder = sqla.orm.relationship(
         "PayloadDecoder", back_populates="topics")
     links = sqla.orm.relationship(
         "TopicLink", back_populates="topic", cascade="all,delete",
         passive_deletes=True)
+    device_links = sqla.orm.relationship(
+        "TopicDeviceLink", back_populates="topic", cascade="all,delete",
+        passive_deletes=True)
 
     brokers = sqla.orm.relationship(
         "Broker", secondary=TopicByBroker.__tablename__,
@@ -185,16 +370,25 @@ class Topic(Base, BaseMixin):
         "Subscriber", secondary=TopicBySubscriber.__tablename__,
         back_populates="topics", cascade="all,delete", passive_deletes=True)
 
+    @property
+    def is_wildcard(self):
+        return is_wildcard_topic(self.name)
+
     @property
     def payload_decoder_cls(self):
-        if self._payload_decoder_cls is None:
+        # Payload decoder can change when topic is refreshed (reload).
+        decoder_name = self.payload_decoder.name
+        if (self._payload_decoder_cls is None
+                or self._payload_decoder_cls.name != decoder_name):
             self._payload_decoder_cls = decoders.get_payload_decoder_cls(
-                self.payload_decoder.name)
+                decoder_name)
         return self._payload_decoder_cls
 
     @property
     def payload_decoder_instance(self):
-        if self._payload_decoder_instance is None:
+        if (self._payload_decoder_instance is None
+                or type(self._payload_decoder_instance)
+                is not self.payload_decoder_cls):
             self._payload_decoder_instance = self.payload_decoder_cls(self)
         return self._payload_decoder_instance
 
@@ -234,6 +428,33 @@ class Topic(Base, BaseMixin):
         if topic_link in self.links:
             topic_link.delete()
 
+    def add_device_link(self, device, payload_field_id, timeseries_id):
+        """Add a device/payload field/timeseries link to this wildcard topic.
+
+        :param str device: Device, as in topic name (see `device_segment`).
+        :param int payload_field_id:
+            Unique field ID from the payload decoder used for this topic.
+        :param int timeseries_id: Unique ID of a timeseries to link with.
+        :raises sqla.exc.IntegrityError: When link integrity is broken.
+        """
+        topic_device_link = TopicDeviceLink(
+            topic_id=self.id, device=device,
+            payload_field_id=payload_field_id, timeseries_id=timeseries_id)
+        topic_device_link.save()
+        return topic_device_link
+
+    def remove_device_link(self, device, payload_field_id):
+        """Remove a device/payload field link from this wildcard topic.
+
+        :param str device: Device, as in topic name.
+        :param int payload_field_id:
+            Unique field ID from the payload decoder used for this topic.
+        """
+        topic_device_link = TopicDeviceLink.get_by_id(
+            (self.id, device, payload_field_id,))
+        if topic_device_link is not None:
+            topic_device_link.delete()
+
     def add_broker(self, broker_id):
         topic_by_broker = TopicByBroker(topic_id=self.id, broker_id=broker_id)
         topic_by_broker.save()
@@ -260,10 +481,19 @@ class Topic(Base, BaseMixin):
         if self.qos and self.qos not in (0, 1, 2,):
             raise ValueError("Invalid QoS level!")
 
+        if self.name is not None:
+            verify_topic_name(self.name, self.device_segment)
+
+        if self.on_conflict and self.on_conflict not in tuple(
+                x.value for x in Topic.OnConflict):
+            raise ValueError("Invalid topic on conflict action!")
+
     def _make_transient(self):
         super()._make_transient()
         for link in self.links:
             sqla.orm.make_transient(link)
+        for link in self.device_links:
+            sqla.orm.make_transient(link)
 
     def update_subscription(self, subscriber_id, is_subscribed):
         """Update topic subscription status.
@@ -0,0 +1,325 @@
+"""MQTT messages routing
+
+The routing table is compiled once from the topics (database) and then only
+read when processing messages: it maps each topic name to its payload
+decoder and the timeseries to which decoded values are written.
+
+Wildcard topics (for example "application/+/device/+/rx") are matched with a
+topic trie, in a time proportional to the number of topic levels, whatever
+the number of topics. A wildcard topic can route the messages of each device
+(topic level captured by `Topic.device_segment`) to its own timeseries.
+
+With MQTT v5 topic aliases, brokers send a topic name once by connection,
+then a number standing for it: `TopicAliases` gives messages their topic name
+back before routing.
+"""
+
+import collections
+import itertools
+import types
+
+
+# Payload field name, to timeseries ID.
+RouteLink = collections.namedtuple(
+    "RouteLink", ("field_name", "timeseries_id"))
+
+# Compiled payload decoder (see `PayloadDecoderBase.compile`) and its links.
+Route = collections.namedtuple("Route", ("decoder", "links"))
+
+
+def _links(links):
+    return tuple(
+        RouteLink(x.payload_field.name, x.timeseries_id) for x in links)
+
+
+def _compile_route(topic, links, previous, *, buffer, timestamp_cache):
+    # Compile the route of a topic (or of a device of a wildcard topic).
+    #  Previous route is kept if it is still up to date.
+    if (previous is not None
+            and type(previous.decoder) is topic.payload_decoder_cls
+            and previous.decoder._on_conflict == topic.on_conflict
+            and previous.links == links):
+        return previous
+    decoder = topic.payload_decoder_cls(
+        topic, buffer=buffer, timestamp_cache=timestamp_cache)
+    decoder.compile(links)
+    return Route(decoder, decoder.links)
+
+
+class WildcardRoute:
+    """Routes of the topics matching a wildcard topic.
+
+    :param Route route: Route of all matching topics (no device segment).
+    :param int device_segment: Topic level identifying a device, or None.
+    :param dict devices: Routes, by device (if device segment).
+    """
+
+    __slots__ = ("route", "device_segment", "devices")
+
+    def __init__(self, route=None, device_segment=None, devices=None):
+        self.route = route
+        self.device_segment = device_segment
+        self.devices = types.MappingProxyType(dict(devices or {}))
+
+    def __iter__(self):
+        if self.route is not None:
+            yield self.route
+        yield from self.devices.values()
+
+    def get(self, levels):
+        """Get the route of a topic matching the wildcard topic.
+
+        :param list levels: Levels of the topic name.
+        :returns Route: The route found (None for an unknown device).
+        """
+        if self.device_segment is None:
+            return self.route
+        return self.devices.get(levels[self.device_segment])
+
+
+class _TrieNode:
+
+    __slots__ = ("children", "value")
+
+    def __init__(self):
+        self.children = {}
+        self.value = None
+
+
+def _match(node, levels, idx, is_system):
+    # Most specific filter first: exact level, then "+", then "#".
+    if idx == len(levels):
+        if node.value is not None:
+            return node.value
+        # "a/#" also matches "a".
+        child = node.children.get("#")
+        return None if child is None else child.value
+    child = node.children.get(levels[idx])
+    if child is not None:
+        value = _match(child, levels, idx + 1, False)
+        if value is not None:
+            return value
+    if is_system:
+        return None
+    child = node.children.get("+")
+    if child is not None:
+        value = _match(child, levels, idx + 1, False)
+        if value is not None:
+            return value
+    child = node.children.get("#")
+    return None if child is None else child.value
+
+
+class TopicTrie:
+    """Topic filters ("+" and "#" wildcards allowed) to values.
+
+    Matching a topic name walks the trie level by level: it does not depend
+    on the number of filters.
+    """
+
+    __slots__ = ("_root", "_filters")
+
+    def __init__(self):
+        self._root = _TrieNode()
+        self._filters = {}
+
+    def __len__(self):
+        return len(self._filters)
+
+    def __contains__(self, topic_filter):
+        return topic_filter in self._filters
+
+    def __iter__(self):
+        return iter(self._filters)
+
+    def get(self, topic_filter):
+        """Get the value of a topic filter (no matching).
+
+        :param str topic_filter: Topic filter, as inserted.
+        :returns: The value found or None.
+        """
+        return self._filters.get(topic_filter)
+
+    def insert(self, topic_filter, value):
+        """Set the value of a topic filter.
+
+        :param str topic_filter: Topic filter (for example "sensors/+/temp").
+        :param value: Value returned when a topic name matches filter (not
+            None).
+        """
+        node = self._root
+        for level in topic_filter.split("/"):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = _TrieNode()
+            node = child
+        node.value = value
+        self._filters[topic_filter] = value
+
+    def match(self, topic_name):
+        """Get the value of the most specific filter matching a topic name.
+
+        :param str topic_name: Topic name (no wildcards).
+        :returns: The value found or None.
+        """
+        return self.match_levels(topic_name.split("/"))
+
+    def match_levels(self, levels):
+        """As `match`, from the levels of a topic name."""
+        # Topics starting with "$" are not matched by first level wildcards.
+        return _match(self._root, levels, 0, levels[0].startswith("$"))
+
+
+class TopicAliases:
+    """Inbound topic aliases of a client connection (MQTT v5).
+
+    Broker sets an alias with a message holding both a topic name and an
+    alias, then sends the alias only (empty topic name). Aliases are lost
+    when client connects again: `clear` must be called at each connection.
+
+    :param int maximum: Highest alias accepted (client `TopicAliasMaximum`).
+    """
+
+    __slots__ = ("_maximum", "_topics")
+
+    def __init__(self, maximum):
+        self._maximum = maximum
+        self._topics = {}
+
+    def __len__(self):
+        return len(self._topics)
+
+    def clear(self):
+        """Forget all aliases (new connection)."""
+        self._topics.clear()
+
+    def resolve(self, msg):
+        """Set (or read) the alias of a message, and its topic name.
+
+        :param MQTTMessage msg: Message received (topic name is set in place
+            when message holds an alias only).
+        :returns str: The topic name, None if alias is unknown or invalid.
+        """
+        alias = getattr(getattr(msg, "properties", None), "TopicAlias", None)
+        topic_name = msg.topic
+        if alias is None:
+            return topic_name
+        if not 0 < alias <= self._maximum:
+            return None
+        if topic_name:
+            self._topics[alias] = topic_name
+            return topic_name
+        topic_name = self._topics.get(alias)
+        if topic_name is not None:
+            msg.topic = topic_name.encode()
+        return topic_name
+
+
+class RoutingTable:
+    """Immutable mapping of topic names to routes.
+
+    A new table must be compiled when topology (topics, links...) changes.
+
+    :param dict routes: Routes, by topic name.
+    :param TopicTrie wildcards: (optional, default None)
+        Routes of wildcard topics (see `WildcardRoute`), by topic filter.
+    """
+
+    __slots__ = ("_routes", "_wildcards")
+
+    def __init__(self, routes=None, wildcards=None):
+        self._routes = types.MappingProxyType(dict(routes or {}))
+        self._wildcards = wildcards if wildcards is not None else TopicTrie()
+
+    def __len__(self):
+        return len(self._routes) + len(self._wildcards)
+
+    def __contains__(self, topic_name):
+        return topic_name in self._routes or topic_name in self._wildcards
+
+    def __iter__(self):
+        return itertools.chain(self._routes, self._wildcards)
+
+    def get(self, topic_name):
+        """Get the route of a topic.
+
+        Topic name is looked up in topics first, then matched against
+        wildcard topics.
+
+        :param str topic_name: Name of the topic a message is received from.
+        :returns Route: The route found or None.
+        """
+        route = self._routes.get(topic_name)
+        if route is None and self._wildcards:
+            levels = topic_name.split("/")
+            wildcard_route = self._wildcards.match_levels(levels)
+            if wildcard_route is not None:
+                route = wildcard_route.get(levels)
+        return route
+
+    def iter_routes(self):
+        """Iterate over all routes (wildcard topics: route of each device).
+        """
+        yield from self._routes.values()
+        for topic_filter in self._wildcards:
+            yield from self._wildcards.get(topic_filter)
+
+    @classmethod
+    def compile(cls, topics, *, buffer=None, timestamp_cache=None,
+                previous=None):
+        """Compile a routing table from topics.
+
+        Topics, links and payload fields are read from database here, once.
+
+        When a previous table is given (topology reload), the route of a
+        topic (or of a device) whose payload decoder, conflict strategy and
+        links did not change is kept as is (same decoder instance).
+
+        :param list topics: Topics to route.
+        :param TimeseriesDataBuffer buffer: (optional, default None)
+            Buffer used by payload decoders to write values in database.
+        :param TimeseriesLastTimestampCache timestamp_cache:
+            (optional, default None)
+            Cache used by payload decoders to drop values already in
+            database.
+        :param RoutingTable previous: (optional, default None)
+            Routing table to reuse unchanged routes from.
+        :returns RoutingTable: The compiled routing table.
+        """
+        kwargs = {"buffer": buffer, "timestamp_cache": timestamp_cache}
+        routes = {}
+        wildcards = TopicTrie()
+        for topic in topics:
+            if topic.name in routes or topic.name in wildcards:
+                continue
+            if not topic.is_wildcard:
+                routes[topic.name] = _compile_route(
+                    topic, _links(topic.links),
+                    None if previous is None
+                    else previous._routes.get(topic.name),
+                    **kwargs)
+                continue
+            previous_route = (
+                None if previous is None
+                else previous._wildcards.get(topic.name))
+            if topic.device_segment is None:
+                wildcard_route = WildcardRoute(route=_compile_route(
+                    topic, _links(topic.links),
+                    None if previous_route is None else previous_route.route,
+                    **kwargs))
+            else:
+                device_links = collections.defaultdict(list)
+                for link in topic.device_links:
+                    device_links[link.device].append(link)
+                previous_devices = (
+                    {} if previous_route is None else previous_route.devices)
+                wildcard_route = WildcardRoute(
+                    device_segment=topic.device_segment,
+                    devices={
+                        device: _compile_route(
+                            topic, tuple(sorted(_links(links))),
+                            previous_devices.get(device), **kwargs)
+                        for device, links in device_links.items()
+                    })
+            wildcards.insert(topic.name, wildcard_route)
+        return cls(routes, wildcards)
@@ -1,16 +1,42 @@
 """MQTT service"""
 
+import concurrent.futures
+import functools
+import threading
+import time
 from pathlib import Path
 
+import sqlalchemy as sqla
+
 from bemserver_core.database import db
 from bemserver_service_acquisition_mqtt import decoders
+from bemserver_service_acquisition_mqtt import ingestion
+from bemserver_service_acquisition_mqtt import metrics
+from bemserver_service_acquisition_mqtt.routing import RoutingTable
+from bemserver_service_acquisition_mqtt.startup import StartupReport
+from bemserver_service_acquisition_mqtt.listener import TopologyListener
+from bemserver_service_acquisition_mqtt.loop import (
+    NetworkLoop, NETWORK_LOOP_THREADED, NETWORK_LOOP_MODES)
 from bemserver_service_acquisition_mqtt.model import (
     Subscriber, PayloadDecoder)
-from bemserver_service_acquisition_mqtt.exceptions import ServiceError
+from bemserver_service_acquisition_mqtt.model.subscriber import (
+    CONNECTION_TIMEOUT)
+from bemserver_service_acquisition_mqtt.exceptions import (
+    ServiceError, PayloadDecoderRegistrationError)
 
 
 MQTT_CLIENT_ID = "bemserver-acquisition"
 
+# Topic label of messages received from topics without route (metrics).
+NO_ROUTE_TOPIC_LABEL = "<no route>"
+# Minimum time, in seconds, between two warnings of messages without route.
+NO_ROUTE_WARNING_INTERVAL = 60.0
+
+
+def _identity(subscriber):
+    # Subscriber ID, even if subscriber is expired and deleted in database.
+    return sqla.inspect(subscriber).identity[0]
+
 
 class Service:
     """Acquisition service for timeseries data, based on MQTT protocol.
@@ -23,65 +49,590 @@ class Service:
     def __init__(self, working_dirpath, *, logger=None):
         self._tls_cert_dirpath = Path(working_dirpath)
         self._logger = logger
+        self._client_id = MQTT_CLIENT_ID
+        self._shard = None
         self._running_subscribers = []
+        self._buffer = None
+        self._writer_pool = None
+        self._spools = []
+        self._timestamp_cache = None
+        self._routing_table = RoutingTable()
+        self._network_loop_mode = NETWORK_LOOP_THREADED
+        self._network_loop = None
+        self._metrics_server = None
+        self._connection_workers = 16
+        self._connection_timeout = CONNECTION_TIMEOUT
+        self._listener = None
+        self._reload_delay = 1.0
+        self._reload_event = threading.Event()
+        self._reload_request_time = 0.0
+        # Messages without route since last warning, and its time.
+        self._no_route_lock = threading.Lock()
+        self._no_route_count = 0
+        self._no_route_warning_time = None
+        # Changes applied by last topology reload.
+        self.reload_report = None
+        # Durations and database queries of last startup phases.
+        self.startup_report = None
         self.is_running = False
 
+    @property
+    def ingestion_stats(self):
+        """Statistics of timeseries data buffer flushes, if buffer is used.
+
+        With writer workers, statistics are summed over workers.
+        """
+        if self._buffer is None:
+            return None
+        return self._buffer.stats
+
+    @property
+    def status(self):
+        """Service status summary (running state, subscribers, ingestion)."""
+        return {
+            "is_running": self.is_running,
+            "subscribers": len(self._running_subscribers),
+            "topics": len(self._routing_table),
+            "ingestion_stats": self.ingestion_stats,
+            "timestamp_cache_stats": (
+                None if self._timestamp_cache is None
+                else self._timestamp_cache.stats),
+            "startup": (
+                None if self.startup_report is None
+                else self.startup_report.as_dict()),
+            "reload": self.reload_report,
+        }
+
     def set_db_url(self, db_url):
         """Set database URL."""
         if (db.engine is None
                 or db.engine is not None and str(db.engine.url) != db_url):
             db.set_db_url(db_url)
 
+    def set_ingestion(
+            self, *, strategy=ingestion.TimeseriesDataWriterInsert.name,
+            buffer_size=1000, buffer_max_age=1.0, workers=0,
+            queue_size=10000, spool_dirpath=None,
+            spool_max_size=1024 ** 3, spool_segment_size=64 * 1024 ** 2):
+        """Write received timeseries data by batches (write-behind buffer).
+
+        With writer workers, messages are decoded and written by a pool of
+        workers instead of MQTT network threads.
+
+        With a spool, values that can not be written in database (database
+        down or too slow) are stored on disk, then replayed.
+
+        :param str strategy: (optional, default "insert")
+            Name of the strategy used to write batches in database
+            ("insert", "copy_csv" or "copy_binary").
+        :param int buffer_size: (optional, default 1000)
+            Number of buffered values that triggers a database write.
+        :param float buffer_max_age: (optional, default 1.0)
+            Time, in seconds, a value can be buffered before database write.
+        :param int workers: (optional, default 0)
+            Number of writer workers, each using its own database
+            connection. If 0, messages are processed in MQTT network threads.
+        :param int queue_size: (optional, default 10000)
+            Maximum number of messages waiting for each writer worker.
+        :param str|Path spool_dirpath: (optional, default None)
+            Directory of spool files (relative to working directory). If
+            None, values that can not be written are lost.
+        :param int spool_max_size: (optional, default 1 GiB)
+            Maximum size, in bytes, of spool files (shared by writer workers).
+        :param int spool_segment_size: (optional, default 64 MiB)
+            Size, in bytes, of each spool file.
+        :raises TimeseriesDataWriterNotFoundError:
+            When ingestion strategy does not exist.
+        """
+        writer_cls = ingestion.get_writer_cls(strategy)
+        for spool in self._spools:
+            spool.close()
+        self._spools = []
+        if spool_dirpath is not None:
+            spool_dirpath = self._tls_cert_dirpath / spool_dirpath
+            if workers > 0:
+                # Each worker writes and replays its own spool.
+                self._spools = [
+                    ingestion.TimeseriesDataSpool(
+                        spool_dirpath / f"worker{i}",
+                        max_size=max(
+                            spool_max_size // workers, spool_segment_size),
+                        segment_size=spool_segment_size)
+                    for i in range(workers)
+                ]
+            else:
+                self._spools = [
+                    ingestion.TimeseriesDataSpool(
+                        spool_dirpath, max_size=spool_max_size,
+                        segment_size=spool_segment_size)
+                ]
+        if workers > 0:
+            self._writer_pool = ingestion.TimeseriesDataWriterPool(
+                workers, queue_size=queue_size, buffer_size=buffer_size,
+                buffer_max_age=buffer_max_age, writer=writer_cls(),
+                spools=self._spools or None,
+                timestamp_cache=self._timestamp_cache)
+            self._buffer = self._writer_pool
+            for idx in range(workers):
+                metrics.QUEUE_DEPTH.labels(str(idx)).set_function(
+                    lambda idx=idx: self._writer_pool.queue_depths[idx])
+        else:
+            self._writer_pool = None
+            self._buffer = ingestion.TimeseriesDataBuffer(
+                max_size=buffer_size, max_age=buffer_max_age,
+                writer=writer_cls(),
+                spool=self._spools[0] if self._spools else None,
+                timestamp_cache=self._timestamp_cache)
+            metrics.BUFFERED_VALUES.set_function(lambda: len(self._buffer))
+
+    def set_network_loop(self, mode):
+        """Set how subscribers' MQTT clients network loop runs.
+
+        :param str mode: "threaded" (one thread per subscriber) or "selector"
+            (one thread for all subscribers, see `NetworkLoop`).
+        :raises ValueError: When network loop mode is not valid.
+        """
+        if mode not in NETWORK_LOOP_MODES:
+            raise ValueError("Invalid network loop mode!")
+        self._network_loop_mode = mode
+
+    def set_connection(self, *, workers=16, timeout=CONNECTION_TIMEOUT):
+        """Set how subscribers connect to (and disconnect from) brokers.
+
+        Subscribers are connected concurrently, by a pool of threads, so that
+        service start and stop do not wait for each broker in turn. Database
+        is only accessed in the calling thread.
+
+        :param int workers: (optional, default 16)
+            Maximum number of subscribers connecting (or disconnecting) at
+            the same time.
+        :param float timeout: (optional, default 30)
+            Time, in seconds, to wait for each broker to accept connection
+            (or end it). Subscribers not connected in time are not run.
+        :raises ValueError: When workers or timeout is not positive.
+        """
+        if workers < 1:
+            raise ValueError("Invalid number of connection workers!")
+        if timeout <= 0:
+            raise ValueError("Invalid connection timeout!")
+        self._connection_workers = workers
+        self._connection_timeout = timeout
+
+    def set_reload(self, *, listen=True, delay=1.0):
+        """Set how topology changes are applied while service is running.
+
+        Topology reload (see `reload`) can be requested by a signal (SIGHUP,
+        see `request_reload`) or, when listening, by PostgreSQL each time
+        topology tables change (see `model.notify`).
+
+        :param bool listen: (optional, default True)
+            Whether to listen to topology change notifications (PostgreSQL
+            database only).
+        :param float delay: (optional, default 1.0)
+            Time, in seconds, without new request before reloading, so that
+            the changes of a whole edit (topic, its links, its
+            subscribers...) are applied at once.
+        :raises ValueError: When delay is negative.
+        """
+        if delay < 0:
+            raise ValueError("Invalid reload delay!")
+        self._reload_delay = delay
+        self._listener = (
+            TopologyListener(self.request_reload) if listen else None)
+
+    def set_timestamp_cache(self, enabled=True):
+        """Drop values already in database before writing them.
+
+        Retained and redelivered messages, received at each (re)connection,
+        are mostly already in database. A cache of the last timestamp of
+        each timeseries (loaded from database in one query when routing
+        table is compiled) drops their values before any database work.
+
+        :param bool enabled: (optional, default True)
+            Whether to use a last timestamp cache.
+        """
+        self._timestamp_cache = (
+            ingestion.TimeseriesLastTimestampCache() if enabled else None)
+        if self._buffer is not None:
+            # Told of values lost by buffer.
+            self._buffer.timestamp_cache = self._timestamp_cache
+
+    def set_metrics(self, *, host="127.0.0.1", port=9108):
+        """Serve service metrics to Prometheus, while service is running.
+
+        Metrics (messages received, decode failures, values written, database
+        write latency, queue depths, subscribers connection state...) are
+        served in Prometheus text format on `http://<host>:<port>/metrics`.
+
+        :param str host: (optional, default "127.0.0.1")
+            Host address to listen to.
+        :param int port: (optional, default 9108)
+            Port to listen to. If None, metrics are not served.
+        """
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+        self._metrics_server = (
+            None if port is None else metrics.MetricsServer(host, port))
+
+    def set_json_backend(self, backend_name):
+        """Set the backend used to decode JSON payloads.
+
+        :param str backend_name: "orjson", "ujson" or "json" (standard
+            library, always available).
+        :raises JSONBackendNotFoundError: When JSON backend is not available.
+        """
+        decoders.jsonlib.set_backend(backend_name)
+
     def _register_decoders(self):
-        for decoder_cls in decoders._PAYLOAD_DECODERS.values():
-            PayloadDecoder.register_from_class(decoder_cls)
+        for decoder_cls in list(decoders._PAYLOAD_DECODERS.values()):
+            if not issubclass(
+                    decoder_cls,
+                    decoders.declarative.PayloadDecoderDeclarativeBase):
+                PayloadDecoder.register_from_class(decoder_cls)
+        # Declarative decoders are compiled once, from their description.
+        for decoder in PayloadDecoder.get_declarative_list():
+            try:
+                decoder_cls = decoder.compile_cls()
+            except PayloadDecoderRegistrationError as exc:
+                if self._logger is not None:
+                    self._logger.error(str(exc))
+                continue
+            decoders.register_payload_decoder_cls(decoder_cls)
+            if self._logger is not None:
+                self._logger.debug(
+                    f"{decoder.name} declarative payload decoder compiled")
+
+    def _compile_routing_table(self, subscribers, *, previous=None):
+        topics = [topic for x in subscribers for topic in x.topics]
+        routing_table = RoutingTable.compile(
+            topics, buffer=self._buffer,
+            timestamp_cache=self._timestamp_cache, previous=previous)
+        if self._logger is not None:
+            self._logger.debug(
+                f"Routing table compiled ({len(routing_table)} topics)")
+        if self._timestamp_cache is not None:
+            # Timeseries of new topics only.
+            timeseries_ids = {
+                link.timeseries_id
+                for route in routing_table.iter_routes()
+                for link in route.links
+                if self._timestamp_cache.get(link.timeseries_id) is None
+            }
+            self._timestamp_cache.seed(timeseries_ids)
+        return routing_table
+
+    def rebuild_routing_table(self):
+        """Compile again the routing table of running subscribers' topics.
 
-    def run(self, *, client_id=MQTT_CLIENT_ID):
+        To call when topics or their links change. The new table replaces
+        the previous one at once: messages being processed meanwhile use
+        the previous one.
+        """
+        self._routing_table = self._compile_routing_table(
+            self._running_subscribers)
+
+    def _on_message(self, client, userdata, msg):
+        # Called in MQTT network threads: do not access database here.
+        # (user data is subscriber metrics label)
+        route = self._routing_table.get(msg.topic)
+        if route is None:
+            metrics.MESSAGES_RECEIVED.labels(
+                userdata, NO_ROUTE_TOPIC_LABEL).inc()
+            self._warn_no_route(msg.topic)
+            return
+        # Labelled by topic filter for wildcard topics (not by topic name,
+        #  one per device).
+        metrics.MESSAGES_RECEIVED.labels(
+            userdata, route.decoder.topic_name).inc()
+        if self._writer_pool is not None:
+            # Waits when worker queue is full, slowing down the broker.
+            self._writer_pool.submit(route, client, userdata, msg)
+        else:
+            route.decoder.on_message(client, userdata, msg)
+
+    def _warn_no_route(self, topic_name):
+        # Messages without route may keep coming: warn once in a while.
+        if self._logger is None:
+            return
+        now = time.monotonic()
+        with self._no_route_lock:
+            self._no_route_count += 1
+            if (self._no_route_warning_time is not None
+                    and now - self._no_route_warning_time
+                    < NO_ROUTE_WARNING_INTERVAL):
+                nb_messages = None
+            else:
+                nb_messages = self._no_route_count
+                self._no_route_count = 0
+                self._no_route_warning_time = now
+        if nb_messages is None:
+            self._logger.debug(f"No route for topic {topic_name}!")
+        elif nb_messages > 1:
+            self._logger.warning(
+                f"No route for topic {topic_name}! ({nb_messages - 1} other"
+                " messages without route since last warning)")
+        else:
+            self._logger.warning(f"No route for topic {topic_name}!")
+
+    def _run_concurrently(self, subscribers, func_name):
+        # Call a network method of subscribers in a pool of threads.
+        #  Returns its result by subscriber, False when it failed.
+        results = []
+        if len(subscribers) <= 0:
+            return results
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(self._connection_workers, len(subscribers)),
+                thread_name_prefix="connection") as executor:
+            futures = [
+                executor.submit(functools.partial(
+                    getattr(subscriber, func_name),
+                    self._connection_timeout))
+                for subscriber in subscribers
+            ]
+            for subscriber, future in zip(subscribers, futures):
+                try:
+                    results.append(future.result())
+                except Exception as exc:
+                    if self._logger is not None:
+                        self._logger.error(
+                            f"{subscriber._log_header} {func_name} failed:"
+                            f" {str(exc)}")
+                    results.append(False)
+        return results
+
+    def _get_subscribers(self):
+        # Enabled subscribers of shard, with their topics, links... in a few
+        #  queries.
+        subscribers = [
+            row[0] for row in Subscriber.get_list(
+                is_enabled=True, load_topology=True)]
+        if self._shard is not None:
+            shard_index, shard_count = self._shard
+            subscribers = [
+                x for x in subscribers if x.id % shard_count == shard_index]
+        return subscribers
+
+    def _connect_subscribers(self, subscribers):
+        for subscriber in subscribers:
+            # Set certificate file path if broker uses TLS.
+            if subscriber.broker.use_tls:
+                subscriber.broker.tls_certificate_dirpath = (
+                    self._tls_cert_dirpath)
+            # Broker stops sending messages while writer queues are full.
+            subscriber.connect_prepare(
+                self._client_id, logger=self._logger,
+                on_message=self._on_message,
+                network_loop=self._network_loop,
+                receive_maximum=(
+                    None if self._writer_pool is None
+                    else self._writer_pool.queue_size))
+        # Connect subscribers (network only), then save their state.
+        results = self._run_concurrently(subscribers, "connect_network")
+        for subscriber, is_connected in zip(subscribers, results):
+            subscriber.connect_finish(is_connected)
+            if is_connected:
+                self._running_subscribers.append(subscriber)
+        return sum(results)
+
+    def _disconnect_subscribers(self, subscribers, *, deleted_ids=()):
+        # Disconnect subscribers (network only), then save their state.
+        #  Deleted subscribers have no state to save.
+        self._run_concurrently(subscribers, "disconnect_network")
+        for subscriber in subscribers:
+            self._running_subscribers.remove(subscriber)
+            if _identity(subscriber) in deleted_ids:
+                if subscriber in db.session:
+                    db.session.expunge(subscriber)
+            else:
+                subscriber.disconnect_finish()
+
+    def run(self, *, client_id=MQTT_CLIENT_ID, shard=None):
         """Run the MQTT acquisition servive:
             - register payload decoders
             - get all enabled subsribers
-            - connect each subscriber to its broker to get messages
+            - compile the routing table of their topics
+            - connect subscribers to their brokers to get messages,
+              concurrently (see `set_connection`)
 
         :param str client_id: (optional, default "bemserver-acquisition")
             Client ID to use, especially when using a persistent session.
+        :param tuple shard: (optional, default None)
+            `(index, count)` to run only the subscribers of a shard, that is
+            whose ID modulo `count` is `index`. All subscribers if None.
         :raises ServiceError: When no enabled subscriber is available.
         """
         if self._logger is not None:
             self._logger.debug("Starting service...")
+        report = StartupReport()
 
-        self._register_decoders()
+        with report.phase("decoders"):
+            self._register_decoders()
 
-        rows = Subscriber.get_list(is_enabled=True)
-        if len(rows) <= 0:
+        self._client_id = client_id
+        self._shard = shard
+        with report.phase("topology"):
+            subscribers = self._get_subscribers()
+        if len(subscribers) <= 0:
             raise ServiceError(
                 "No subscribers available to run MQTT acquisition!")
 
-        for row in rows:
-            subscriber = row[0]
-            # Set certificate file path if broker uses TLS.
-            if subscriber.broker.use_tls:
-                subscriber.broker.tls_certificate_dirpath = (
-                    self._tls_cert_dirpath)
-            # Connect subscriber.
-            subscriber.connect(client_id, logger=self._logger)
-            if subscriber.is_connected:
-                self._running_subscribers.append(subscriber)
+        with report.phase("routing"):
+            self._routing_table = self._compile_routing_table(subscribers)
+
+        for spool in self._spools:
+            # Closed when service stopped.
+            spool.open()
+        if self._buffer is not None:
+            self._buffer.start()
 
+        if self._metrics_server is not None:
+            self._metrics_server.start()
+
+        if self._network_loop_mode != NETWORK_LOOP_THREADED:
+            self._network_loop = NetworkLoop()
+            self._network_loop.start()
+
+        with report.phase("connection"):
+            self._connect_subscribers(subscribers)
+
+        report.sizes = {
+            "subscribers": len(subscribers),
+            "topics": len(self._routing_table),
+            "connected": len(self._running_subscribers),
+        }
+        self.startup_report = report
+        if self._listener is not None:
+            try:
+                self._listener.start()
+            except ServiceError as exc:
+                if self._logger is not None:
+                    self._logger.error(
+                        f"{str(exc)} Topology is reloaded on SIGHUP only.")
         self.is_running = True
         if self._logger is not None:
+            self._logger.info(str(report))
             self._logger.debug("Service is running!")
 
     def stop(self):
         """Stop the MQTT acquisition service.
 
-        Each enabled subscriber is disconnected.
+        Running subscribers are disconnected concurrently.
         """
         if self._logger is not None:
             self._logger.debug("Stopping service...")
-        while len(self._running_subscribers) > 0:
-            self._running_subscribers[0].disconnect()
-            if not self._running_subscribers[0].is_connected:
-                del self._running_subscribers[0]
+        if self._listener is not None:
+            self._listener.stop()
+        self._disconnect_subscribers(list(self._running_subscribers))
+        if self._network_loop is not None:
+            self._network_loop.stop()
+            self._network_loop = None
+        # Write values still buffered.
+        if self._buffer is not None:
+            self._buffer.stop()
+        # Values not written are safe on disk.
+        for spool in self._spools:
+            spool.close()
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+        self._reload_event.clear()
         self.is_running = False
         if self._logger is not None:
             self._logger.debug("Service is stopped!")
+
+    def request_reload(self, tables=None):
+        """Request a topology reload (see `reload`).
+
+        Only sets a flag: can be called from a signal handler or another
+        thread. Service owner then calls `reload` (see
+        `is_reload_requested`), in the thread owning database session.
+
+        :param set tables: (optional, default None)
+            Names of the tables changed, if known.
+        """
+        self._reload_request_time = time.monotonic()
+        self._reload_event.set()
+
+    @property
+    def is_reload_requested(self):
+        """Whether a topology reload is requested and is due (no new
+        request for `delay` seconds, see `set_reload`)."""
+        return (
+            self._reload_event.is_set()
+            and time.monotonic() - self._reload_request_time
+            >= self._reload_delay)
+
+    def reload(self):
+        """Apply topology changes to the running service, without restart.
+
+        Topology is read again from database and compared to the running
+        one:
+            - subscribers disabled or deleted are disconnected
+            - subscribers enabled (or not connected yet) are connected
+            - subscribers whose connection settings changed (broker...)
+              connect again
+            - other subscribers only subscribe to topics added and
+              unsubscribe from topics removed (see
+              `Subscriber.sync_subscriptions`)
+            - routing table is compiled again, keeping the routes of
+              unchanged topics (see `RoutingTable.compile`)
+        Connections of unchanged subscribers are not touched: no retained
+        messages nor redeliveries.
+
+        :returns dict: Duration, numbers of subscribers connected and
+            disconnected, of topics subscribed and unsubscribed, and of
+            topics routed.
+        :raises ServiceError: When service is not running.
+        """
+        if not self.is_running:
+            raise ServiceError("Can not reload topology of a stopped service!")
+        self._reload_event.clear()
+        if self._logger is not None:
+            self._logger.debug("Reloading topology...")
+        t_start = time.perf_counter()
+
+        # Running subscribers are refreshed by query.
+        running = {_identity(x): x for x in self._running_subscribers}
+        subscribers = self._get_subscribers()
+        removed_ids = set(running) - {x.id for x in subscribers}
+        deleted_ids = removed_ids - set(db.session.execute(
+            sqla.select(Subscriber.id).filter(
+                Subscriber.id.in_(removed_ids))).scalars())
+        stopped = [
+            subscriber for subscriber_id, subscriber in running.items()
+            if subscriber_id in removed_ids
+            or subscriber.is_connection_changed
+        ]
+
+        # Routes of new topics must exist before they are subscribed.
+        self._routing_table = self._compile_routing_table(
+            subscribers, previous=self._routing_table)
+
+        self._disconnect_subscribers(stopped, deleted_ids=deleted_ids)
+        kept = list(self._running_subscribers)
+        nb_connected = self._connect_subscribers(
+            [x for x in subscribers if x not in kept])
+        nb_subscribed = nb_unsubscribed = 0
+        for subscriber in kept:
+            nb_sub, nb_unsub = subscriber.sync_subscriptions(
+                timeout=self._connection_timeout)
+            nb_subscribed += nb_sub
+            nb_unsubscribed += nb_unsub
+
+        self.reload_report = {
+            "duration": time.perf_counter() - t_start,
+            "connected": nb_connected,
+            "disconnected": len(stopped),
+            "subscribed": nb_subscribed,
+            "unsubscribed": nb_unsubscribed,
+            "topics": len(self._routing_table),
+        }
+        if self._logger is not None:
+            self._logger.info(
+                "Topology reloaded in"
+                f" {self.reload_report['duration']:.3f} s:"
+                f" {nb_connected} subscribers connected,"
+                f" {len(stopped)} disconnected,"
+                f" {nb_subscribed} topics subscribed,"
+                f" {nb_unsubscribed} unsubscribed"
+                f" ({len(self._routing_table)} topics routed)")
+        return self.reload_report
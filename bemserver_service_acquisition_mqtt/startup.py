@@ -0,0 +1,91 @@
+"""Service startup report
+
+Times each phase of service startup (payload decoders registration, topology
+loading, routing table compilation, subscribers connection) and counts the
+database queries it issues, to check that startup does not depend on the
+number of topics (no query by topic).
+"""
+
+import contextlib
+import time
+import sqlalchemy as sqla
+
+from bemserver_core.database import db
+
+
+class QueryCounter:
+    """Counts SQL statements executed on database engine (all threads).
+
+    Used as a context manager.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._engine = None
+
+    def _on_execute(self, conn, cursor, statement, parameters, context,
+                    executemany):
+        self.count += 1
+
+    def __enter__(self):
+        self._engine = db.engine
+        sqla.event.listen(
+            self._engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sqla.event.remove(
+            self._engine, "before_cursor_execute", self._on_execute)
+        self._engine = None
+
+
+class StartupReport:
+    """Duration and number of database queries of startup phases."""
+
+    def __init__(self):
+        # (duration in seconds, number of queries), by phase name.
+        self._phases = {}
+        # Topology sizes (subscribers, topics...), by name.
+        self.sizes = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Measure a startup phase (context manager).
+
+        :param str name: Phase name.
+        """
+        t_start = time.perf_counter()
+        with QueryCounter() as counter:
+            try:
+                yield
+            finally:
+                self._phases[name] = (
+                    time.perf_counter() - t_start, counter.count)
+
+    @property
+    def duration(self):
+        return sum(x[0] for x in self._phases.values())
+
+    @property
+    def queries(self):
+        return sum(x[1] for x in self._phases.values())
+
+    def as_dict(self):
+        return {
+            "duration": self.duration,
+            "queries": self.queries,
+            "phases": {
+                name: {"duration": duration, "queries": queries}
+                for name, (duration, queries) in self._phases.items()
+            },
+            **self.sizes,
+        }
+
+    def __str__(self):
+        phases = ", ".join(
+            f"{name} {duration:.3f} s ({queries} queries)"
+            for name, (duration, queries) in self._phases.items())
+        sizes = ", ".join(f"{v} {k}" for k, v in self.sizes.items())
+        return (
+            f"Startup in {self.duration:.3f} s, {self.queries} queries"
+            f" ({sizes}): {phases}")
@@ -0,0 +1,272 @@
+"""Multi-process MQTT acquisition
+
+A supervisor process runs the acquisition service in several worker
+processes, each one running a shard of the enabled subscribers with its own
+database engine. Decoding then scales over CPU cores.
+"""
+
+import os
+import time
+import signal
+import logging
+import threading
+import queue
+import multiprocessing
+from pathlib import Path
+
+from bemserver_service_acquisition_mqtt import SERVICE_LOGNAME
+from bemserver_service_acquisition_mqtt.exceptions import ServiceError
+
+
+logger = logging.getLogger(SERVICE_LOGNAME)
+
+
+def _run_worker(index, count, svc_config, verbose, debug, status_queue,
+                status_interval):
+    """Worker process: run the service for a shard of subscribers.
+
+    Status is reported to supervisor every `status_interval` seconds, as
+    `(index, pid, status)` tuples.
+    """
+    # Imported here to avoid a circular import (main imports supervisor).
+    from bemserver_service_acquisition_mqtt.__main__ import (
+        init_logger, create_service)
+
+    stop_event = threading.Event()
+
+    def signal_term_handler(sigcode, frame):
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, signal_term_handler)
+    # Ctrl+C is sent to the whole process group: let supervisor handle it.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Topology reload, forwarded by supervisor (handled once service runs).
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    init_logger(
+        svc_config["logging"], verbose=verbose, debug=debug,
+        filename_suffix=f"-worker{index}")
+    logger.info(f"Worker #{index} PID: {os.getpid()}...")
+
+    ingestion_config = svc_config.get("ingestion", {})
+    if ingestion_config.get("spool_dirpath") is not None:
+        # Spool files are not shared between processes.
+        svc_config = {**svc_config, "ingestion": {
+            **ingestion_config,
+            "spool_dirpath": str(
+                Path(ingestion_config["spool_dirpath"]) / f"process{index}"),
+        }}
+
+    metrics_config = svc_config.get("metrics")
+    if metrics_config is not None and metrics_config.get("port"):
+        # Each process serves its own metrics, on next ports.
+        svc_config = {**svc_config, "metrics": {
+            **metrics_config, "port": metrics_config["port"] + index}}
+
+    service = create_service(svc_config)
+    try:
+        service.run(shard=(index, count))
+    except ServiceError as exc:
+        # Not a crash (e.g. shard is empty): do not restart worker.
+        logger.warning(f"Worker #{index} is not running: {str(exc)}")
+        status_queue.put((index, os.getpid(), service.status))
+        return
+
+    signal.signal(
+        signal.SIGHUP, lambda sigcode, frame: service.request_reload())
+    try:
+        next_status = time.monotonic() + status_interval
+        while service.is_running and not stop_event.wait(
+                min(status_interval, 1.0)):
+            if service.is_reload_requested:
+                service.reload()
+            if time.monotonic() >= next_status:
+                next_status += status_interval
+                status_queue.put((index, os.getpid(), service.status))
+    finally:
+        service.stop()
+        status_queue.put((index, os.getpid(), service.status))
+
+
+class Supervisor:
+    """Runs and watches the acquisition service in worker processes.
+
+    Enabled subscribers are split between workers by ID (see `Service.run`
+    `shard` parameter). A crashed worker is restarted. Supervisor has the
+    same `run`/`stop`/`is_running`/`request_reload` interface as `Service`.
+
+    :param dict svc_config: Service configuration (see `load_config`).
+    :param int nb_workers: Number of worker processes.
+    :param bool verbose: (optional, default False)
+        If True workers print log messages in console output.
+    :param bool debug: (optional, default False)
+        If True forces workers log level to DEBUG.
+    :param float restart_delay: (optional, default 5.0)
+        Time, in seconds, to wait before restarting a crashed worker.
+    :param float status_interval: (optional, default 10.0)
+        Time, in seconds, between two status reports of a worker.
+    """
+
+    def __init__(
+            self, svc_config, nb_workers, *, verbose=False, debug=False,
+            restart_delay=5.0, status_interval=10.0):
+        if nb_workers < 1:
+            raise ValueError("Invalid number of workers!")
+        self._svc_config = svc_config
+        self._nb_workers = nb_workers
+        self._verbose = verbose
+        self._debug = debug
+        self._restart_delay = restart_delay
+        self._status_interval = status_interval
+        # Spawn (do not fork) so that each worker has its own DB engine.
+        self._mp_context = multiprocessing.get_context("spawn")
+        self._status_queue = self._mp_context.Queue()
+        self._processes = [None] * nb_workers
+        self._restarts = [0] * nb_workers
+        self._worker_status = [None] * nb_workers
+        self._stop_event = threading.Event()
+        self._monitor_thread = None
+        self._lock = threading.Lock()
+        self.is_running = False
+
+    @property
+    def _log_header(self):
+        return "[Supervisor]"
+
+    @property
+    def nb_workers(self):
+        return self._nb_workers
+
+    @property
+    def pids(self):
+        """PID of each worker process (None if not started)."""
+        with self._lock:
+            return [x.pid if x is not None else None for x in self._processes]
+
+    @property
+    def status(self):
+        """Aggregated status of workers."""
+        self._drain_status_queue()
+        with self._lock:
+            workers = [
+                {
+                    "pid": process.pid if process is not None else None,
+                    "is_alive": process is not None and process.is_alive(),
+                    "restarts": self._restarts[index],
+                    "status": self._worker_status[index],
+                }
+                for index, process in enumerate(self._processes)
+            ]
+        reported = [x["status"] for x in workers if x["status"] is not None]
+        return {
+            "is_running": self.is_running,
+            "workers": workers,
+            "workers_alive": sum(x["is_alive"] for x in workers),
+            "subscribers": sum(x["subscribers"] for x in reported),
+            "topics": sum(x["topics"] for x in reported),
+        }
+
+    @property
+    def is_reload_requested(self):
+        # Workers reload their topology themselves.
+        return False
+
+    def request_reload(self, tables=None):
+        """Request a topology reload of workers (SIGHUP forwarded to each
+        one, see `Service.request_reload`)."""
+        with self._lock:
+            processes = [
+                x for x in self._processes
+                if x is not None and x.is_alive()]
+        for process in processes:
+            os.kill(process.pid, signal.SIGHUP)
+        logger.debug(
+            f"{self._log_header} topology reload requested to"
+            f" {len(processes)} workers")
+
+    def _start_worker(self, index):
+        process = self._mp_context.Process(
+            target=_run_worker, name=f"AcquisitionWorker-{index}",
+            args=(
+                index, self._nb_workers, self._svc_config, self._verbose,
+                self._debug, self._status_queue, self._status_interval),
+            daemon=False)
+        process.start()
+        self._processes[index] = process
+        logger.debug(
+            f"{self._log_header} worker #{index} started (PID {process.pid})")
+
+    def _drain_status_queue(self):
+        while True:
+            try:
+                index, pid, status = self._status_queue.get_nowait()
+            except queue.Empty:
+                return
+            with self._lock:
+                self._worker_status[index] = status
+
+    def _monitor(self):
+        while not self._stop_event.wait(1.0):
+            self._drain_status_queue()
+            with self._lock:
+                for index, process in enumerate(self._processes):
+                    if (process is None or process.is_alive()
+                            or process.exitcode == 0):
+                        continue
+                    logger.error(
+                        f"{self._log_header} worker #{index} (PID"
+                        f" {process.pid}) crashed (exit code"
+                        f" {process.exitcode}), restarting in"
+                        f" {self._restart_delay} seconds...")
+                    process.close()
+                    self._processes[index] = None
+                    self._restarts[index] += 1
+                    threading.Timer(
+                        self._restart_delay, self._restart_worker,
+                        args=(index,)).start()
+
+    def _restart_worker(self, index):
+        with self._lock:
+            if not self._stop_event.is_set():
+                self._start_worker(index)
+
+    def run(self):
+        """Start worker processes and watch them."""
+        logger.debug(
+            f"{self._log_header} starting {self._nb_workers} workers...")
+        self._stop_event.clear()
+        with self._lock:
+            for index in range(self._nb_workers):
+                self._start_worker(index)
+        self._monitor_thread = threading.Thread(
+            target=self._monitor, name="SupervisorMonitor", daemon=True)
+        self._monitor_thread.start()
+        self.is_running = True
+
+    def stop(self, *, timeout=30.0):
+        """Stop worker processes (SIGTERM forwarded to each one).
+
+        :param float timeout: (optional, default 30.0)
+            Time, in seconds, to wait for a worker to stop before killing it.
+        """
+        logger.debug(f"{self._log_header} stopping workers...")
+        self._stop_event.set()
+        if self._monitor_thread is not None:
+            self._monitor_thread.join()
+            self._monitor_thread = None
+        with self._lock:
+            processes = [x for x in self._processes if x is not None]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.error(
+                    f"{self._log_header} worker (PID {process.pid}) did not"
+                    " stop in time and is killed!")
+                process.kill()
+                process.join()
+        self._drain_status_queue()
+        self.is_running = False
+        logger.debug(f"{self._log_header} workers stopped")
@@ -0,0 +1,327 @@
+"""Micro-benchmark of payload decoders
+
+Measures `_decode` of each registered payload decoder on realistic corpora:
+    - bemserver: small payloads
+    - Chirpstack: uplinks with objectJSON as a string (Chirpstack v3) or as a
+      dict, multi-gateway rxInfo with full metadata
+    - Chirpstack binary frames: uplinks with base64 device frame
+    - malformed inputs (invalid JSON, missing keys, invalid timestamps...)
+
+Reports time per message (best of repeats, in nanoseconds) and memory
+allocated per message (median peak and retained, from tracemalloc). Decoders
+without a corpus (custom decoders...) are skipped.
+
+Example::
+
+    python benchmarks/bench_decoders.py --json-backend orjson \\
+        --output results.json
+"""
+
+import argparse
+import base64
+import json
+import random
+import statistics
+import struct
+import sys
+import time
+import tracemalloc
+import datetime as dt
+
+from bemserver_service_acquisition_mqtt import decoders
+from bemserver_service_acquisition_mqtt.decoders import jsonlib
+from bemserver_service_acquisition_mqtt.decoders.chirpstack import (
+    PayloadDecoderChirpstackBase)
+from bemserver_service_acquisition_mqtt.decoders.lorawan import (
+    PayloadDecoderChirpstackFrameBase, PayloadDecoderChirpstackMilesightBase)
+
+import common
+
+
+_START_DT = dt.datetime(2021, 5, 3, 17, 28, 55, tzinfo=dt.timezone.utc)
+
+
+def _timestamps(nb_messages):
+    return [
+        _START_DT + dt.timedelta(
+            seconds=i, microseconds=random.randrange(1000000))
+        for i in range(nb_messages)
+    ]
+
+
+def _gateway_info(timestamp, idx=0):
+    return {
+        "gatewayID": f"a840411ed69041{idx:02x}",
+        "uplinkID": "0d9f2b8e-0a3c-4ce3-b9a1-5ab1b1a8f0c2",
+        "name": f"gateway-{idx}",
+        "time": timestamp.isoformat().replace("+00:00", "Z"),
+        "rssi": random.randint(-120, -40),
+        "loRaSNR": round(random.uniform(-10, 10), 1),
+        "channel": random.randint(0, 7),
+        "rfChain": 1,
+        "board": 0,
+        "antenna": 0,
+        "location": {"latitude": 45.76, "longitude": 4.83, "altitude": 170},
+        "context": "8vJVhA==",
+    }
+
+
+def _uplink(timestamp, *, object_json=None, data=None, nb_gateways=1,
+            metadata=True):
+    uplink = {
+        "rxInfo": [
+            _gateway_info(timestamp, idx) if metadata
+            else {"time": timestamp.isoformat().replace("+00:00", "Z")}
+            for idx in range(nb_gateways)
+        ],
+    }
+    if metadata:
+        uplink.update({
+            "applicationID": "1",
+            "applicationName": "benchmark",
+            "deviceName": "device",
+            "devEUI": "24e124136b502217",
+            "txInfo": {"frequency": 868100000, "dr": 5},
+            "adr": True,
+            "fCnt": random.randint(0, 65535),
+            "fPort": 85,
+        })
+    if isinstance(data, bytes):
+        uplink["data"] = base64.b64encode(data).decode()
+    elif data is not None:
+        # Invalid data.
+        uplink["data"] = data
+    if object_json is not None:
+        uplink["objectJSON"] = object_json
+    return json.dumps(uplink).encode()
+
+
+def _object_values(decoder_cls):
+    if issubclass(decoder_cls, decoders.PayloadDecoderChirpstackARF8200AA):
+        return {
+            field: {"unit": "mA", "value": round(random.uniform(4, 20), 3)}
+            for field in decoder_cls.fields
+        }
+    return {
+        field: round(random.uniform(0, 100), 1)
+        for field in decoder_cls.fields
+    }
+
+
+def _frame(decoder_cls):
+    if issubclass(decoder_cls, PayloadDecoderChirpstackMilesightBase):
+        return struct.pack(
+            "<BBBBBhBBB", 0x01, 0x75, random.randint(0, 100), 0x03, 0x67,
+            random.randint(-200, 400), 0x04, 0x68, random.randint(0, 200))
+    if issubclass(
+            decoder_cls, decoders.PayloadDecoderChirpstackFrameARF8200AA):
+        return struct.pack(
+            ">BBBfBf", 0x42, 0x20, 0x01, random.uniform(4, 20), 0x01,
+            random.uniform(4, 20))
+    return None
+
+
+def _malformed_json(timestamps):
+    # Invalid JSON, not an object, empty payload, truncated payload.
+    return [b"{not json", b"[]", b"", b'{"ts": "2021-05-03T17:'] + [
+        json.dumps({"ts": "2021-13-45T99:00:00Z", "value": 1}).encode()
+        for _ in timestamps
+    ]
+
+
+def make_corpora(decoder_cls, nb_messages):
+    """Get the corpora of a decoder.
+
+    :returns dict: Lists of payloads (bytes), by corpus name. Empty if the
+        decoder is not supported.
+    """
+    timestamps = _timestamps(nb_messages)
+    if issubclass(decoder_cls, decoders.PayloadDecoderBEMServer):
+        return {
+            "small": [
+                json.dumps({
+                    "ts": x.isoformat(),
+                    "value": round(random.uniform(0, 100), 2),
+                }).encode()
+                for x in timestamps
+            ],
+            "malformed": [
+                json.dumps({"ts": x.isoformat()}).encode()
+                if i % 2 else json.dumps({"value": 1}).encode()
+                for i, x in enumerate(timestamps)
+            ] + _malformed_json(timestamps[:10]),
+        }
+    if issubclass(decoder_cls, PayloadDecoderChirpstackFrameBase):
+        if _frame(decoder_cls) is None:
+            return {}
+        return {
+            "frame": [
+                _uplink(x, data=_frame(decoder_cls), metadata=False)
+                for x in timestamps
+            ],
+            "multi_gateway": [
+                _uplink(x, data=_frame(decoder_cls), nb_gateways=3)
+                for x in timestamps
+            ],
+            "malformed": [
+                _uplink(x, data=b"\x03\x67\x10")
+                if i % 2 else _uplink(x, data="@@ not base64 @@")
+                for i, x in enumerate(timestamps)
+            ] + _malformed_json(timestamps[:10]),
+        }
+    if issubclass(decoder_cls, PayloadDecoderChirpstackBase):
+        return {
+            "object_json_string": [
+                _uplink(
+                    x, object_json=json.dumps(_object_values(decoder_cls)),
+                    metadata=False)
+                for x in timestamps
+            ],
+            "object_json_dict": [
+                _uplink(
+                    x, object_json=_object_values(decoder_cls),
+                    metadata=False)
+                for x in timestamps
+            ],
+            "multi_gateway": [
+                _uplink(
+                    x, object_json=json.dumps(_object_values(decoder_cls)),
+                    nb_gateways=3)
+                for x in timestamps
+            ],
+            "malformed": [
+                _uplink(x, object_json="{broken")
+                if i % 2 else _uplink(x, object_json={}).replace(
+                    b'"rxInfo"', b'"noInfo"')
+                for i, x in enumerate(timestamps)
+            ] + _malformed_json(timestamps[:10]),
+        }
+    return {}
+
+
+def measure_time(decode, corpus, *, repeat):
+    """Get best time per message, in nanoseconds, and number of errors."""
+    best = None
+    for _ in range(repeat):
+        nb_errors = 0
+        t_start = time.perf_counter_ns()
+        for payload in corpus:
+            try:
+                decode(payload)
+            except Exception:
+                nb_errors += 1
+        duration = (time.perf_counter_ns() - t_start) / len(corpus)
+        if best is None or duration < best:
+            best = duration
+    return best, nb_errors
+
+
+def measure_memory(decode, corpus):
+    """Get median memory allocated per message, in bytes: peak while
+    decoding and retained (decoded values).
+
+    Median ignores one-off allocations (caches filled, imports...).
+    """
+    peaks = []
+    retained = []
+    for payload in corpus:
+        tracemalloc.start()
+        try:
+            result = decode(payload)
+        except Exception:
+            result = None
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+        peaks.append(peak)
+        retained.append(current)
+    return statistics.median(peaks), statistics.median(retained)
+
+
+def run(args):
+    """Run the benchmark.
+
+    :returns dict: Results.
+    """
+    random.seed(args.seed)
+    if args.json_backend is not None:
+        jsonlib.set_backend(args.json_backend)
+
+    metrics = {}
+    for name, decoder_cls in sorted(decoders._PAYLOAD_DECODERS.items()):
+        if args.decoder and name not in args.decoder:
+            continue
+        corpora = make_corpora(decoder_cls, args.messages)
+        if not corpora:
+            print(f"{name}: skipped (no corpus)", file=sys.stderr)
+            continue
+        decoder = decoder_cls(None)
+        decoder.timestamp_last_reception = _START_DT
+        for corpus_name, corpus in corpora.items():
+            # Warm up (imports, caches).
+            measure_time(decoder._decode, corpus[:10], repeat=1)
+            ns_per_message, nb_errors = measure_time(
+                decoder._decode, corpus, repeat=args.repeat)
+            peak, retained = measure_memory(
+                decoder._decode, corpus[:args.memory_messages])
+            key = f"{name}.{corpus_name}"
+            metrics[f"{key}.ns_per_message"] = common.metric(
+                round(ns_per_message), "ns", common.LOWER)
+            metrics[f"{key}.alloc_peak_bytes"] = common.metric(
+                round(peak), "B", common.LOWER)
+            metrics[f"{key}.alloc_retained_bytes"] = common.metric(
+                round(retained), "B", common.LOWER)
+            print(
+                f"{key:<50} {ns_per_message:>10,.0f} ns/msg"
+                f" {peak:>8,.0f} B peak {retained:>6,.0f} B retained"
+                f" {nb_errors:>6} errors", file=sys.stderr)
+
+    parameters = {
+        "messages": args.messages,
+        "repeat": args.repeat,
+        "memory_messages": args.memory_messages,
+        "seed": args.seed,
+        "json_backend": jsonlib.get_backend(),
+        "decoders": sorted(args.decoder) if args.decoder else None,
+    }
+    return common.make_results("decoders", parameters, metrics)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--decoder", action="append",
+        help="Decoder to benchmark (can be repeated, default: all)")
+    parser.add_argument(
+        "--messages", type=int, default=1000, help="Messages per corpus")
+    parser.add_argument(
+        "--repeat", type=int, default=5,
+        help="Timed passes over each corpus (best is kept)")
+    parser.add_argument(
+        "--memory-messages", type=int, default=100,
+        help="Messages of each corpus traced for memory allocations")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json-backend", default=None)
+    parser.add_argument("--output", help="Results JSON file (default: stdout)")
+    parser.add_argument(
+        "--baseline", help="Results JSON file to check regressions against")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1,
+        help="Relative regression allowed (default 0.1)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+    common.write_results(results, args.output)
+    if args.baseline is not None:
+        regressions = common.compare(
+            common.load_results(args.baseline), results,
+            tolerance=args.tolerance)
+        return common.report_regressions(regressions)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
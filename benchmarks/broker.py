@@ -0,0 +1,322 @@
+"""Local MQTT broker stand-in for benchmarks
+
+Only what the service needs is implemented, for MQTT v3.1.1 and v5 clients:
+CONNECT, SUBSCRIBE (exact topic filters), PINGREQ, DISCONNECT, and PUBLISH
+to subscribers with QoS 0 or 1 (acknowledgements are ignored). Messages are
+published by the broker itself, at a given rate, so that no publisher client
+competes with the service for the CPU.
+"""
+
+import json
+import random
+import socket
+import struct
+import threading
+import time
+import datetime as dt
+
+
+PAYLOAD_KINDS = ("bemserver", "chirpstack",)
+
+# MQTT control packet types.
+_CONNECT = 1
+_PUBLISH = 3
+_SUBSCRIBE = 8
+_PINGREQ = 12
+_DISCONNECT = 14
+
+_MQTTv5 = 5
+
+_EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+
+
+def _encode_length(length):
+    data = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        data.append(byte | (128 if length else 0))
+        if not length:
+            return bytes(data)
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def _read_packet(sock):
+    header = _recv_exactly(sock, 1)[0]
+    multiplier, length = 1, 0
+    while True:
+        byte = _recv_exactly(sock, 1)[0]
+        length += (byte & 127) * multiplier
+        multiplier *= 128
+        if not byte & 128:
+            break
+    return header >> 4, _recv_exactly(sock, length)
+
+
+def _skip_properties(data, offset):
+    # Properties are not used: skip them (variable byte integer length).
+    multiplier, length = 1, 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        length += (byte & 127) * multiplier
+        multiplier *= 128
+        if not byte & 128:
+            return offset + length
+
+
+class _Connection:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.protocol_version = None
+        self.next_packet_id = 0
+        self._lock = threading.Lock()
+
+    def send(self, data):
+        with self._lock:
+            self.sock.sendall(data)
+
+    def publish_packet(self, topic, payload, qos):
+        topic = topic.encode()
+        body = struct.pack("!H", len(topic)) + topic
+        if qos > 0:
+            self.next_packet_id = self.next_packet_id % 65535 + 1
+            body += struct.pack("!H", self.next_packet_id)
+        if self.protocol_version == _MQTTv5:
+            # No properties.
+            body += b"\x00"
+        body += payload
+        return (
+            bytes([(_PUBLISH << 4) | (qos << 1)])
+            + _encode_length(len(body)) + body)
+
+
+class LocalBroker:
+    """Threaded MQTT broker, listening on localhost.
+
+    :param int port: (optional, default 0) Port to listen to (0 for any free
+        port, see `port` attribute).
+    """
+
+    def __init__(self, port=0):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", port))
+        self._server.listen(128)
+        self.port = self._server.getsockname()[1]
+        # Subscribed connections, by topic.
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self._is_running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    @property
+    def topics(self):
+        """Subscribed topics."""
+        with self._lock:
+            return {k for k, v in self._subscriptions.items() if v}
+
+    def _accept(self):
+        while self._is_running:
+            try:
+                sock, _ = self._server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(
+                target=self._handle, args=(_Connection(sock),),
+                daemon=True).start()
+
+    def _handle(self, conn):
+        try:
+            while True:
+                packet_type, data = _read_packet(conn.sock)
+                if packet_type == _CONNECT:
+                    # Protocol name (2 + 4 bytes), then protocol level.
+                    conn.protocol_version = data[6]
+                    if conn.protocol_version == _MQTTv5:
+                        conn.send(b"\x20\x03\x00\x00\x00")
+                    else:
+                        conn.send(b"\x20\x02\x00\x00")
+                elif packet_type == _SUBSCRIBE:
+                    self._subscribe(conn, data)
+                elif packet_type == _PINGREQ:
+                    conn.send(b"\xd0\x00")
+                elif packet_type == _DISCONNECT:
+                    break
+                # Other packets (PUBACK...) are ignored.
+        except (ConnectionError, OSError, IndexError):
+            pass
+        finally:
+            with self._lock:
+                for connections in self._subscriptions.values():
+                    connections.pop(conn, None)
+            conn.sock.close()
+
+    def _subscribe(self, conn, data):
+        packet_id = data[:2]
+        offset = 2
+        if conn.protocol_version == _MQTTv5:
+            offset = _skip_properties(data, offset)
+        granted = bytearray()
+        with self._lock:
+            while offset < len(data):
+                (length,) = struct.unpack_from("!H", data, offset)
+                topic = data[offset + 2:offset + 2 + length].decode()
+                qos = data[offset + 2 + length] & 0x03
+                offset += 3 + length
+                self._subscriptions.setdefault(topic, {})[conn] = qos
+                granted.append(qos)
+        body = packet_id
+        if conn.protocol_version == _MQTTv5:
+            body += b"\x00"
+        body += bytes(granted)
+        conn.send(b"\x90" + _encode_length(len(body)) + body)
+
+    def publish(self, messages):
+        """Send messages to subscribers, one write per connection.
+
+        :param list messages: List of `(topic, payload)` tuples.
+        :returns int: Number of messages delivered (to all subscribers).
+        """
+        packets = {}
+        nb_delivered = 0
+        with self._lock:
+            for topic, payload in messages:
+                for conn, qos in self._subscriptions.get(topic, {}).items():
+                    packets.setdefault(conn, []).append(
+                        conn.publish_packet(topic, payload, qos))
+                    nb_delivered += 1
+        for conn, conn_packets in packets.items():
+            try:
+                conn.send(b"".join(conn_packets))
+            except OSError:
+                pass
+        return nb_delivered
+
+    def close(self):
+        self._is_running = False
+        self._server.close()
+
+
+def make_payload(kind, timestamp):
+    """Build a synthetic payload, timestamped with its publication time.
+
+    :param str kind: "bemserver" or "chirpstack" (EM300-TH-868 uplink).
+    :param datetime timestamp: Publication time (aware).
+    :returns bytes: Payload.
+    """
+    if kind == "bemserver":
+        payload = {
+            "ts": timestamp.isoformat(),
+            "value": round(random.uniform(0, 100), 2),
+        }
+    elif kind == "chirpstack":
+        payload = {
+            "applicationID": "1",
+            "applicationName": "benchmark",
+            "deviceName": "em300-th",
+            "devEUI": "24e124136b502217",
+            "rxInfo": [{
+                "gatewayID": "a840411ed6904150",
+                "time": timestamp.isoformat().replace("+00:00", "Z"),
+                "rssi": -57,
+                "loRaSNR": 9.5,
+                "location": {
+                    "latitude": 45.8, "longitude": 4.8, "altitude": 0},
+            }],
+            "txInfo": {"frequency": 868100000, "dr": 5},
+            "adr": True,
+            "fCnt": random.randint(0, 65535),
+            "fPort": 85,
+            "data": "AXVkA2fcAARoaQ==",
+            "objectJSON": json.dumps({
+                "battery": 100,
+                "temperature": round(random.uniform(15, 25), 1),
+                "humidity": round(random.uniform(30, 60), 1),
+            }),
+        }
+    else:
+        raise ValueError(f"Invalid payload kind: {kind}")
+    return json.dumps(payload).encode()
+
+
+def publish_synthetic(publish, topics, *, kind, rate, duration):
+    """Publish synthetic payloads, in round robin over topics.
+
+    Messages are published at `rate` messages per second (as fast as
+    possible if 0), for `duration` seconds. Each payload timestamp is its
+    publication time, unique (microseconds).
+
+    :param callable publish: Called with a list of `(topic, payload)` tuples,
+        returns number of messages delivered.
+    :returns dict: Publication results.
+    """
+    nb_published = 0
+    nb_delivered = 0
+    last_us = 0
+    t_start = time.monotonic()
+    t_stop = t_start + duration
+    while True:
+        now = time.monotonic()
+        if now >= t_stop:
+            break
+        if rate > 0:
+            nb_due = int((now - t_start) * rate) - nb_published
+            if nb_due <= 0:
+                time.sleep(min(0.001, 1 / rate))
+                continue
+        else:
+            nb_due = 100
+        first_us = max(time.time_ns() // 1000, last_us + 1)
+        last_us = first_us + nb_due - 1
+        messages = [
+            (
+                topics[(nb_published + i) % len(topics)],
+                make_payload(
+                    kind, _EPOCH + dt.timedelta(microseconds=first_us + i)),
+            )
+            for i in range(nb_due)
+        ]
+        nb_delivered += publish(messages)
+        nb_published += nb_due
+    return {
+        "messages_published": nb_published,
+        "messages_delivered": nb_delivered,
+        "publish_duration": time.monotonic() - t_start,
+    }
+
+
+def run_broker(conn, topics, *, kind, rate, duration, subscribe_timeout=60):
+    """Broker process: publish synthetic payloads once topics are subscribed.
+
+    Sends broker port through `conn` pipe, then waits for a "start" message
+    and sends back a dict of publication results (see `publish_synthetic`).
+    """
+    broker = LocalBroker()
+    conn.send(broker.port)
+    if conn.recv() != "start":
+        return
+
+    t_timeout = time.monotonic() + subscribe_timeout
+    while broker.topics != set(topics):
+        if time.monotonic() > t_timeout:
+            conn.send({"error": "Topics not subscribed in time"})
+            return
+        time.sleep(0.05)
+
+    conn.send(publish_synthetic(
+        broker.publish, topics, kind=kind, rate=rate, duration=duration))
+    # Keep connections open until service is stopped.
+    conn.recv()
+    broker.close()
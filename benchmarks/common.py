@@ -0,0 +1,181 @@
+"""Benchmark results: environment, metrics and regression checks
+
+Results are JSON documents:
+
+.. code-block:: json
+
+    {
+        "benchmark": "service",
+        "environment": {"version": "0.0.1", "python": "3.9.5", ...},
+        "parameters": {"rate": 1000, ...},
+        "metrics": {
+            "messages_per_second": {
+                "value": 998.2, "unit": "msg/s", "better": "higher"
+            }
+        }
+    }
+
+Each metric states whether higher or lower is better, so that any two
+results of a benchmark can be compared (see `compare`).
+"""
+
+import os
+import sys
+import json
+import math
+import platform
+import resource
+import threading
+import datetime as dt
+
+import bemserver_service_acquisition_mqtt as svc
+
+
+HIGHER = "higher"
+LOWER = "lower"
+
+
+def environment():
+    """Describe where a benchmark runs."""
+    return {
+        "version": svc.__version__,
+        "date": dt.datetime.now(dt.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def metric(value, unit, better):
+    return {"value": value, "unit": unit, "better": better}
+
+
+def percentile(values, percent):
+    """Get a percentile (nearest rank) of values, None if no values."""
+    if len(values) <= 0:
+        return None
+    values = sorted(values)
+    rank = round(percent / 100 * (len(values) - 1))
+    return values[int(rank)]
+
+
+def rss_mib():
+    """Get resident set size of current process, in MiB (Linux only)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mib():
+    """Get peak resident set size of current process, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere.
+    return peak / 1024 ** (2 if sys.platform == "darwin" else 1)
+
+
+class RSSSampler:
+    """Samples resident set size in a background thread, keeps maximum.
+
+    :param float interval: (optional, default 0.2)
+        Time, in seconds, between samples.
+    """
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.max = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = rss_mib()
+        if rss is not None and (self.max is None or rss > self.max):
+            self.max = rss
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        self._sample()
+
+
+def make_results(benchmark, parameters, metrics):
+    return {
+        "benchmark": benchmark,
+        "environment": environment(),
+        "parameters": parameters,
+        "metrics": metrics,
+    }
+
+
+def write_results(results, filepath=None):
+    """Write results as JSON, in a file or on standard output."""
+    if filepath is None:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+    with open(filepath, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(filepath):
+    with open(filepath) as f:
+        return json.load(f)
+
+
+def compare(baseline, results, *, tolerance=0.1):
+    """Find metrics that regressed since a baseline.
+
+    :param dict baseline: Baseline results (same benchmark).
+    :param dict results: Results to check.
+    :param float tolerance: (optional, default 0.1)
+        Relative change allowed in the wrong direction.
+    :returns list: `(name, baseline value, value, relative change)` tuples
+        of regressed metrics.
+    :raises ValueError: When results are not from the same benchmark, or
+        not with the same parameters.
+    """
+    if baseline["benchmark"] != results["benchmark"]:
+        raise ValueError("Results are not from the same benchmark!")
+    if baseline["parameters"] != results["parameters"]:
+        raise ValueError("Results parameters differ!")
+    regressions = []
+    for name, result in results["metrics"].items():
+        base = baseline["metrics"].get(name)
+        if base is None or base["value"] is None or result["value"] is None:
+            continue
+        change = result["value"] - base["value"]
+        if result["better"] == HIGHER:
+            change = -change
+        if base["value"] != 0:
+            change /= abs(base["value"])
+        elif change > 0:
+            change = math.inf
+        if change > tolerance:
+            regressions.append((name, base["value"], result["value"], change))
+    return regressions
+
+
+def report_regressions(regressions, *, file=sys.stderr):
+    """Print regressions, returns exit status (1 if any regression)."""
+    for name, base_value, value, change in regressions:
+        print(
+            f"REGRESSION {name}: {base_value:g} -> {value:g}"
+            f" ({change:+.1%} worse)", file=file)
+    return 1 if regressions else 0
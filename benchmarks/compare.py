@@ -0,0 +1,31 @@
+"""Check benchmark results for regressions against a baseline
+
+Example::
+
+    python benchmarks/compare.py baseline.json results.json --tolerance 0.05
+
+Exit status is 1 when a metric regressed by more than tolerance.
+"""
+
+import argparse
+import sys
+
+import common
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("baseline", help="Baseline results JSON file")
+    parser.add_argument("results", help="Results JSON file to check")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1,
+        help="Relative regression allowed (default 0.1)")
+    args = parser.parse_args(argv)
+    regressions = common.compare(
+        common.load_results(args.baseline), common.load_results(args.results),
+        tolerance=args.tolerance)
+    return common.report_regressions(regressions)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
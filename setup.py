@@ -43,6 +43,9 @@ setup(
             "#egg=bemserver-core"
         ),
     ],
+    extras_require={
+        "numpy": ["numpy>=1.17"],
+    },
     packages=find_packages(exclude=["tests*"]),
     entry_points={
         "console_scripts": [
@@ -129,6 +129,15 @@ def broker(database):
     return broker
 
 
+@pytest.fixture
+def broker_loopback(database):
+    broker = svc_model.Broker(
+        host="localhost", port=1883,
+        transport=svc_model.Broker.Transport.loopback.value)
+    broker.save()
+    return broker
+
+
 @pytest.fixture
 def broker_tls(database, tmpdir):
     broker = svc_model.Broker(
@@ -147,6 +156,13 @@ def subscriber(broker):
     return subscriber
 
 
+@pytest.fixture
+def subscriber_loopback(broker_loopback):
+    subscriber = svc_model.Subscriber(broker_id=broker_loopback.id)
+    subscriber.save()
+    return subscriber
+
+
 @pytest.fixture
 def subscriber_tls(broker_tls):
     subscriber = svc_model.Subscriber(broker_id=broker_tls.id)
@@ -200,6 +216,25 @@ def topic(topic_name):
     return topic
 
 
+@pytest.fixture
+def wildcard_topic():
+    # Devices "dev1" and "dev2", each one linked to its own timeseries.
+    decoder = svc_model.PayloadDecoder.register_from_class(
+        decoders.PayloadDecoderBEMServer)
+    topic = svc_model.Topic(
+        name="bemserver/+/device/+/rx", device_segment=3,
+        payload_decoder_id=decoder.id)
+    topic.save()
+    for device in ("dev1", "dev2",):
+        for payload_field in decoder.fields:
+            ts = core_model.Timeseries(
+                name=f"Timeseries {device} {payload_field.name}")
+            db.session.add(ts)
+            db.session.commit()
+            topic.add_device_link(device, payload_field.id, ts.id)
+    return topic
+
+
 @pytest.fixture
 def publisher(topic_name):
     pub_cli = mqttc.Client(
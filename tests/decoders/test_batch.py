@@ -0,0 +1,159 @@
+"""Batch decoding tests"""
+
+import pytest
+import json
+import datetime as dt
+import sqlalchemy as sqla
+
+from bemserver_core.database import db
+from bemserver_core.model import TimeseriesData
+from bemserver_service_acquisition_mqtt import decoders, ingestion
+from bemserver_service_acquisition_mqtt.decoders.batch import (
+    parse_timestamps_array)
+from bemserver_service_acquisition_mqtt.decoders.timestamps import (
+    parse_timestamps_epoch_us)
+from bemserver_service_acquisition_mqtt.exceptions import PayloadDecoderError
+
+
+np = pytest.importorskip("numpy")
+
+
+def _bemserver_payload(timestamp, value):
+    return json.dumps({"ts": timestamp.isoformat(), "value": value}).encode()
+
+
+class TestBatchDecoding:
+
+    def test_batch_parse_timestamps_array(self):
+
+        timestamps = [
+            "2021-05-03T17:28:55.041898Z",
+            "2021-05-03T17:28:55Z",
+            "2021-05-03T17:28:55.041898123Z",
+            "2021-05-03T17:28:55.041+00:00",
+        ]
+        epoch_us = parse_timestamps_array(timestamps)
+        assert epoch_us.dtype == np.int64
+        assert epoch_us.tolist() == parse_timestamps_epoch_us(timestamps)
+
+        # Other time zones are parsed one by one.
+        timestamps.append("2021-05-03T19:28:55+02:00")
+        epoch_us = parse_timestamps_array(timestamps)
+        assert epoch_us.tolist() == parse_timestamps_epoch_us(timestamps)
+        assert epoch_us[-1] == epoch_us[1]
+        # As are timestamps without time zone (UTC).
+        timestamps.append("2021-05-03T17:28:55")
+        epoch_us = parse_timestamps_array(timestamps)
+        assert epoch_us[-1] == epoch_us[1]
+
+        assert parse_timestamps_array([]).tolist() == []
+        for invalid_timestamps in (
+                ["2021-05-03T17:28:55Z", "Z"],
+                ["2021-05-03T25:28:55Z"],
+                ["2021-05-03T17:28:55+25:00"],):
+            with pytest.raises(PayloadDecoderError):
+                parse_timestamps_array(invalid_timestamps)
+
+    def test_batch_decode_bemserver(self):
+
+        decoder = decoders.PayloadDecoderBEMServer(None)
+        start_dt = dt.datetime(2021, 1, 1, tzinfo=dt.timezone.utc)
+        payloads = [
+            _bemserver_payload(start_dt + dt.timedelta(seconds=i), i / 2)
+            for i in range(10)
+        ]
+        # Invalid payloads are skipped.
+        payloads.insert(3, b"not JSON")
+        payloads.insert(5, b'{"value": 1}')
+        payloads.insert(7, b'{"ts": "2021-01-01T00:00:00Z", "value": "a"}')
+        payloads.insert(9, b'{"ts": "yesterday", "value": 1}')
+
+        batch = decoder.decode_batch(payloads)
+        assert isinstance(batch, decoders.batch.DecodedBatch)
+        assert batch.timestamps.dtype == np.int64
+        assert batch.field_indexes.dtype == np.int32
+        assert batch.values.dtype == np.float64
+        start_us = decoders.timestamps.to_epoch_us(start_dt)
+        assert batch.timestamps.tolist() == [
+            start_us + i * 1000000 for i in range(10)]
+        assert batch.field_indexes.tolist() == [0] * 10
+        assert batch.values.tolist() == [i / 2 for i in range(10)]
+
+        batch = decoder.decode_batch([])
+        assert len(batch.timestamps) == len(batch.values) == 0
+
+    def test_batch_decode_chirpstack(self):
+
+        decoder = decoders.PayloadDecoderChirpstackEM300TH868(None)
+        payloads = [
+            json.dumps({
+                "rxInfo": [{"time": "2021-05-03T17:28:55.041898Z"}],
+                "objectJSON": {"humidity": 40, "temperature": 21.5},
+            }),
+            # Missing field
+            json.dumps({
+                "rxInfo": [{"time": "2021-05-03T17:29:55.041898Z"}],
+                "objectJSON": json.dumps({"temperature": 22}),
+            }),
+        ]
+        batch = decoder.decode_batch(payloads)
+        ts_1, ts_2 = parse_timestamps_epoch_us(
+            ["2021-05-03T17:28:55.041898Z", "2021-05-03T17:29:55.041898Z"])
+        assert batch.timestamps.tolist() == [ts_1, ts_1, ts_2]
+        assert batch.field_indexes.tolist() == [0, 1, 0]
+        assert batch.values.tolist() == [21.5, 40.0, 22.0]
+
+    def test_batch_decode_generic(self, decoder_mosquitto_uptime):
+
+        # Decoder decoding payloads one by one (no raw timestamp).
+        decoder_cls, _ = decoder_mosquitto_uptime
+        decoder = decoder_cls(None)
+        ts_before = decoders.timestamps.to_epoch_us(
+            dt.datetime.now(dt.timezone.utc))
+        batch = decoder.decode_batch([b"754369 seconds", b"754370 seconds"])
+        assert batch.values.tolist() == [754369.0, 754370.0]
+        assert batch.field_indexes.tolist() == [0, 0]
+        assert (batch.timestamps >= ts_before).all()
+
+    @pytest.mark.parametrize(
+        "writer_cls", (
+            ingestion.TimeseriesDataWriterInsert,
+            ingestion.TimeseriesDataWriterCopyCSV,
+            ingestion.TimeseriesDataWriterCopyBinary,
+        ))
+    def test_batch_save(self, database, topic, writer_cls):
+
+        decoder = decoders.PayloadDecoderBEMServer(topic)
+        decoder.compile()
+        start_dt = dt.datetime(2021, 1, 1, tzinfo=dt.timezone.utc)
+        payloads = [
+            _bemserver_payload(start_dt + dt.timedelta(hours=i), float(i))
+            for i in range(10)
+        ]
+        assert decoder.save_batch(payloads, writer=writer_cls()) == 10
+        # Values already in database are skipped.
+        assert decoder.save_batch(payloads, writer=writer_cls()) == 0
+
+        timeseries_id = topic.links[0].timeseries_id
+        stmt = sqla.select(TimeseriesData)
+        stmt = stmt.filter(TimeseriesData.timeseries_id == timeseries_id)
+        stmt = stmt.order_by(TimeseriesData.timestamp)
+        tsdatas = [x[0] for x in db.session.execute(stmt).all()]
+        assert [x.timestamp for x in tsdatas] == [
+            start_dt + dt.timedelta(hours=i) for i in range(10)]
+        assert [x.value for x in tsdatas] == [float(i) for i in range(10)]
+
+    def test_batch_timeseries_arrays(self, database, topic):
+
+        decoder = decoders.PayloadDecoderBEMServer(topic)
+        decoder.compile()
+        batch = decoders.batch.make_batch([10, 20], [0, 0], [1.0, 2.0])
+        timeseries_ids, timestamps, values = decoder.timeseries_arrays(batch)
+        assert timeseries_ids.tolist() == [topic.links[0].timeseries_id] * 2
+        assert timestamps.tolist() == [10, 20]
+        assert values.tolist() == [1.0, 2.0]
+
+        # Unlinked fields are dropped.
+        decoder.links = ()
+        timeseries_ids, timestamps, values = decoder.timeseries_arrays(batch)
+        assert len(timeseries_ids) == len(timestamps) == len(values) == 0
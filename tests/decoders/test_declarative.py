@@ -0,0 +1,109 @@
+"""Declarative decoders tests"""
+
+import pytest
+import json
+import datetime as dt
+
+from bemserver_service_acquisition_mqtt import decoders
+from bemserver_service_acquisition_mqtt.decoders.declarative import (
+    parse_path, compile_extractor, make_decoder_cls)
+from bemserver_service_acquisition_mqtt.exceptions import PayloadDecoderError
+
+
+class TestDeclarativeDecoders:
+
+    def test_declarative_parse_path(self):
+
+        assert parse_path("value") == ("value",)
+        assert parse_path("rxInfo.0.time") == ("rxInfo", 0, "time")
+        # Quoted numeric keys, non ASCII digits keys.
+        assert parse_path('data."0".value') == ("data", "0", "value")
+        assert parse_path('"1"') == ("1",)
+        assert parse_path("m²") == ("m²",)
+        assert parse_path("²") == ("²",)
+        for invalid_path in (
+                "", "rxInfo..time", ".value", "value.", 'data."".value'):
+            with pytest.raises(ValueError):
+                parse_path(invalid_path)
+
+    def test_declarative_compile_extractor(self):
+
+        keys, extract = compile_extractor(
+            "ts", [("value", None, "float"), ("state", "data.0", "int")])
+        assert keys == ("ts", "value", "data")
+        assert extract({"ts": "2021", "value": "4.5", "data": [1.0]}) == (
+            "2021", {"value": 4.5, "state": 1})
+        # Missing and invalid values are skipped.
+        assert extract({"ts": "2021", "value": "a", "data": []}) == (
+            "2021", {})
+        # Embedded JSON document is decoded.
+        assert extract({"ts": "2021", "data": "[3]"}) == (
+            "2021", {"state": 3})
+        # int truncates numbers, integer strings only.
+        assert extract({"ts": "2021", "data": [21.9]}) == (
+            "2021", {"state": 21})
+        assert extract({"ts": "2021", "data": ["21"]}) == (
+            "2021", {"state": 21})
+        assert extract({"ts": "2021", "data": ["21.5"]}) == ("2021", {})
+
+        # Numeric keys are quoted.
+        keys, extract = compile_extractor(
+            '"0"', [("value", 'data."1"', "float")])
+        assert keys == ("0", "data")
+        assert extract({"0": "2021", "data": {"1": 4.5}}) == (
+            "2021", {"value": 4.5})
+
+        # Paths are quoted, not evaluated.
+        keys, extract = compile_extractor(
+            "ts", [("x", "a'] + __import__('os').getcwd() + ['", "float")])
+        assert extract({"ts": "2021", "a": {}}) == ("2021", {})
+
+        with pytest.raises(ValueError):
+            compile_extractor("ts", [("value", None, "complex")])
+        with pytest.raises(ValueError):
+            compile_extractor("0.ts", [])
+
+    def test_declarative_decoder_chirpstack(self):
+
+        # Same as Chirpstack ARF8200AA decoder.
+        decoder_cls = make_decoder_cls(
+            "declarative_ARF8200AA", "rxInfo.0.time",
+            [
+                ("channelA", "objectJSON.channelA.value", "float"),
+                ("channelB", "objectJSON.channelB.value", "float"),
+            ],
+            description="Declarative ARF8200AA decoder")
+        assert decoder_cls.fields == ["channelA", "channelB"]
+        assert decoder_cls.description == "Declarative ARF8200AA decoder"
+        decoder = decoder_cls(None)
+        chirpstack_decoder = decoders.PayloadDecoderChirpstackARF8200AA(None)
+
+        payload = json.dumps({
+            "rxInfo": [{"time": "2021-05-03T17:28:55.041898Z"}],
+            "txInfo": {"frequency": 868100000},
+            "objectJSON": json.dumps({
+                "channelA": {"unit": "mA", "value": 4.126},
+                "channelB": {"unit": "mA", "value": 4.131},
+            }),
+        })
+        ts, values = decoder._decode(payload)
+        assert ts == dt.datetime(
+            2021, 5, 3, 17, 28, 55, 41898, tzinfo=dt.timezone.utc)
+        assert values == {"channelA": 4.126, "channelB": 4.131}
+        assert (ts, values) == chirpstack_decoder._decode(payload)
+
+        with pytest.raises(PayloadDecoderError):
+            decoder._decode('{"objectJSON": {}}')
+        with pytest.raises(PayloadDecoderError):
+            decoder._decode('{"rxInfo": [{"time": "now"}]}')
+
+    def test_declarative_decoder_register(self):
+
+        decoder_cls = make_decoder_cls(
+            "declarative_test", "ts", [("value", None, "float")])
+        decoders.register_payload_decoder_cls(decoder_cls)
+        try:
+            assert decoders.get_payload_decoder_cls(
+                "declarative_test") == decoder_cls
+        finally:
+            del decoders._PAYLOAD_DECODERS["declarative_test"]
@@ -5,10 +5,11 @@ import json
 import time
 import datetime as dt
 import sqlalchemy as sqla
+import paho.mqtt.client as mqttc
 
 from bemserver_core.database import db
 from bemserver_core.model import TimeseriesData
-from bemserver_service_acquisition_mqtt import decoders
+from bemserver_service_acquisition_mqtt import decoders, metrics
 from bemserver_service_acquisition_mqtt.exceptions import (
     PayloadDecoderNotFoundError)
 
@@ -79,6 +80,29 @@ class TestDecoders:
         assert tsdata.timeseries_id in [
             x.timeseries_id for x in mosquitto_topic.links]
 
+    @pytest.mark.parametrize("decoder_cls, payload", (
+        # Missing timestamp.
+        (decoders.PayloadDecoderBEMServer, {"value": 1}),
+        # Missing reception info, or empty.
+        (decoders.PayloadDecoderChirpstackEM300TH868, {"objectJSON": {}}),
+        (
+            decoders.PayloadDecoderChirpstackEM300TH868,
+            {"rxInfo": [], "objectJSON": {}},
+        ),
+    ))
+    def test_decoder_on_message_invalid(self, decoder_cls, payload):
+
+        decoder = decoder_cls(None)
+        msg = mqttc.MQTTMessage(topic=b"bemserver/invalid")
+        msg.payload = json.dumps(payload).encode()
+        failures = metrics.DECODE_FAILURES.labels(decoder.name)
+        nb_failures = failures.value
+
+        # Invalid payloads are counted, not raised in MQTT network thread.
+        decoder.on_message(None, None, msg)
+        assert failures.value == nb_failures + 1
+        assert decoder.timestamp_last_reception is not None
+
     def test_decoder_bemserver_decode(self):
 
         bemserver_decoder = decoders.PayloadDecoderBEMServer(None)
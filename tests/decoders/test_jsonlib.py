@@ -0,0 +1,75 @@
+"""JSON decoding tests"""
+
+import json
+
+import pytest
+
+from bemserver_service_acquisition_mqtt.decoders import jsonlib
+from bemserver_service_acquisition_mqtt.exceptions import (
+    PayloadDecoderError, JSONBackendNotFoundError)
+
+
+@pytest.fixture(params=list(jsonlib._JSON_BACKENDS))
+def json_backend(request):
+    backend_name = jsonlib.get_backend()
+    jsonlib.set_backend(request.param)
+    yield request.param
+    jsonlib.set_backend(backend_name)
+
+
+class TestJSONLib:
+
+    def test_jsonlib_backend(self):
+
+        backend_name = jsonlib.get_backend()
+        assert backend_name in jsonlib._JSON_BACKENDS
+        jsonlib.set_backend("json")
+        assert jsonlib.get_backend() == "json"
+        with pytest.raises(JSONBackendNotFoundError):
+            jsonlib.set_backend("unknown")
+        assert jsonlib.get_backend() == "json"
+        # Fastest backend is used by default.
+        jsonlib.set_backend()
+        assert jsonlib.get_backend() == backend_name
+
+    def test_jsonlib_loads(self, json_backend):
+
+        assert jsonlib.loads(b'{"value": 4.2}') == {"value": 4.2}
+        assert jsonlib.loads('{"value": 4.2}') == {"value": 4.2}
+        for data in (b'{"value": 4.2', b"\xff", ""):
+            with pytest.raises(PayloadDecoderError):
+                jsonlib.loads(data)
+
+    def test_jsonlib_projection(self, json_backend):
+
+        projection = jsonlib.JSONProjection(("ts", "rxInfo",))
+        payload = {
+            "ts": "2021-05-03T17:28:55Z",
+            "rxInfo": [{"time": "2021-05-03T17:28:55.041898Z"}],
+            "txInfo": {"frequency": 868300000},
+            "data": "AXVkA2cQAQRoUA==",
+        }
+        expected = {"ts": payload["ts"], "rxInfo": payload["rxInfo"]}
+        assert projection(json.dumps(payload).encode()) == expected
+        assert projection(json.dumps(payload, indent=4)) == expected
+        # Missing keys are ignored.
+        assert projection(b'{"value": 1}') == {}
+
+        # Keys text found in string values or nested objects are ignored.
+        payload["name"] = '"ts": "dummy"'
+        payload["txInfo"]["ts"] = "dummy"
+        assert projection(json.dumps(payload)) == expected
+        # Keys found only in nested objects are ignored too.
+        projection = jsonlib.JSONProjection(("ts", "value",))
+        for data in (
+                b'{"ts": "2021", "meta": {"value": 3}}',
+                b'{"meta": [{"value": 3}], "ts": "2021"}',
+                b'{"meta": {"name": "}{", "value": 3}, "ts": "2021"}',
+                b'{"meta": {"name": "a\\"}", "value": 3}, "ts": "2021"}',):
+            assert projection(data) == {"ts": "2021"}
+        assert projection(
+            b'{"meta": {"a": [1, {"b": "]"}]}, "value": 3}') == {"value": 3}
+
+        for data in (b'{"ts": }', b'["ts"]', b"\xff"):
+            with pytest.raises(PayloadDecoderError):
+                projection(data)
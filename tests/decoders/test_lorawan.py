@@ -0,0 +1,89 @@
+"""Binary LoRaWAN frames decoders tests"""
+
+import pytest
+import json
+import base64
+import struct
+import datetime as dt
+
+from bemserver_service_acquisition_mqtt import decoders
+from bemserver_service_acquisition_mqtt.exceptions import PayloadDecoderError
+
+
+def _uplink(frame):
+    return json.dumps({
+        "rxInfo": [{"time": "2021-05-03T17:28:55.041898Z"}],
+        "data": base64.b64encode(frame).decode(),
+    })
+
+
+class TestLoRaWANDecoders:
+
+    def test_lorawan_decoder_get_cls(self):
+
+        for decoder_cls in (
+                decoders.PayloadDecoderChirpstackFrameARF8200AA,
+                decoders.PayloadDecoderChirpstackFrameEM300TH868,
+                decoders.PayloadDecoderChirpstackFrameUC11,):
+            assert decoders.get_payload_decoder_cls(
+                decoder_cls.name) == decoder_cls
+
+    @pytest.mark.parametrize(
+        "decoder_cls", (
+            decoders.PayloadDecoderChirpstackFrameEM300TH868,
+            decoders.PayloadDecoderChirpstackFrameUC11,
+        ))
+    def test_lorawan_decoder_milesight(self, decoder_cls):
+
+        decoder = decoder_cls(None)
+        assert decoder.fields == ["temperature", "humidity", "battery"]
+
+        # Battery 100%, temperature 27.2°C, humidity 46.5%
+        frame = bytes.fromhex("0175640367100104685d")
+        ts, values = decoder._decode(_uplink(frame))
+        assert ts == dt.datetime(
+            2021, 5, 3, 17, 28, 55, 41898, tzinfo=dt.timezone.utc)
+        assert values == {
+            "battery": 100, "temperature": 27.2, "humidity": 46.5}
+
+        # Negative temperature, without battery.
+        frame = bytes.fromhex("0367f6ff")
+        _, values = decoder._decode(_uplink(frame))
+        assert values == {"temperature": -1.0}
+
+        # Device information (after power on) and history are skipped,
+        #  temperature alarm is read.
+        frame = bytes.fromhex(
+            "ff0bff" "ff0101" "ff166136b02709601234" "ff090110" "ff0a0102"
+            "ff0f00" "20ce9e74946110015d" "8367100101" "04685d")
+        _, values = decoder._decode(_uplink(frame))
+        assert values == {"temperature": 27.2, "humidity": 46.5}
+
+        for invalid_frame in (
+                bytes.fromhex("0367f6"),
+                bytes.fromhex("036710010568"),
+                bytes.fromhex("03"),):
+            with pytest.raises(PayloadDecoderError):
+                decoder._decode(_uplink(invalid_frame))
+        with pytest.raises(PayloadDecoderError):
+            decoder._decode('{"rxInfo": [], "data": "not base64!"}')
+        with pytest.raises(PayloadDecoderError):
+            decoder._decode('{"rxInfo": []}')
+
+    def test_lorawan_decoder_arf8200aa(self):
+
+        decoder = decoders.PayloadDecoderChirpstackFrameARF8200AA(None)
+        assert decoder.fields == ["channelA", "channelB"]
+
+        frame = struct.pack(">BBBfBf", 0x42, 0x20, 0x01, 4.126, 0x01, 4.131)
+        ts, values = decoder._decode(_uplink(frame))
+        assert ts == dt.datetime(
+            2021, 5, 3, 17, 28, 55, 41898, tzinfo=dt.timezone.utc)
+        assert values == {"channelA": 4.126, "channelB": 4.131}
+
+        # Keep alive frame
+        _, values = decoder._decode(_uplink(bytes.fromhex("3020")))
+        assert values == {}
+
+        with pytest.raises(PayloadDecoderError):
+            decoder._decode(_uplink(frame[:-1]))
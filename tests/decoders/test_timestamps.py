@@ -0,0 +1,62 @@
+"""Timestamps parsing tests"""
+
+import datetime as dt
+
+import pytest
+
+from bemserver_service_acquisition_mqtt.decoders.timestamps import (
+    parse_timestamp, parse_timestamps_epoch_us, to_epoch_us)
+from bemserver_service_acquisition_mqtt.exceptions import PayloadDecoderError
+
+
+class TestTimestamps:
+
+    @pytest.mark.parametrize("timestamp", (
+        "2021-05-03T17:28:55.041898Z",
+        "2021-05-03T17:28:55.041898+00:00",
+        "2021-05-03T17:28:55.041898z",
+        "2021-05-03T17:28:55.041898123Z",
+        "2021-05-03T19:28:55.041898+0200",
+        "2021-05-03 17:28:55.041898Z",
+    ))
+    def test_timestamps_parse(self, timestamp):
+        assert parse_timestamp(timestamp) == dt.datetime(
+            2021, 5, 3, 17, 28, 55, 41898, tzinfo=dt.timezone.utc)
+
+    def test_timestamps_parse_fraction(self):
+        expected = dt.datetime(2021, 5, 3, 17, 28, 55, tzinfo=dt.timezone.utc)
+        assert parse_timestamp("2021-05-03T17:28:55Z") == expected
+        for fraction, microseconds in (
+                ("4", 400000), ("04", 40000), ("041", 41000),
+                ("0418", 41800), ("041898", 41898), ("0418989", 41898)):
+            assert parse_timestamp(f"2021-05-03T17:28:55.{fraction}Z") == (
+                expected + dt.timedelta(microseconds=microseconds))
+
+        # Timestamps without time zone are in UTC.
+        assert parse_timestamp("2021-05-03T17:28:55") == expected
+        assert parse_timestamp("2021-05-03T17:28:55.4") == (
+            expected + dt.timedelta(microseconds=400000))
+
+    @pytest.mark.parametrize("timestamp", (
+        "", "now", "2021-13-03T17:28:55Z", "2021-05-03T25:28:55Z", None, 42,
+    ))
+    def test_timestamps_parse_invalid(self, timestamp):
+        with pytest.raises(PayloadDecoderError):
+            parse_timestamp(timestamp)
+
+    def test_timestamps_epoch_us(self):
+        timestamps = [
+            "1970-01-01T00:00:00Z",
+            "2021-05-03T17:28:55.041898Z",
+            "2021-05-03T19:28:55.041898+02:00",
+        ]
+        assert parse_timestamps_epoch_us(timestamps) == [
+            0, 1620062935041898, 1620062935041898]
+        assert parse_timestamps_epoch_us([]) == []
+        assert to_epoch_us(parse_timestamp(timestamps[1])) == 1620062935041898
+
+        # Same rule as one by one: UTC if no time zone.
+        assert parse_timestamps_epoch_us(["2021-05-03T17:28:55.041898"]) == [
+            1620062935041898]
+        with pytest.raises(PayloadDecoderError):
+            parse_timestamps_epoch_us(["invalid"])
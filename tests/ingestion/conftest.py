@@ -0,0 +1,26 @@
+"""Ingestion conftest"""
+
+import sqlalchemy as sqla
+from bemserver_core.database import db
+from bemserver_core.model import Timeseries, TimeseriesData
+
+import pytest
+
+
+@pytest.fixture
+def timeseries(database):
+    ts = Timeseries(name="Timeseries ingestion test")
+    db.session.add(ts)
+    db.session.commit()
+    return ts
+
+
+@pytest.fixture
+def get_tsdata(database):
+    """Get data of a timeseries from database, ordered by timestamp."""
+    def _get_tsdata(timeseries_id):
+        stmt = sqla.select(TimeseriesData)
+        stmt = stmt.filter(TimeseriesData.timeseries_id == timeseries_id)
+        stmt = stmt.order_by(TimeseriesData.timestamp)
+        return [x[0] for x in db.session.execute(stmt).all()]
+    return _get_tsdata
@@ -0,0 +1,115 @@
+"""Timeseries data buffer tests"""
+
+import time
+import pytest
+import datetime as dt
+
+from bemserver_service_acquisition_mqtt.ingestion import (
+    TimeseriesDataBuffer, TimeseriesDataWriterCopyBinary)
+
+
+class TestTimeseriesDataBuffer:
+
+    def test_buffer_flush(self, database, timeseries, get_tsdata):
+
+        with pytest.raises(ValueError):
+            TimeseriesDataBuffer(max_size=0)
+        with pytest.raises(ValueError):
+            TimeseriesDataBuffer(max_age=0)
+
+        buffer = TimeseriesDataBuffer()
+        assert not buffer.is_running
+        assert len(buffer) == 0
+        assert buffer.flush() == 0
+
+        start_dt = dt.datetime(2021, 1, 1, tzinfo=dt.timezone.utc)
+        buffer.extend([
+            (timeseries.id, start_dt + dt.timedelta(hours=i), float(i))
+            for i in range(5)
+        ])
+        assert len(buffer) == 5
+        assert len(get_tsdata(timeseries.id)) == 0
+
+        assert buffer.flush() == 5
+        assert len(buffer) == 0
+        assert len(get_tsdata(timeseries.id)) == 5
+
+        stats = buffer.stats
+        assert stats["flush_count"] == 1
+        assert stats["values_written"] == 5
+        assert stats["values_skipped"] == 0
+        assert stats["values_failed"] == 0
+        assert stats["last_flush_size"] == 5
+        assert stats["last_flush_duration"] > 0
+        assert stats["max_flush_duration"] == stats["last_flush_duration"]
+
+    def test_buffer_thresholds(self, database, timeseries, get_tsdata):
+
+        start_dt = dt.datetime(2021, 1, 1, tzinfo=dt.timezone.utc)
+        buffer = TimeseriesDataBuffer(max_size=10, max_age=0.5)
+        buffer.start()
+        assert buffer.is_running
+
+        # Size threshold reached: values are flushed right away.
+        buffer.extend([
+            (timeseries.id, start_dt + dt.timedelta(hours=i), float(i))
+            for i in range(10)
+        ])
+        time.sleep(0.2)
+        assert len(buffer) == 0
+        assert len(get_tsdata(timeseries.id)) == 10
+
+        # Below size threshold: values are flushed after max age.
+        buffer.extend([
+            (timeseries.id, start_dt + dt.timedelta(hours=10), 10.0)])
+        time.sleep(0.1)
+        assert len(buffer) == 1
+        time.sleep(0.6)
+        assert len(buffer) == 0
+        assert len(get_tsdata(timeseries.id)) == 11
+
+        # Remaining values are flushed when stopping.
+        buffer.extend([
+            (timeseries.id, start_dt + dt.timedelta(hours=11), 11.0)])
+        buffer.stop()
+        assert not buffer.is_running
+        assert len(get_tsdata(timeseries.id)) == 12
+        assert buffer.stats["flush_count"] == 3
+
+    def test_buffer_writer(self, database, timeseries, get_tsdata):
+
+        start_dt = dt.datetime(2021, 1, 1, tzinfo=dt.timezone.utc)
+        buffer = TimeseriesDataBuffer(writer=TimeseriesDataWriterCopyBinary())
+        buffer.extend([
+            (timeseries.id, start_dt + dt.timedelta(hours=i), float(i))
+            for i in range(5)
+        ])
+        assert buffer.flush() == 5
+        assert len(get_tsdata(timeseries.id)) == 5
+
+    def test_buffer_on_conflict(self, database, timeseries, get_tsdata):
+
+        start_dt = dt.datetime(2021, 1, 1, tzinfo=dt.timezone.utc)
+        buffer = TimeseriesDataBuffer()
+        buffer.extend([(timeseries.id, start_dt, 1.0)])
+        assert buffer.flush() == 1
+
+        # Duplicate values are skipped (and counted), not failed.
+        buffer.extend([
+            (timeseries.id, start_dt, 2.0),
+            (timeseries.id, start_dt + dt.timedelta(hours=1), 2.0),
+        ])
+        assert len(buffer) == 2
+        assert buffer.flush() == 1
+        assert buffer.stats["values_skipped"] == 1
+        assert buffer.stats["values_failed"] == 0
+        assert [x.value for x in get_tsdata(timeseries.id)] == [1.0, 2.0]
+
+        # Or updated, depending on on conflict action.
+        buffer.extend([(timeseries.id, start_dt, 3.0)], on_conflict="update")
+        buffer.extend([
+            (timeseries.id, start_dt + dt.timedelta(hours=1), 3.0)])
+        assert len(buffer) == 2
+        assert buffer.flush() == 1
+        assert buffer.stats["values_skipped"] == 2
+        assert [x.value for x in get_tsdata(timeseries.id)] == [3.0, 2.0]
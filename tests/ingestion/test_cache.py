@@ -0,0 +1,154 @@
+"""Timeseries last timestamp cache tests"""
+
+import json
+import pytest
+import datetime as dt
+import sqlalchemy as sqla
+import paho.mqtt.client as mqttc
+
+from bemserver_core.database import db
+from bemserver_core.model import TimeseriesData
+from bemserver_service_acquisition_mqtt.ingestion import (
+    TimeseriesLastTimestampCache, TimeseriesDataBuffer)
+from bemserver_service_acquisition_mqtt.routing import RoutingTable
+
+
+_START_DT = dt.datetime(2021, 1, 1, tzinfo=dt.timezone.utc)
+
+
+def _row(hours, timeseries_id=1):
+    return (timeseries_id, _START_DT + dt.timedelta(hours=hours), 42.0)
+
+
+class TestTimeseriesLastTimestampCache:
+
+    def test_cache_filter(self):
+
+        cache = TimeseriesLastTimestampCache()
+        assert len(cache) == 0
+        assert cache.get(1) is None
+
+        rows = [_row(1), _row(2), _row(0, timeseries_id=2)]
+        assert cache.filter(rows, on_conflict="nothing") == rows
+        assert len(cache) == 2
+        assert cache.get(1) == _row(2)[1]
+
+        # Retained and redelivered values not newer are suppressed.
+        assert cache.filter(
+            [_row(2), _row(3)], on_conflict="nothing", retain=True) == [
+                _row(3)]
+        assert cache.filter([_row(1)], on_conflict="nothing", dup=True) == []
+        # Live values are suppressed only when duplicate (late values kept).
+        assert cache.filter([_row(3)], on_conflict="nothing") == []
+        assert cache.filter([_row(1)], on_conflict="nothing") == [_row(1)]
+        # Values to overwrite are never suppressed.
+        assert cache.filter(
+            [_row(3)], on_conflict="update", retain=True) == [_row(3)]
+
+        assert cache.stats == {
+            "values_passed": 6,
+            "suppressed_retained": 1,
+            "suppressed_redelivered": 1,
+            "suppressed_duplicate": 1,
+        }
+
+    def test_cache_forget(self):
+
+        cache = TimeseriesLastTimestampCache()
+        cache.filter(
+            [_row(2), _row(1, timeseries_id=2)], on_conflict="nothing")
+
+        # Older value lost: last timestamp (other value) kept.
+        assert cache.forget([_row(3), _row(0, timeseries_id=3)]) == 0
+        assert cache.forget([_row(1)]) == 1
+        assert cache.get(1) is None
+        assert cache.get(2) == _row(1)[1]
+        # Value lost is not dropped when sent again.
+        assert cache.filter(
+            [_row(2)], on_conflict="nothing", retain=True) == [_row(2)]
+
+    def test_cache_buffer_write_failure(self):
+
+        class FailingWriter:
+            name = "failing"
+
+            def write(self, rows, **kwargs):
+                raise ConnectionError("Database is down")
+
+        cache = TimeseriesLastTimestampCache()
+        buffer = TimeseriesDataBuffer(
+            writer=FailingWriter(), timestamp_cache=cache)
+        buffer.extend(cache.filter([_row(1)], on_conflict="nothing"))
+        assert cache.get(1) == _row(1)[1]
+        assert buffer.flush() == 0
+        assert buffer.stats["values_failed"] == 1
+
+        # Value lost (no spool): written when redelivered.
+        assert cache.get(1) is None
+        assert cache.filter(
+            [_row(1)], on_conflict="nothing", dup=True) == [_row(1)]
+
+    @pytest.mark.parametrize(
+        "timeseries_data", ({"nb_ts": 2, "nb_tsd": 10},), indirect=True)
+    def test_cache_seed(self, timeseries_data):
+
+        (ts_id_1, nb_tsd, start_dt, _), (ts_id_2, _, _, _) = timeseries_data
+        last_dt = start_dt + dt.timedelta(hours=nb_tsd - 1)
+
+        cache = TimeseriesLastTimestampCache()
+        assert cache.seed([]) == 0
+        assert cache.seed([ts_id_1, 666]) == 1
+        assert cache.get(ts_id_1) == last_dt
+        assert cache.get(ts_id_2) is None
+        assert cache.seed() == 2
+        assert cache.get(ts_id_2) == last_dt
+
+        assert cache.filter(
+            [(ts_id_1, last_dt, 0.0)], on_conflict="nothing",
+            retain=True) == []
+
+    def test_cache_decoder(self, database, topic):
+
+        cache = TimeseriesLastTimestampCache()
+        routing_table = RoutingTable.compile([topic], timestamp_cache=cache)
+        decoder = routing_table.get(topic.name).decoder
+        assert decoder.timestamp_cache is cache
+        ts_id = topic.links[0].timeseries_id
+
+        decoder._save_to_db(_START_DT, {"value": 42})
+        # Retained message received again (reconnection): no database work.
+        decoder._save_to_db(_START_DT, {"value": 42}, retain=True)
+        assert cache.stats["suppressed_retained"] == 1
+
+        stmt = sqla.select(TimeseriesData)
+        stmt = stmt.filter(TimeseriesData.timeseries_id == ts_id)
+        rows = db.session.execute(stmt).all()
+        assert len(rows) == 1
+
+    def test_cache_decoder_naive_timestamp(self, database, topic):
+
+        cache = TimeseriesLastTimestampCache()
+        routing_table = RoutingTable.compile([topic], timestamp_cache=cache)
+        decoder = routing_table.get(topic.name).decoder
+        ts_id = topic.links[0].timeseries_id
+        decoder._save_to_db(_START_DT, {"value": 42})
+        # Aware last timestamp, from database.
+        cache = TimeseriesLastTimestampCache()
+        assert cache.seed([ts_id]) == 1
+        decoder.timestamp_cache = cache
+
+        # Payload timestamps without offset are in UTC.
+        for hours, value in ((0, 42), (1, 43)):
+            msg = mqttc.MQTTMessage(topic=topic.name.encode())
+            msg.payload = json.dumps({
+                "ts": _row(hours)[1].replace(tzinfo=None).isoformat(),
+                "value": value,
+            }).encode()
+            msg.retain = True
+            decoder.on_message(None, None, msg)
+        assert cache.stats["suppressed_retained"] == 1
+        assert cache.get(ts_id) == _row(1)[1]
+
+        stmt = sqla.select(TimeseriesData)
+        stmt = stmt.filter(TimeseriesData.timeseries_id == ts_id)
+        assert len(db.session.execute(stmt).all()) == 2
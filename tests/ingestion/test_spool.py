@@ -0,0 +1,268 @@
+"""Timeseries data spool tests"""
+
+import time
+import pytest
+import datetime as dt
+
+from bemserver_service_acquisition_mqtt.ingestion import (
+    TimeseriesDataSpool, TimeseriesDataBuffer)
+from bemserver_service_acquisition_mqtt.ingestion.spool import (
+    SEGMENT_SUFFIX)
+
+
+_EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+_START_DT = dt.datetime(2021, 1, 1, tzinfo=dt.timezone.utc)
+# Segment header and 100 records.
+_SEGMENT_SIZE = 24 + 21 * 100
+
+
+class FakeWriter:
+    """Collects written values, or fails as a database down."""
+
+    name = "fake"
+
+    def __init__(self):
+        self.rows = []
+        self.is_down = False
+
+    def write(self, rows, *, on_conflict="nothing", connection=None):
+        if self.is_down:
+            raise ConnectionError("Database is down")
+        self.rows.extend(
+            (ts_id, timestamp, value, on_conflict)
+            for ts_id, timestamp, value in rows)
+        return len(rows)
+
+    def write_arrays(self, timeseries_ids, timestamps, values, *,
+                     on_conflict="nothing", connection=None):
+        return self.write([
+            (
+                ts_id, _EPOCH + dt.timedelta(microseconds=timestamp),
+                None if value != value else value,
+            )
+            for ts_id, timestamp, value in zip(
+                timeseries_ids.tolist(), timestamps.tolist(),
+                values.tolist())
+        ], on_conflict=on_conflict, connection=connection)
+
+
+def _rows(start, stop, timeseries_id=1):
+    return [
+        (timeseries_id, _START_DT + dt.timedelta(seconds=i), float(i))
+        for i in range(start, stop)
+    ]
+
+
+class TestTimeseriesDataSpool:
+
+    def test_spool_append_replay(self, tmpdir):
+
+        with pytest.raises(ValueError):
+            TimeseriesDataSpool(str(tmpdir), segment_size=10)
+        with pytest.raises(ValueError):
+            TimeseriesDataSpool(
+                str(tmpdir), segment_size=_SEGMENT_SIZE, max_size=100)
+
+        spool = TimeseriesDataSpool(
+            str(tmpdir), segment_size=_SEGMENT_SIZE,
+            max_size=_SEGMENT_SIZE * 3)
+        assert len(spool) == 0
+        assert spool.append([]) == 0
+
+        assert spool.append(_rows(0, 150)) == 150
+        rows = _rows(150, 160)
+        rows.append((2, _START_DT, None))
+        assert spool.append(rows, on_conflict="update") == 11
+        assert len(spool) == 161
+        assert len(list(tmpdir.listdir(f"*{SEGMENT_SUFFIX}"))) == 2
+
+        # Spool is full: values are dropped.
+        assert spool.append(_rows(1000, 1200)) == 139
+        stats = spool.stats
+        assert stats["values_spooled"] == 300
+        assert stats["values_dropped"] == 61
+        assert stats["values_pending"] == 300
+        assert stats["size"] == _SEGMENT_SIZE * 3
+
+        writer = FakeWriter()
+        assert spool.replay(writer, max_values=120) == 120
+        assert len(spool) == 180
+        assert writer.rows[:120] == [x + ("nothing",) for x in _rows(0, 120)]
+        # Fully replayed segment is deleted.
+        assert len(list(tmpdir.listdir(f"*{SEGMENT_SUFFIX}"))) == 2
+
+        writer.is_down = True
+        assert spool.replay(writer) == 0
+        assert len(spool) == 180
+        assert spool.stats["values_replay_failed"] > 0
+
+        writer.is_down = False
+        assert spool.replay(writer) == 180
+        assert len(spool) == 0
+        assert len(writer.rows) == 300
+        assert [x for x in writer.rows if x[3] == "update"] == [
+            x + ("update",) for x in rows]
+        stats = spool.stats
+        assert stats["values_replayed"] == 300
+        assert stats["replay_count"] == 2
+        assert stats["last_replay_rate"] > 0
+        # Last segment (being written) is kept, to be reused.
+        assert len(list(tmpdir.listdir(f"*{SEGMENT_SUFFIX}"))) == 1
+        assert spool.append(_rows(0, 10)) == 10
+
+    def test_spool_reopen(self, tmpdir):
+
+        spool = TimeseriesDataSpool(str(tmpdir), segment_size=_SEGMENT_SIZE)
+        spool.append(_rows(0, 250))
+        writer = FakeWriter()
+        spool.replay(writer, max_values=50)
+        spool.close()
+
+        # Values not replayed are kept for next run.
+        spool = TimeseriesDataSpool(str(tmpdir), segment_size=_SEGMENT_SIZE)
+        assert len(spool) == 200
+        assert spool.replay(writer) == 200
+        assert [x[:3] for x in writer.rows] == _rows(0, 250)
+
+        # Invalid segment files are set aside.
+        spool.close()
+        tmpdir.join(f"9999999999{SEGMENT_SUFFIX}").write("garbage")
+        spool = TimeseriesDataSpool(str(tmpdir), segment_size=_SEGMENT_SIZE)
+        assert len(spool) == 0
+        assert tmpdir.join("9999999999.corrupt").exists()
+
+    def test_spool_buffer(self, tmpdir):
+
+        spool = TimeseriesDataSpool(str(tmpdir), segment_size=_SEGMENT_SIZE)
+        writer = FakeWriter()
+        writer.is_down = True
+        buffer = TimeseriesDataBuffer(
+            max_size=10, writer=writer, spool=spool, max_pending=20,
+            replay_retry_delay=0.1)
+
+        # Values that can not be written are spooled.
+        buffer.extend(_rows(0, 10))
+        assert buffer.flush() == 0
+        assert len(spool) == 10
+        # Values appended while too many are waiting are spooled.
+        buffer.extend(_rows(10, 30))
+        buffer.extend(_rows(30, 40))
+        assert len(buffer) == 20
+        assert len(spool) == 20
+        stats = buffer.stats
+        assert stats["values_spooled"] == 20
+        assert stats["values_failed"] == 0
+        assert stats["spool_values_pending"] == 20
+
+        # Spooled values are replayed once database is back.
+        writer.is_down = False
+        buffer.start()
+        time.sleep(0.5)
+        buffer.stop()
+        assert len(spool) == 0
+        assert sorted(x[:3] for x in writer.rows) == _rows(0, 40)
+
+    def test_spool_buffer_steady_traffic(self, tmpdir):
+
+        class SlowWriter(FakeWriter):
+            def write(self, rows, **kwargs):
+                time.sleep(0.005)
+                return super().write(rows, **kwargs)
+
+        spool = TimeseriesDataSpool(str(tmpdir), segment_size=_SEGMENT_SIZE)
+        spool.append(_rows(0, 300))
+        writer = SlowWriter()
+        buffer = TimeseriesDataBuffer(
+            max_size=10, max_age=10.0, writer=writer, spool=spool)
+
+        # Buffer is full again at each flush (never idle): spool is replayed
+        #  after flushes.
+        buffer.start()
+        deadline = time.monotonic() + 5.0
+        idx = 1000
+        while len(spool) > 0 and time.monotonic() < deadline:
+            buffer.extend(_rows(idx, idx + 10, timeseries_id=2))
+            idx += 10
+            time.sleep(0.003)
+        buffer.stop()
+        assert len(spool) == 0
+        assert sorted(x[:3] for x in writer.rows if x[0] == 1) == _rows(0, 300)
+
+    def test_spool_buffer_update_order(self, tmpdir):
+
+        spool = TimeseriesDataSpool(str(tmpdir), segment_size=_SEGMENT_SIZE)
+        writer = FakeWriter()
+        buffer = TimeseriesDataBuffer(max_size=10, writer=writer, spool=spool)
+        timestamp = _START_DT
+
+        # A value to update is spooled (database down)...
+        writer.is_down = True
+        buffer.extend([(1, timestamp, 1.0)], on_conflict="update")
+        buffer.flush()
+        assert len(spool) == 1
+
+        # ...then corrected: correction is written after it, through spool.
+        writer.is_down = False
+        buffer.extend([(1, timestamp, 2.0)], on_conflict="update")
+        buffer.extend([(2, timestamp, 3.0)])
+        assert buffer.flush() == 1
+        assert len(spool) == 2
+        assert buffer.replay() == 2
+        assert writer.rows == [
+            (2, timestamp, 3.0, "nothing"),
+            (1, timestamp, 1.0, "update"),
+            (1, timestamp, 2.0, "update"),
+        ]
+
+    def test_spool_buffer_naive_timestamps(self, tmpdir):
+
+        spool = TimeseriesDataSpool(str(tmpdir), segment_size=_SEGMENT_SIZE)
+        writer = FakeWriter()
+        buffer = TimeseriesDataBuffer(
+            max_size=10, writer=writer, spool=spool, max_pending=1)
+
+        # Naive timestamps are in UTC, spooled when appended (too many
+        #  values waiting) or flushed (database down).
+        writer.is_down = True
+        buffer.extend([(1, _START_DT.replace(tzinfo=None), 1.0)])
+        buffer.extend([(2, _START_DT.replace(tzinfo=None), 2.0)])
+        assert buffer.flush() == 0
+        assert len(spool) == 2
+        writer.is_down = False
+        assert buffer.replay() == 2
+        assert writer.rows == [
+            (2, _START_DT, 2.0, "nothing"), (1, _START_DT, 1.0, "nothing")]
+
+    def test_spool_buffer_flush_error(self, tmpdir, monkeypatch):
+
+        spool = TimeseriesDataSpool(str(tmpdir), segment_size=_SEGMENT_SIZE)
+        writer = FakeWriter()
+        writer.is_down = True
+        buffer = TimeseriesDataBuffer(
+            max_size=10, max_age=0.05, writer=writer, spool=spool)
+
+        def append(rows, **kwargs):
+            raise RuntimeError("Spool is broken")
+
+        # Flushing thread survives an unexpected error.
+        monkeypatch.setattr(spool, "append", append)
+        buffer.start()
+        buffer.extend(_rows(0, 10))
+        time.sleep(0.2)
+        monkeypatch.undo()
+        writer.is_down = False
+        buffer.extend(_rows(10, 20))
+        time.sleep(0.2)
+        assert buffer.is_running
+        assert sorted(x[:3] for x in writer.rows) == _rows(10, 20)
+        buffer.stop()
+
+    def test_spool_close_open(self, tmpdir):
+
+        spool = TimeseriesDataSpool(str(tmpdir), segment_size=_SEGMENT_SIZE)
+        spool.append(_rows(0, 10))
+        spool.close()
+        assert len(spool) == 0
+        spool.open()
+        spool.open()
+        assert len(spool) == 10
@@ -0,0 +1,76 @@
+"""Timeseries data writer pool tests"""
+
+import time
+import pytest
+import datetime as dt
+
+from bemserver_service_acquisition_mqtt.ingestion import (
+    TimeseriesDataWriterPool)
+from bemserver_service_acquisition_mqtt.routing import RoutingTable
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.retain = False
+        self.dup = False
+
+
+class TestTimeseriesDataWriterPool:
+
+    def test_writer_pool_extend(self, database, topic, get_tsdata):
+
+        with pytest.raises(ValueError):
+            TimeseriesDataWriterPool(0)
+
+        ts_id = topic.links[0].timeseries_id
+        pool = TimeseriesDataWriterPool(3, buffer_size=10, buffer_max_age=10)
+        assert pool.nb_workers == 3
+        assert not pool.is_running
+        pool.start()
+        assert pool.is_running
+
+        # Values of a timeseries all go to the same worker.
+        start_dt = dt.datetime(2021, 1, 1, tzinfo=dt.timezone.utc)
+        pool.extend([
+            (ts_id, start_dt + dt.timedelta(hours=i), float(i))
+            for i in range(5)
+        ])
+        assert sorted(len(x.buffer) for x in pool._workers) == [0, 0, 5]
+
+        # Full buffer is written by its worker.
+        pool.extend([
+            (ts_id, start_dt + dt.timedelta(hours=i), float(i))
+            for i in range(5, 10)
+        ])
+        time.sleep(0.2)
+        assert len(get_tsdata(ts_id)) == 10
+
+        pool.extend([(ts_id, start_dt + dt.timedelta(hours=10), 10.0)])
+        pool.stop()
+        assert not pool.is_running
+        assert len(get_tsdata(ts_id)) == 11
+        stats = pool.stats
+        assert stats["flush_count"] == 2
+        assert stats["values_written"] == 11
+        assert stats["queue_depths"] == [0, 0, 0]
+
+    def test_writer_pool_submit(self, database, topic, get_tsdata):
+
+        ts_id = topic.links[0].timeseries_id
+        pool = TimeseriesDataWriterPool(2, buffer_size=100, buffer_max_age=10)
+        route = RoutingTable.compile([topic], buffer=pool).get(topic.name)
+        pool.start()
+
+        for i in range(5):
+            msg = FakeMessage(topic.name, (
+                f'{{"ts": "2021-01-01T0{i}:00:00+00:00", "value": {i}}}'
+            ).encode())
+            pool.submit(route, None, None, msg)
+        # Invalid payload does not stop worker.
+        pool.submit(route, None, None, FakeMessage(topic.name, b"invalid"))
+
+        pool.stop()
+        assert [x.value for x in get_tsdata(ts_id)] == [
+            0.0, 1.0, 2.0, 3.0, 4.0]
@@ -0,0 +1,125 @@
+"""Timeseries data writers tests"""
+
+import pytest
+import datetime as dt
+
+from bemserver_service_acquisition_mqtt import ingestion
+from bemserver_service_acquisition_mqtt.exceptions import (
+    TimeseriesDataWriterNotFoundError)
+
+
+class TestTimeseriesDataWriters:
+
+    def test_writer_get_cls(self):
+
+        for writer_cls in (
+                ingestion.TimeseriesDataWriterInsert,
+                ingestion.TimeseriesDataWriterCopyCSV,
+                ingestion.TimeseriesDataWriterCopyBinary,):
+            assert ingestion.get_writer_cls(writer_cls.name) == writer_cls
+
+        with pytest.raises(TimeseriesDataWriterNotFoundError):
+            ingestion.get_writer_cls("orm")
+
+    @pytest.mark.parametrize(
+        "writer_cls", (
+            ingestion.TimeseriesDataWriterInsert,
+            ingestion.TimeseriesDataWriterCopyCSV,
+            ingestion.TimeseriesDataWriterCopyBinary,
+        ))
+    def test_writer_write(
+            self, database, timeseries, writer_cls, get_tsdata):
+
+        start_dt = dt.datetime(2021, 1, 1, tzinfo=dt.timezone.utc)
+        rows = [
+            (timeseries.id, start_dt + dt.timedelta(hours=i), float(i))
+            for i in range(10)
+        ]
+        rows.append((timeseries.id, start_dt + dt.timedelta(hours=10), None))
+
+        writer = writer_cls()
+        assert writer.write([]) == 0
+        assert writer.write(rows) == 11
+        tsdatas = get_tsdata(timeseries.id)
+        assert len(tsdatas) == 11
+        assert [x.timestamp for x in tsdatas] == [x[1] for x in rows]
+        assert [x.value for x in tsdatas[:10]] == [
+            float(i) for i in range(10)]
+        assert tsdatas[10].value is None
+
+        # Duplicate values are skipped in one statement, others are written.
+        rows.append((timeseries.id, start_dt + dt.timedelta(hours=11), 11.0))
+        assert writer.write(rows) == 1
+        assert len(get_tsdata(timeseries.id)) == 12
+
+        with pytest.raises(ValueError):
+            writer.write(rows, on_conflict="explode")
+
+    @pytest.mark.parametrize(
+        "writer_cls", (
+            ingestion.TimeseriesDataWriterInsert,
+            ingestion.TimeseriesDataWriterCopyCSV,
+            ingestion.TimeseriesDataWriterCopyBinary,
+        ))
+    def test_writer_write_on_conflict_update(
+            self, database, timeseries, writer_cls, get_tsdata):
+
+        start_dt = dt.datetime(2021, 1, 1, tzinfo=dt.timezone.utc)
+        rows = [
+            (timeseries.id, start_dt + dt.timedelta(hours=i), float(i))
+            for i in range(3)
+        ]
+        writer = writer_cls()
+        assert writer.write(rows, on_conflict="update") == 3
+
+        # Only values that changed are updated (and counted).
+        rows = [
+            (timeseries.id, start_dt, 0.0),
+            (timeseries.id, start_dt + dt.timedelta(hours=1), 42.0),
+            # Same value twice in batch: last one wins.
+            (timeseries.id, start_dt + dt.timedelta(hours=2), 66.0),
+            (timeseries.id, start_dt + dt.timedelta(hours=2), 69.0),
+        ]
+        assert writer.write(rows, on_conflict="update") == 2
+        tsdatas = get_tsdata(timeseries.id)
+        assert [x.value for x in tsdatas] == [0.0, 42.0, 69.0]
+
+    @pytest.mark.parametrize(
+        "writer_cls", (
+            ingestion.TimeseriesDataWriterInsert,
+            ingestion.TimeseriesDataWriterCopyCSV,
+            ingestion.TimeseriesDataWriterCopyBinary,
+        ))
+    def test_writer_write_arrays(
+            self, database, timeseries, writer_cls, get_tsdata):
+        np = pytest.importorskip("numpy")
+
+        start_dt = dt.datetime(2021, 1, 1, tzinfo=dt.timezone.utc)
+        start_us = int(start_dt.timestamp()) * 1000000
+        hour_us = 3600 * 1000000
+        timeseries_ids = np.full(4, timeseries.id, dtype=np.int64)
+        timestamps = start_us + hour_us * np.arange(4, dtype=np.int64)
+        values = np.array([0.0, 1.0, 2.0, 3.0])
+
+        writer = writer_cls()
+        assert writer.write_arrays([], [], []) == 0
+        assert writer.write_arrays(timeseries_ids, timestamps, values) == 4
+        tsdatas = get_tsdata(timeseries.id)
+        assert [x.timestamp for x in tsdatas] == [
+            start_dt + dt.timedelta(hours=i) for i in range(4)]
+        assert [x.value for x in tsdatas] == [0.0, 1.0, 2.0, 3.0]
+
+        # NaN values are NULL. Same value twice in batch: last one wins.
+        timestamps = np.append(timestamps, [timestamps[0], timestamps[0]])
+        timeseries_ids = np.full(6, timeseries.id, dtype=np.int64)
+        values = np.array([0.0, 1.0, np.nan, 3.0, 66.0, 69.0])
+        assert writer.write_arrays(
+            timeseries_ids, timestamps, values, on_conflict="update") == 2
+        tsdatas = get_tsdata(timeseries.id)
+        assert [x.value for x in tsdatas] == [69.0, 1.0, None, 3.0]
+
+        with pytest.raises(ValueError):
+            writer.write_arrays(timeseries_ids, timestamps[:2], values)
+        with pytest.raises(ValueError):
+            writer.write_arrays(
+                timeseries_ids, timestamps, values, on_conflict="explode")
@@ -5,8 +5,11 @@ import sqlalchemy as sqla
 
 from bemserver_core.database import db
 from bemserver_core.model import Timeseries
+from bemserver_service_acquisition_mqtt import decoders
 from bemserver_service_acquisition_mqtt.model import (
     PayloadDecoder, PayloadField, Topic)
+from bemserver_service_acquisition_mqtt.exceptions import (
+    PayloadDecoderRegistrationError)
 
 
 class TestPayloadDecoderModel:
@@ -80,6 +83,42 @@ class TestPayloadDecoderModel:
         assert [x.name for x in decoder.fields] == (
             decoder_mosquitto_uptime_cls.fields)
 
+    def test_payload_decoder_declarative(self, database):
+
+        decoder = PayloadDecoder(name="declarative_decoder")
+        decoder.save()
+        assert not decoder.is_declarative
+        with pytest.raises(PayloadDecoderRegistrationError):
+            decoder.compile_cls()
+
+        decoder.timestamp_path = "rxInfo.0.time"
+        decoder.save()
+        assert decoder.is_declarative
+        decoder.add_field("channelA", path="objectJSON.channelA.value")
+        decoder.add_field("relay", path="objectJSON.relay", value_type="bool")
+        assert decoder.fields[0].value_type == "float"
+        assert PayloadDecoder.get_declarative_list() == [decoder]
+
+        decoder_cls = decoder.compile_cls()
+        assert issubclass(
+            decoder_cls, decoders.declarative.PayloadDecoderDeclarativeBase)
+        assert decoder_cls.name == decoder.name
+        assert decoder_cls.fields == ["channelA", "relay"]
+        _, values = decoder_cls(None)._decode(
+            '{"rxInfo": [{"time": "2021-05-03T17:28:55Z"}],'
+            ' "objectJSON": {"channelA": {"value": 4.1}, "relay": 0}}')
+        assert values == {"channelA": 4.1, "relay": False}
+
+        with pytest.raises(ValueError):
+            decoder.add_field("invalid", value_type="complex")
+        db.session.rollback()
+        with pytest.raises(ValueError):
+            decoder.add_field("invalid", path="objectJSON..value")
+        db.session.rollback()
+        decoder.timestamp_path = ""
+        with pytest.raises(ValueError):
+            decoder.save()
+
 
 class TestPayloadFieldModel:
 
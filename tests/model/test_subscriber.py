@@ -2,6 +2,7 @@
 
 import time
 import json
+import socket
 import logging
 import pytest
 import datetime as dt
@@ -10,8 +11,9 @@ from pathlib import Path
 
 from bemserver_core.database import db
 from bemserver_core.model import TimeseriesData
+from bemserver_service_acquisition_mqtt import decoders, loopback
 from bemserver_service_acquisition_mqtt.model import (
-    Subscriber, Topic, TopicBySubscriber)
+    Subscriber, Topic, TopicBySubscriber, PayloadDecoder)
 
 
 class TestSubscriberModel:
@@ -145,6 +147,24 @@ class TestSubscriberModel:
         assert not subscriber._client.is_connected()
         assert not subscriber.is_connected
 
+    def test_subscriber_connect_timeout(
+            self, database, subscriber, monkeypatch):
+
+        timeouts = []
+
+        def create_connection(address, timeout=None, source_address=None):
+            # Broker unreachable.
+            timeouts.append(timeout)
+            raise socket.timeout("timed out")
+
+        monkeypatch.setattr(socket, "create_connection", create_connection)
+        with pytest.raises(socket.timeout):
+            subscriber.connect(timeout=5)
+        # Socket connection does not exceed connection timeout (not
+        #  keepalive, 60 s).
+        assert timeouts == [5]
+        assert subscriber._client._keepalive == subscriber.keep_alive
+
     def test_subscriber_on_message(
             self, database, subscriber, client_id, topic, publisher):
 
@@ -265,6 +285,121 @@ class TestSubscriberModel:
         assert not subscriber.is_connected
         assert not topic_by_subscriber.is_subscribed
 
+    def test_subscriber_share_group(
+            self, database, subscriber, topic, publisher):
+
+        topic_by_subscriber = topic.add_subscriber(subscriber.id)
+        assert subscriber.share_group is None
+        assert topic_by_subscriber.share_group is None
+        assert subscriber._subscription_name(topic) == topic.name
+
+        for share_group in ("", "group/1", "group+", "#"):
+            subscriber.share_group = share_group
+            with pytest.raises(ValueError):
+                subscriber._verify_consistency()
+            topic_by_subscriber.share_group = share_group
+            with pytest.raises(ValueError):
+                topic_by_subscriber._verify_consistency()
+        topic_by_subscriber.share_group = None
+
+        subscriber.share_group = "bemserver"
+        subscriber.save()
+        assert subscriber._subscription_name(topic) == (
+            f"$share/bemserver/{topic.name}")
+        # Topic share group overrides subscriber's one.
+        topic_by_subscriber.share_group = "bemserver-topic"
+        topic_by_subscriber.save()
+        assert subscriber._subscription_name(topic) == (
+            f"$share/bemserver-topic/{topic.name}")
+
+        stmt = sqla.select(TimeseriesData)
+        for topic_link in topic.links:
+            stmt = stmt.filter(
+                TimeseriesData.timeseries_id == topic_link.timeseries_id
+            )
+
+        subscriber.use_persistent_session = False
+        subscriber.connect()
+        assert subscriber.is_connected
+        assert topic_by_subscriber.is_subscribed
+        time.sleep(0.5)
+
+        # Retained messages are not sent to shared subscriptions, but new
+        #  messages are received from the real topic and decoded.
+        payload = {
+            "ts": dt.datetime.now(dt.timezone.utc).isoformat(),
+            "value": 666,
+        }
+        msg_info = publisher.publish(
+            topic=topic.name, payload=json.dumps(payload), qos=1)
+        msg_info.wait_for_publish()
+        time.sleep(0.5)
+
+        rows = db.session.execute(stmt).all()
+        assert [x[0].value for x in rows] == [666]
+
+        subscriber.disconnect()
+        assert not subscriber.is_connected
+
+    def test_subscriber_flow_control(
+            self, database, subscriber_loopback, topic):
+
+        subscriber = subscriber_loopback
+        topic.add_subscriber(subscriber.id)
+        assert subscriber.receive_maximum is None
+        assert subscriber.topic_alias_maximum is None
+        assert subscriber.maximum_packet_size is None
+        assert subscriber.max_inflight_messages is None
+        assert subscriber.max_queued_messages is None
+
+        # Save errors.
+        for field_name, value, error in (
+                ("receive_maximum", 0, "receive maximum"),
+                ("receive_maximum", 65536, "receive maximum"),
+                ("topic_alias_maximum", -1, "topic alias maximum"),
+                ("topic_alias_maximum", 65536, "topic alias maximum"),
+                ("maximum_packet_size", 0, "maximum packet size"),
+                ("max_inflight_messages", -1, "max inflight messages"),
+                ("max_queued_messages", -1, "max queued messages"),):
+            setattr(subscriber, field_name, value)
+            with pytest.raises(ValueError) as exc:
+                subscriber._verify_consistency()
+                assert str(exc) == f"Invalid subscriber {error}!"
+            setattr(subscriber, field_name, None)
+
+        subscriber.receive_maximum = 1000
+        subscriber.topic_alias_maximum = 1
+        subscriber.maximum_packet_size = 64 * 1024
+        subscriber.max_inflight_messages = 10
+        subscriber.max_queued_messages = 100
+        subscriber.save()
+
+        # Receive maximum does not exceed messages queue size.
+        messages = []
+        subscriber.connect(
+            on_message=lambda client, userdata, msg: messages.append(msg),
+            receive_maximum=100)
+        assert subscriber.is_connected
+        conn_props = subscriber._connect_kwargs["properties"]
+        assert conn_props.ReceiveMaximum == 100
+        assert conn_props.TopicAliasMaximum == 1
+        assert conn_props.MaximumPacketSize == 64 * 1024
+
+        # Topic names are given back to aliased messages.
+        broker = loopback.get_broker("localhost", 1883)
+        for _ in range(3):
+            assert broker.publish(topic.name, "{}", qos=1) == 1
+        assert [x.topic for x in messages] == [topic.name] * 3
+        assert [x.properties.TopicAlias for x in messages] == [1] * 3
+
+        # Flow control properties are connection settings.
+        assert not subscriber.is_connection_changed
+        subscriber.receive_maximum = 10
+        assert subscriber.is_connection_changed
+
+        subscriber.disconnect()
+        assert not subscriber.is_connected
+
     def test_subscriber_unsubscribe(
             self, database, subscriber, client_id, topic, publisher):
 
@@ -367,3 +502,101 @@ class TestSubscriberModel:
         assert log_filepath.exists()
         with log_filepath.open("r") as logfile:
             assert len(logfile.read()) > 0
+
+    def test_subscriber_subscribe_chunks(
+            self, database, subscriber_loopback, monkeypatch):
+
+        monkeypatch.setattr(
+            "bemserver_service_acquisition_mqtt.model.subscriber."
+            "SUBSCRIPTIONS_CHUNK_SIZE", 2)
+        decoder = PayloadDecoder.register_from_class(
+            decoders.PayloadDecoderBEMServer)
+        topics = []
+        for idx in range(5):
+            topic = Topic(
+                name=f"bemserver/chunks/{idx}", payload_decoder_id=decoder.id)
+            topic.save()
+            topic.add_subscriber(subscriber_loopback.id)
+            topics.append(topic)
+        broker = loopback.get_broker("localhost", 1883)
+
+        statements = []
+
+        def on_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sqla.event.listen(db.engine, "before_cursor_execute", on_execute)
+        try:
+            # 3 SUBSCRIBE packets, one UPDATE each.
+            assert subscriber_loopback.connect(on_message=lambda *args: None)
+        finally:
+            sqla.event.remove(db.engine, "before_cursor_execute", on_execute)
+        assert len([
+            x for x in statements
+            if x.startswith("UPDATE mqtt_topic_by_subscriber")]) == 3
+        assert broker.nb_subscriptions == 5
+        for topic in topics:
+            topic_by_subscriber = TopicBySubscriber.get_by_id(
+                (topic.id, subscriber_loopback.id,))
+            assert topic_by_subscriber.is_subscribed
+            assert topic_by_subscriber.timestamp_last_subscription is not None
+
+        assert subscriber_loopback.unsubscribe(topics[0])
+        assert broker.nb_subscriptions == 4
+        assert subscriber_loopback.unsubscribe_all() == 5
+        assert broker.nb_subscriptions == 0
+        for topic in topics:
+            assert not TopicBySubscriber.get_by_id(
+                (topic.id, subscriber_loopback.id,)).is_subscribed
+        assert subscriber_loopback.subscribe_all() == 5
+        assert broker.nb_subscriptions == 5
+
+        subscriber_loopback.disconnect()
+        assert not subscriber_loopback.is_connected
+        assert broker.nb_subscriptions == 0
+        for topic in topics:
+            assert not TopicBySubscriber.get_by_id(
+                (topic.id, subscriber_loopback.id,)).is_subscribed
+
+    def test_subscriber_sync_subscriptions(
+            self, database, subscriber_loopback):
+
+        decoder = PayloadDecoder.register_from_class(
+            decoders.PayloadDecoderBEMServer)
+        topics = []
+        for idx in range(3):
+            topic = Topic(
+                name=f"bemserver/sync/{idx}", payload_decoder_id=decoder.id)
+            topic.save()
+            topics.append(topic)
+        topics[0].add_subscriber(subscriber_loopback.id)
+        topics[1].add_subscriber(subscriber_loopback.id)
+        broker = loopback.get_broker("localhost", 1883)
+
+        assert not subscriber_loopback.is_connection_changed
+        assert subscriber_loopback.connect(on_message=lambda *args: None)
+        assert not subscriber_loopback.is_connection_changed
+        assert subscriber_loopback.sync_subscriptions() == (0, 0)
+
+        # Only changed subscriptions are sent.
+        topics[1].remove_subscriber(subscriber_loopback.id)
+        topics[2].add_subscriber(subscriber_loopback.id)
+        topics[0].qos = 2
+        topics[0].save()
+        db.session.expire(subscriber_loopback, ["topics"])
+        assert subscriber_loopback.sync_subscriptions() == (2, 1)
+        assert broker.nb_subscriptions == 2
+        assert TopicBySubscriber.get_by_id(
+            (topics[2].id, subscriber_loopback.id,)).is_subscribed
+        assert subscriber_loopback.sync_subscriptions() == (0, 0)
+
+        # Shared subscription: topic filter changes.
+        subscriber_loopback.share_group = "group"
+        subscriber_loopback.save()
+        assert subscriber_loopback.sync_subscriptions() == (2, 2)
+        assert not subscriber_loopback.is_connection_changed
+
+        subscriber_loopback.keep_alive = 30
+        assert subscriber_loopback.is_connection_changed
+        subscriber_loopback.disconnect()
+        assert not subscriber_loopback.is_connection_changed
@@ -7,7 +7,7 @@ import sqlalchemy as sqla
 from bemserver_core.database import db
 from bemserver_core.model import Timeseries
 from bemserver_service_acquisition_mqtt.model import (
-    Topic, TopicLink, TopicByBroker, TopicBySubscriber)
+    Topic, TopicLink, TopicDeviceLink, TopicByBroker, TopicBySubscriber)
 
 
 class TestTopicModel:
@@ -27,6 +27,7 @@ class TestTopicModel:
         assert topic.id is not None
         assert topic.qos == 1
         assert topic.is_enabled
+        assert topic.on_conflict == Topic.OnConflict.nothing.value
         assert topic.payload_decoder == decoder
         assert topic.payload_decoder_cls == decoder_mosquitto_uptime_cls
         assert isinstance(
@@ -108,6 +109,12 @@ class TestTopicModel:
             assert str(exc) == "Invalid QoS level!"
 
         topic.qos = 2
+        topic.on_conflict = "explode"
+        with pytest.raises(ValueError) as exc:
+            topic._verify_consistency()
+            assert str(exc) == "Invalid topic on conflict action!"
+
+        topic.on_conflict = Topic.OnConflict.update.value
         topic.payload_decoder_id = 666
         with pytest.raises(sqla.exc.IntegrityError):
             topic.save()
@@ -152,6 +159,36 @@ class TestTopicModel:
         rows = db.session.execute(stmt).all()
         assert len(rows) == 0
 
+    def test_topic_wildcard(self, database, decoder_mosquitto_uptime):
+
+        _, decoder = decoder_mosquitto_uptime
+
+        topic = Topic(name="sensors/temp/1", payload_decoder_id=decoder.id)
+        topic.save()
+        assert not topic.is_wildcard
+        assert topic.device_segment is None
+        assert topic.device_links == []
+
+        for topic_name in ("sensors/+/1", "sensors/#", "+", "#",):
+            topic.name = topic_name
+            topic.save()
+            assert topic.is_wildcard
+
+        for topic_name in ("sensors/#/1", "sensors/temp+/1", "sensors/t#",):
+            topic.name = topic_name
+            with pytest.raises(ValueError) as exc:
+                topic._verify_consistency()
+                assert str(exc) == "Invalid topic wildcard!"
+
+        topic.name = "application/+/device/+/rx"
+        topic.device_segment = 3
+        topic.save()
+        for device_segment in (0, 2, 5, -1,):
+            topic.device_segment = device_segment
+            with pytest.raises(ValueError) as exc:
+                topic._verify_consistency()
+                assert str(exc) == "Invalid topic device segment!"
+
 
 class TestTopicLinkModel:
 
@@ -214,6 +251,68 @@ class TestTopicLinkModel:
         assert len(topic.links) == 1
 
 
+class TestTopicDeviceLinkModel:
+
+    def test_topic_device_link_crud(self, database, decoder_mosquitto_uptime):
+
+        _, decoder = decoder_mosquitto_uptime
+        payload_field = decoder.fields[0]
+
+        topic = Topic(
+            name="application/+/device/+/rx", device_segment=3,
+            payload_decoder_id=decoder.id)
+        topic.save()
+        assert topic.device_links == []
+
+        timeseries = []
+        for idx in range(3):
+            ts = Timeseries(name=f"Timeseries device {idx}")
+            db.session.add(ts)
+            db.session.commit()
+            timeseries.append(ts)
+
+        topic_device_link = topic.add_device_link(
+            "dev1", payload_field.id, timeseries[0].id)
+        assert topic_device_link.topic == topic
+        assert topic_device_link.payload_field == payload_field
+        assert topic_device_link.timeseries == timeseries[0]
+        topic.add_device_link("dev2", payload_field.id, timeseries[1].id)
+        assert len(topic.device_links) == 2
+        assert {x.device for x in topic.device_links} == {"dev1", "dev2"}
+        assert len(payload_field.topic_device_links) == 2
+
+        # Verify unique constraints between:
+        #   - topic, device and payload field
+        #   - topic, device and timeseries
+        with pytest.raises(sqla.exc.IntegrityError):
+            topic.add_device_link("dev1", payload_field.id, timeseries[2].id)
+        payload_field_test = decoder.add_field("test")
+        with pytest.raises(sqla.exc.IntegrityError):
+            topic.add_device_link(
+                "dev1", payload_field_test.id, timeseries[0].id)
+
+        # Invalid devices.
+        for device in ("", "dev/1", "dev+", "dev#",):
+            topic_device_link = TopicDeviceLink(
+                topic_id=topic.id, device=device,
+                payload_field_id=payload_field.id,
+                timeseries_id=timeseries[2].id)
+            with pytest.raises(ValueError) as exc:
+                topic_device_link.save()
+                assert str(exc) == "Invalid topic device!"
+
+        # Remove links from topic.
+        topic.remove_device_link("dev3", payload_field.id)
+        assert len(topic.device_links) == 2
+        topic.remove_device_link("dev2", payload_field.id)
+        assert [x.device for x in topic.device_links] == ["dev1"]
+
+        # Links are deleted with topic.
+        topic.delete()
+        assert TopicDeviceLink.get_by_id(
+            (topic.id, "dev1", payload_field.id,)) is None
+
+
 class TestTopicByBrokerModel:
 
     def test_topic_by_broker(
@@ -0,0 +1,81 @@
+"""Benchmark results tests"""
+
+import math
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+
+# Benchmarks are scripts, not a package.
+_spec = importlib.util.spec_from_file_location(
+    "benchmarks_common",
+    Path(__file__).resolve().parent.parent / "benchmarks" / "common.py")
+common = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(common)
+
+
+def _results(parameters=None, **metrics):
+    return {
+        "benchmark": "service",
+        "parameters": parameters or {"rate": 1000},
+        "metrics": {
+            name: common.metric(value, "", better)
+            for name, (value, better) in metrics.items()
+        },
+    }
+
+
+class TestBenchmarksCompare:
+
+    def test_benchmarks_compare(self):
+
+        baseline = _results(
+            throughput=(1000.0, common.HIGHER),
+            latency=(10.0, common.LOWER),
+            errors=(0, common.LOWER),
+        )
+        # Changes within tolerance, or in the right direction.
+        assert common.compare(baseline, _results(
+            throughput=(950.0, common.HIGHER),
+            latency=(5.0, common.LOWER),
+            errors=(0, common.LOWER),
+        )) == []
+        assert common.compare(baseline, _results(
+            throughput=(2000.0, common.HIGHER),
+            latency=(10.5, common.LOWER),
+        )) == []
+
+        # Higher is better: decrease is a regression.
+        assert common.compare(baseline, _results(
+            throughput=(800.0, common.HIGHER),
+        )) == [("throughput", 1000.0, 800.0, pytest.approx(0.2))]
+        # Lower is better: increase is a regression.
+        assert common.compare(baseline, _results(
+            latency=(15.0, common.LOWER),
+        )) == [("latency", 10.0, 15.0, pytest.approx(0.5))]
+        assert common.compare(baseline, _results(
+            latency=(15.0, common.LOWER),
+        ), tolerance=0.6) == []
+
+        # Zero baseline: any change in the wrong direction is a regression.
+        assert common.compare(baseline, _results(
+            errors=(1, common.LOWER),
+        )) == [("errors", 0, 1, math.inf)]
+
+        # Metrics missing or without value are ignored.
+        assert common.compare(baseline, _results(
+            other=(1.0, common.LOWER),
+            latency=(None, common.LOWER),
+        )) == []
+
+    def test_benchmarks_compare_mismatch(self):
+
+        baseline = _results(latency=(10.0, common.LOWER))
+        results = _results(latency=(10.0, common.LOWER))
+        results["benchmark"] = "startup"
+        with pytest.raises(ValueError):
+            common.compare(baseline, results)
+        with pytest.raises(ValueError):
+            common.compare(baseline, _results(
+                {"rate": 2000}, latency=(10.0, common.LOWER)))
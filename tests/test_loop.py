@@ -0,0 +1,129 @@
+"""Network loop tests"""
+
+import time
+import socket
+import threading
+
+import paho.mqtt.client as mqttc
+
+from bemserver_service_acquisition_mqtt.loop import NetworkLoop
+
+
+class TestNetworkLoop:
+
+    def test_network_loop(self, topic_name, publisher):
+
+        network_loop = NetworkLoop()
+        assert not network_loop.is_running
+        network_loop.start()
+        assert network_loop.is_running
+        nb_threads = threading.active_count()
+
+        messages = []
+        clients = []
+        for i in range(5):
+            client = mqttc.Client()
+            client.on_message = (
+                lambda client, userdata, msg: messages.append(msg))
+            network_loop.add(client, name=f"client #{i}")
+            client.connect(host="test.mosquitto.org", port=1883)
+            client.subscribe(topic_name, 1)
+            clients.append(client)
+        assert len(network_loop) == 5
+
+        # All clients are driven by network loop thread.
+        time.sleep(2)
+        assert threading.active_count() == nb_threads
+        assert all(x.is_connected() for x in clients)
+        # Each client received the retained message.
+        assert len(messages) == 5
+
+        for client in clients:
+            network_loop.remove(client)
+            client.disconnect()
+        time.sleep(0.5)
+        assert len(network_loop) == 0
+        assert not any(x.is_connected() for x in clients)
+
+        network_loop.stop()
+        assert not network_loop.is_running
+
+    def test_network_loop_reconnect(self):
+
+        class FakeClient:
+            def __init__(self, sock=None):
+                self.sock = sock
+                self.nb_loop_misc = 0
+                self.nb_reconnect = 0
+                self.reconnect_event = threading.Event()
+
+            def socket(self):
+                return self.sock
+
+            def loop_misc(self):
+                self.nb_loop_misc += 1
+
+            def reconnect(self):
+                # Broker slow to accept connection.
+                self.nb_reconnect += 1
+                self.reconnect_event.wait(5)
+                raise socket.timeout("timed out")
+
+        network_loop = NetworkLoop(
+            misc_interval=0.05, reconnect_delay_min=0.05)
+        network_loop.start()
+        sock, other_sock = socket.socketpair()
+        client = FakeClient(sock)
+        lost_client = FakeClient()
+        network_loop.add(client, name="client")
+        network_loop.add(lost_client, name="lost client")
+        network_loop._on_socket_close(lost_client, None, other_sock)
+
+        time.sleep(0.3)
+        # Reconnecting client does not stall other clients.
+        assert lost_client.nb_reconnect == 1
+        nb_loop_misc = client.nb_loop_misc
+        time.sleep(0.3)
+        assert client.nb_loop_misc > nb_loop_misc
+        assert lost_client.nb_reconnect == 1
+
+        # Reconnection failed: tried again later.
+        lost_client.reconnect_event.set()
+        time.sleep(0.5)
+        assert lost_client.nb_reconnect >= 2
+
+        network_loop.remove(client)
+        network_loop.remove(lost_client)
+        network_loop.stop()
+        sock.close()
+        other_sock.close()
+
+    def test_network_loop_reconnect_error(self):
+
+        class FakeClient:
+            def __init__(self):
+                self.nb_reconnect = 0
+
+            def socket(self):
+                return None
+
+            def reconnect(self):
+                self.nb_reconnect += 1
+                raise ValueError("Invalid host.")
+
+        network_loop = NetworkLoop(
+            misc_interval=0.05, reconnect_delay_min=0.05)
+        network_loop.start()
+        sock, other_sock = socket.socketpair()
+        client = FakeClient()
+        network_loop.add(client, name="client")
+        network_loop._on_socket_close(client, None, sock)
+
+        # Unexpected reconnection error: tried again later.
+        time.sleep(0.5)
+        assert client.nb_reconnect >= 2
+
+        network_loop.remove(client)
+        network_loop.stop()
+        sock.close()
+        other_sock.close()
@@ -0,0 +1,150 @@
+"""Loopback transport tests"""
+
+import paho.mqtt.client as mqttc
+
+from bemserver_service_acquisition_mqtt import loopback
+
+
+def _connect(port, protocol=mqttc.MQTTv311):
+    client = loopback.LoopbackClient(protocol=protocol)
+    client.connect("localhost", port)
+    return client
+
+
+class TestLoopback:
+
+    def test_loopback_get_broker(self):
+
+        broker = loopback.get_broker("localhost", 10001)
+        assert loopback.get_broker("localhost", 10001) is broker
+        assert loopback.get_broker("localhost", 10002) is not broker
+        assert broker.nb_subscriptions == 0
+
+    def test_loopback_client_messages(self):
+
+        client = loopback.LoopbackClient(userdata="data")
+        received = {"callback": [], "on_message": []}
+
+        def on_connect(client, userdata, flags, rc):
+            received["connect"] = (userdata, rc)
+
+        def on_subscribe(client, userdata, mid, granted_qos):
+            received["subscribe"] = (mid, granted_qos)
+
+        def on_message(client, userdata, msg):
+            received["on_message"].append((userdata, msg.topic, msg.payload))
+
+        def callback(client, userdata, msg):
+            received["callback"].append((msg.topic, msg.payload, msg.qos))
+
+        client.on_connect = on_connect
+        client.on_subscribe = on_subscribe
+        client.on_message = on_message
+        assert client.socket() is None
+        assert not client.is_connected()
+        assert client.subscribe("test/1") == (mqttc.MQTT_ERR_NO_CONN, None)
+
+        assert client.connect("localhost", 10003) == mqttc.MQTT_ERR_SUCCESS
+        assert client.is_connected()
+        assert received["connect"] == ("data", 0)
+        broker = loopback.get_broker("localhost", 10003)
+
+        client.message_callback_add("test/1", callback)
+        rc, mid = client.subscribe([("test/1", 1), ("test/+", 0)])
+        assert rc == mqttc.MQTT_ERR_SUCCESS
+        assert received["subscribe"] == (mid, (1, 0))
+        assert broker.nb_subscriptions == 2
+
+        # Message callback of topic, else on_message.
+        assert broker.publish("test/1", b"1", qos=1) == 2
+        assert broker.publish("test/2", "2", qos=1) == 1
+        assert broker.publish("other/1", b"3") == 0
+        assert received["callback"] == [
+            ("test/1", b"1", 1), ("test/1", b"1", 0)]
+        assert received["on_message"] == [("data", "test/2", b"2")]
+
+        client.message_callback_remove("test/1")
+        msg_info = client.publish("test/1", b"4")
+        assert msg_info.rc == mqttc.MQTT_ERR_SUCCESS
+        assert msg_info.is_published()
+        assert len(received["on_message"]) == 3
+
+        client.unsubscribe("test/+")
+        assert broker.nb_subscriptions == 1
+        assert client.disconnect() == mqttc.MQTT_ERR_SUCCESS
+        assert not client.is_connected()
+        assert broker.nb_subscriptions == 0
+        assert client.disconnect() == mqttc.MQTT_ERR_NO_CONN
+        assert client.publish("test/1").rc == mqttc.MQTT_ERR_NO_CONN
+
+    def test_loopback_client_mqttv5(self):
+
+        client = loopback.LoopbackClient(protocol=mqttc.MQTTv5)
+        received = {}
+
+        def on_connect(client, userdata, flags, reasonCode, properties):
+            received["connect"] = reasonCode
+
+        def on_subscribe(client, userdata, mid, reasonCodes, properties):
+            received["subscribe"] = reasonCodes
+
+        def on_disconnect(client, userdata, reasonCode, properties):
+            received["disconnect"] = reasonCode
+
+        client.on_connect = on_connect
+        client.on_subscribe = on_subscribe
+        client.on_disconnect = on_disconnect
+        client.connect("localhost", 10004, clean_start=True)
+        assert received["connect"].value == 0
+        client.subscribe("test/1", 1)
+        assert [x.value for x in received["subscribe"]] == [1]
+        client.disconnect()
+        assert received["disconnect"].value == 0
+
+    def test_loopback_retained_messages(self):
+
+        broker = loopback.get_broker("localhost", 10005)
+        broker.publish("test/1", b"1", qos=1, retain=True)
+        broker.publish("test/2", b"2", qos=0, retain=True)
+
+        client = _connect(10005)
+        received = []
+        client.on_message = lambda c, u, msg: received.append(
+            (msg.topic, msg.payload, msg.qos, msg.retain))
+        client.subscribe("test/#", 1)
+        assert sorted(received) == [
+            ("test/1", b"1", 1, True), ("test/2", b"2", 0, True)]
+
+        # Empty payload clears retained message.
+        broker.publish("test/1", b"", retain=True)
+        assert received[-1] == ("test/1", b"", 0, False)
+        received.clear()
+        client.unsubscribe("test/#")
+        client.subscribe("test/#", 1)
+        assert received == [("test/2", b"2", 0, True)]
+
+    def test_loopback_shared_subscriptions(self):
+
+        broker = loopback.get_broker("localhost", 10006)
+        received = {}
+        clients = []
+        for idx in range(2):
+            client = _connect(10006)
+            received[idx] = []
+            client.message_callback_add(
+                "test/1",
+                lambda c, u, msg, idx=idx: received[idx].append(msg.payload))
+            client.subscribe("$share/group/test/1", 0)
+            clients.append(client)
+        assert broker.nb_subscriptions == 1
+
+        # Group members receive messages in turn.
+        for idx in range(4):
+            assert broker.publish("test/1", str(idx)) == 1
+        assert received == {0: [b"0", b"2"], 1: [b"1", b"3"]}
+
+        clients[0].disconnect()
+        broker.publish("test/1", b"4")
+        assert received[1][-1] == b"4"
+        clients[1].unsubscribe("$share/group/test/1")
+        assert broker.nb_subscriptions == 0
@@ -0,0 +1,84 @@
+"""Metrics tests"""
+
+import threading
+import urllib.error
+import urllib.request
+import pytest
+
+from bemserver_service_acquisition_mqtt.metrics import (
+    MetricsRegistry, MetricsServer, CONTENT_TYPE)
+
+
+class TestMetrics:
+
+    def test_metrics_collect(self):
+
+        registry = MetricsRegistry()
+        counter = registry.counter(
+            "messages_total", "Messages", ("subscriber", "topic"))
+        gauge = registry.gauge("queue_depth", "Queue depth")
+        histogram = registry.histogram(
+            "write_seconds", "Write duration", ("writer",),
+            buckets=(0.1, 1.0))
+        with pytest.raises(ValueError):
+            registry.counter("messages_total", "Messages again")
+        with pytest.raises(ValueError):
+            counter.labels("1")
+
+        counter.labels("1", 'a"b').inc()
+        counter.labels("1", 'a"b').inc(2)
+        gauge.set_function(lambda: 12)
+        histogram.labels("copy").observe(0.05)
+        histogram.labels("copy").observe(0.5)
+        histogram.labels("copy").observe(5)
+
+        assert registry.collect().splitlines() == [
+            "# HELP messages_total Messages",
+            "# TYPE messages_total counter",
+            'messages_total{subscriber="1",topic="a\\"b"} 3.0',
+            "# HELP queue_depth Queue depth",
+            "# TYPE queue_depth gauge",
+            "queue_depth 12.0",
+            "# HELP write_seconds Write duration",
+            "# TYPE write_seconds histogram",
+            'write_seconds_bucket{writer="copy",le="0.1"} 1',
+            'write_seconds_bucket{writer="copy",le="1.0"} 2',
+            'write_seconds_bucket{writer="copy",le="+Inf"} 3',
+            'write_seconds_sum{writer="copy"} 5.55',
+            'write_seconds_count{writer="copy"} 3',
+        ]
+
+    def test_metrics_threads(self):
+
+        registry = MetricsRegistry()
+        counter = registry.counter("messages_total", "Messages", ("topic",))
+
+        def increment():
+            for _ in range(10000):
+                counter.labels("t").inc()
+
+        threads = [threading.Thread(target=increment) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert counter.labels("t").value == 80000
+
+    def test_metrics_server(self):
+
+        registry = MetricsRegistry()
+        registry.counter("messages_total", "Messages").inc()
+        server = MetricsServer(port=0, registry=registry)
+        server.start()
+        assert server.is_running
+        assert server.port > 0
+        try:
+            url = f"http://127.0.0.1:{server.port}"
+            with urllib.request.urlopen(f"{url}/metrics") as resp:
+                assert resp.headers["Content-Type"] == CONTENT_TYPE
+                assert b"messages_total 1.0\n" in resp.read()
+            with pytest.raises(urllib.error.HTTPError):
+                urllib.request.urlopen(f"{url}/other")
+        finally:
+            server.stop()
+        assert not server.is_running
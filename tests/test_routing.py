@@ -0,0 +1,230 @@
+"""Routing tests"""
+
+import pytest
+import datetime as dt
+import sqlalchemy as sqla
+import paho.mqtt.client as mqttc
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from bemserver_core.database import db
+from bemserver_core.model import Timeseries, TimeseriesData
+from bemserver_service_acquisition_mqtt import decoders
+from bemserver_service_acquisition_mqtt.model import Topic
+from bemserver_service_acquisition_mqtt.routing import (
+    RoutingTable, Route, RouteLink, TopicTrie, TopicAliases)
+
+
+class TestTopicTrie:
+
+    def test_topic_trie_match(self):
+
+        trie = TopicTrie()
+        assert len(trie) == 0
+        assert trie.match("a/b") is None
+        for topic_filter in (
+                "a/b", "a/+", "a/#", "+/b/c", "#", "a/+/c/+", "$SYS/#"):
+            trie.insert(topic_filter, topic_filter)
+        assert len(trie) == 7
+        assert "a/+" in trie
+        assert "a/c" not in trie
+        assert trie.get("a/+") == "a/+"
+        assert trie.get("a/c") is None
+
+        # Most specific filter matches, level by level: exact level, "+"
+        #  then "#".
+        assert trie.match("a/b") == "a/b"
+        assert trie.match("a/c") == "a/+"
+        assert trie.match("a/b/c") == "a/#"
+        assert trie.match("x/b/c") == "+/b/c"
+        assert trie.match("a/x/c/d") == "a/+/c/+"
+        assert trie.match("a/x/c") == "a/#"
+        assert trie.match("a") == "a/#"
+        assert trie.match("z/y") == "#"
+        assert trie.match("a//") == "a/#"
+        # Topics starting with "$" do not match first level wildcards.
+        assert trie.match("$SYS/broker/uptime") == "$SYS/#"
+        assert trie.match("$other/b/c") is None
+
+        trie.insert("a/+", "other")
+        assert len(trie) == 7
+        assert trie.match("a/c") == "other"
+
+
+class TestTopicAliases:
+
+    @staticmethod
+    def _message(topic_name, alias=None):
+        msg = mqttc.MQTTMessage(topic=topic_name.encode())
+        if alias is not None:
+            msg.properties = Properties(PacketTypes.PUBLISH)
+            msg.properties.TopicAlias = alias
+        return msg
+
+    def test_topic_aliases_resolve(self):
+
+        topic_aliases = TopicAliases(2)
+        assert len(topic_aliases) == 0
+
+        # Messages without alias are left as is.
+        msg = self._message("a/b")
+        assert topic_aliases.resolve(msg) == "a/b"
+        assert len(topic_aliases) == 0
+
+        # An alias is set by a message with a topic name, then used alone.
+        assert topic_aliases.resolve(self._message("a/b", 1)) == "a/b"
+        assert len(topic_aliases) == 1
+        msg = self._message("", 1)
+        assert topic_aliases.resolve(msg) == "a/b"
+        assert msg.topic == "a/b"
+        # Alias can be set again.
+        assert topic_aliases.resolve(self._message("a/c", 1)) == "a/c"
+        assert topic_aliases.resolve(self._message("", 1)) == "a/c"
+
+        # Unknown or invalid aliases.
+        msg = self._message("", 2)
+        assert topic_aliases.resolve(msg) is None
+        assert msg.topic == ""
+        assert topic_aliases.resolve(self._message("a/d", 3)) is None
+        assert topic_aliases.resolve(self._message("a/d", 0)) is None
+
+        # Aliases are lost with connection.
+        topic_aliases.clear()
+        assert len(topic_aliases) == 0
+        assert topic_aliases.resolve(self._message("", 1)) is None
+
+
+class TestRoutingTable:
+
+    def test_routing_table_compile(self, database, topic, mosquitto_topic):
+
+        routing_table = RoutingTable()
+        assert len(routing_table) == 0
+        assert routing_table.get(topic.name) is None
+
+        # Duplicate topics are routed once.
+        routing_table = RoutingTable.compile([topic, mosquitto_topic, topic])
+        assert len(routing_table) == 2
+        assert set(routing_table) == {topic.name, mosquitto_topic.name}
+        assert topic.name in routing_table
+        assert "unknown/topic" not in routing_table
+        assert routing_table.get("unknown/topic") is None
+
+        route = routing_table.get(topic.name)
+        assert isinstance(route, Route)
+        assert isinstance(route.decoder, decoders.PayloadDecoderBEMServer)
+        assert route.decoder.is_compiled
+        assert route.decoder.buffer is None
+        assert route.links == tuple(
+            RouteLink(x.payload_field.name, x.timeseries_id)
+            for x in topic.links)
+        assert route.links[0].field_name == "value"
+
+        # Routing table is immutable.
+        with pytest.raises(TypeError):
+            routing_table._routes["unknown/topic"] = route
+
+    def test_routing_table_topology_change(self, database, topic):
+
+        routing_table = RoutingTable.compile([topic])
+        route = routing_table.get(topic.name)
+        assert len(route.links) == 1
+
+        # Compiled routes ignore topology changes...
+        payload_field = topic.payload_decoder.fields[0]
+        ts_id = topic.links[0].timeseries_id
+        topic.remove_link(payload_field.id, ts_id)
+        assert len(topic.links) == 0
+        assert len(route.links) == 1
+        assert len(route.decoder.links) == 1
+
+        # ...until routing table is compiled again.
+        routing_table = RoutingTable.compile([topic])
+        assert routing_table.get(topic.name).links == ()
+
+    def test_routing_table_compile_previous(
+            self, database, topic, mosquitto_topic):
+
+        previous = RoutingTable.compile([topic, mosquitto_topic])
+        route = previous.get(topic.name)
+        mosquitto_route = previous.get(mosquitto_topic.name)
+
+        # Unchanged routes are kept.
+        routing_table = RoutingTable.compile([topic], previous=previous)
+        assert len(routing_table) == 1
+        assert routing_table.get(topic.name) is route
+
+        # Routes of changed topics are compiled again.
+        payload_field = topic.payload_decoder.fields[0]
+        topic.remove_link(payload_field.id, topic.links[0].timeseries_id)
+        mosquitto_topic.on_conflict = Topic.OnConflict.update.value
+        routing_table = RoutingTable.compile(
+            [topic, mosquitto_topic], previous=previous)
+        assert routing_table.get(topic.name) is not route
+        assert routing_table.get(topic.name).links == ()
+        assert routing_table.get(mosquitto_topic.name) is not mosquitto_route
+
+    def test_routing_table_wildcard(self, database, topic, wildcard_topic):
+
+        routing_table = RoutingTable.compile([topic, wildcard_topic])
+        assert len(routing_table) == 2
+        assert set(routing_table) == {topic.name, wildcard_topic.name}
+        assert wildcard_topic.name in routing_table
+        assert len(list(routing_table.iter_routes())) == 3
+
+        # Each device has its own route, unknown devices have none.
+        route_1 = routing_table.get("bemserver/app/device/dev1/rx")
+        route_2 = routing_table.get("bemserver/other/device/dev2/rx")
+        assert route_1.decoder is not route_2.decoder
+        assert routing_table.get("bemserver/other/device/dev1/rx") is route_1
+        for device, route in (("dev1", route_1), ("dev2", route_2)):
+            assert route.decoder.is_compiled
+            assert route.links == tuple(
+                RouteLink(x.payload_field.name, x.timeseries_id)
+                for x in wildcard_topic.device_links if x.device == device)
+        assert routing_table.get("bemserver/app/device/dev3/rx") is None
+        assert routing_table.get("bemserver/app/device/dev1/tx") is None
+        # Topics are looked up before wildcard topics.
+        assert routing_table.get(topic.name).links == tuple(
+            RouteLink(x.payload_field.name, x.timeseries_id)
+            for x in topic.links)
+
+        # Unchanged devices keep their route.
+        payload_field = wildcard_topic.payload_decoder.fields[0]
+        wildcard_topic.remove_device_link("dev2", payload_field.id)
+        routing_table = RoutingTable.compile(
+            [wildcard_topic], previous=routing_table)
+        assert routing_table.get("bemserver/app/device/dev1/rx") is route_1
+        assert routing_table.get("bemserver/app/device/dev2/rx") is None
+
+        # Wildcard topic without device segment: topic links.
+        wildcard_topic.device_segment = None
+        for link in wildcard_topic.device_links:
+            wildcard_topic.add_link(link.payload_field_id, link.timeseries_id)
+        routing_table = RoutingTable.compile([wildcard_topic])
+        route = routing_table.get("bemserver/app/device/dev3/rx")
+        assert route is routing_table.get("bemserver/app/device/dev1/rx")
+        assert len(route.links) == 1
+
+    def test_routing_compiled_decoder_save(self, database, topic):
+
+        routing_table = RoutingTable.compile([topic])
+        decoder = routing_table.get(topic.name).decoder
+        ts_id = topic.links[0].timeseries_id
+
+        # Changing topic links after compilation has no effect.
+        ts = Timeseries(name="Timeseries routing test")
+        db.session.add(ts)
+        db.session.commit()
+        topic.remove_link(topic.payload_decoder.fields[0].id, ts_id)
+        topic.add_link(topic.payload_decoder.fields[0].id, ts.id)
+
+        timestamp = dt.datetime(2021, 5, 1, tzinfo=dt.timezone.utc)
+        decoder._save_to_db(timestamp, {"value": 42})
+
+        stmt = sqla.select(TimeseriesData)
+        stmt = stmt.filter(TimeseriesData.timeseries_id == ts_id)
+        rows = db.session.execute(stmt).all()
+        assert len(rows) == 1
+        assert rows[0][0].timestamp == timestamp
+        assert rows[0][0].value == 42
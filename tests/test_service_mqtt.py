@@ -2,17 +2,24 @@
 
 import time
 import json
+import socket
 import logging
+import datetime as dt
 from pathlib import Path
 
 import sqlalchemy as sqla
 from bemserver_core.database import db
-from bemserver_core.model import TimeseriesData
+from bemserver_core.model import Timeseries, TimeseriesData
 
 import pytest
-
-from bemserver_service_acquisition_mqtt.service import Service
-from bemserver_service_acquisition_mqtt import SERVICE_LOGNAME
+import paho.mqtt.client as mqttc
+
+from bemserver_service_acquisition_mqtt.service import (
+    Service, NO_ROUTE_TOPIC_LABEL)
+from bemserver_service_acquisition_mqtt import model as svc_model
+from bemserver_service_acquisition_mqtt import (
+    SERVICE_LOGNAME, loopback, metrics)
+from bemserver_service_acquisition_mqtt.exceptions import ServiceError
 from bemserver_service_acquisition_mqtt.__main__ import (
     load_config, init_logger)
 
@@ -68,6 +75,11 @@ class TestServiceMQTT:
         assert topic_by_subscriber.is_subscribed
         assert len(svc._running_subscribers) == 1
         assert subscriber.id in [x.id for x in svc._running_subscribers]
+        assert len(svc._routing_table) == 1
+        route = svc._routing_table.get(topic.name)
+        assert route.decoder.is_compiled
+        assert route.links == tuple(
+            (x.payload_field.name, x.timeseries_id) for x in topic.links)
 
         # Waiting for messages.
         time.sleep(1)
@@ -82,6 +94,355 @@ class TestServiceMQTT:
         rows = db.session.execute(stmt).all()
         assert len(rows) >= 1
 
+    def test_service_mqtt_run_ingestion(
+            self, tmpdir, database, subscriber, topic, publisher):
+
+        topic_by_subscriber = topic.add_subscriber(subscriber.id)
+        assert not topic_by_subscriber.is_subscribed
+
+        stmt = sqla.select(TimeseriesData)
+        for topic_link in topic.links:
+            stmt = stmt.filter(
+                TimeseriesData.timeseries_id == topic_link.timeseries_id
+            )
+        rows = db.session.execute(stmt).all()
+        assert len(rows) == 0
+
+        svc = Service(str(tmpdir))
+        assert svc.ingestion_stats is None
+        svc.set_ingestion(buffer_size=100, buffer_max_age=10)
+        svc.run()
+        assert svc.is_running
+        route = svc._routing_table.get(topic.name)
+        assert route.decoder.buffer is svc._buffer
+
+        # Waiting for messages, that are buffered but not written yet.
+        time.sleep(1)
+        rows = db.session.execute(stmt).all()
+        assert len(rows) == 0
+
+        # Buffered values are written when service stops.
+        svc.stop()
+        assert not svc.is_running
+        rows = db.session.execute(stmt).all()
+        assert len(rows) >= 1
+        stats = svc.ingestion_stats
+        assert stats["flush_count"] == 1
+        assert stats["values_written"] == len(rows)
+
+    def test_service_mqtt_run_writer_workers(
+            self, tmpdir, database, subscriber, topic, publisher):
+
+        topic.add_subscriber(subscriber.id)
+
+        stmt = sqla.select(TimeseriesData)
+        for topic_link in topic.links:
+            stmt = stmt.filter(
+                TimeseriesData.timeseries_id == topic_link.timeseries_id
+            )
+
+        svc = Service(str(tmpdir))
+        svc.set_ingestion(buffer_size=100, buffer_max_age=10, workers=2)
+        svc.run()
+        assert svc.is_running
+        assert svc._writer_pool.is_running
+        route = svc._routing_table.get(topic.name)
+        assert route.decoder.buffer is svc._writer_pool
+
+        # Messages are decoded by workers, values written when service stops.
+        time.sleep(1)
+        svc.stop()
+        assert not svc._writer_pool.is_running
+        rows = db.session.execute(stmt).all()
+        assert len(rows) >= 1
+        stats = svc.ingestion_stats
+        assert stats["values_written"] == len(rows)
+        assert stats["queue_depths"] == [0, 0]
+
+    def test_service_mqtt_run_network_loop(
+            self, tmpdir, database, subscriber, topic, publisher):
+
+        topic.add_subscriber(subscriber.id)
+
+        stmt = sqla.select(TimeseriesData)
+        for topic_link in topic.links:
+            stmt = stmt.filter(
+                TimeseriesData.timeseries_id == topic_link.timeseries_id
+            )
+
+        svc = Service(str(tmpdir))
+        with pytest.raises(ValueError):
+            svc.set_network_loop("unknown")
+        svc.set_network_loop("selector")
+        svc.run()
+        assert svc.is_running
+        assert subscriber.is_connected
+        assert svc._network_loop.is_running
+        assert len(svc._network_loop) == 1
+        # Subscriber client does not run its own network loop thread.
+        assert subscriber._client._thread is None
+
+        # Waiting for messages.
+        time.sleep(1)
+
+        svc.stop()
+        assert not svc.is_running
+        assert not subscriber.is_connected
+        assert svc._network_loop is None
+
+        rows = db.session.execute(stmt).all()
+        assert len(rows) >= 1
+
+    def test_service_mqtt_run_loopback(
+            self, tmpdir, database, subscriber_loopback, topic):
+
+        topic_by_subscriber = topic.add_subscriber(subscriber_loopback.id)
+
+        stmt = sqla.select(TimeseriesData)
+        for topic_link in topic.links:
+            stmt = stmt.filter(
+                TimeseriesData.timeseries_id == topic_link.timeseries_id
+            )
+
+        svc = Service(str(tmpdir))
+        svc.run()
+        assert svc.is_running
+        assert subscriber_loopback.is_connected
+        assert topic_by_subscriber.is_subscribed
+
+        # Messages are dispatched at once, no broker nor network involved.
+        broker = loopback.get_broker("localhost", 1883)
+        start_dt = dt.datetime(2021, 4, 27, 16, 5, 11, tzinfo=dt.timezone.utc)
+        for idx in range(10):
+            payload = {
+                "ts": (start_dt + dt.timedelta(seconds=idx)).isoformat(),
+                "value": idx,
+            }
+            assert broker.publish(topic.name, json.dumps(payload), qos=1) == 1
+        rows = db.session.execute(stmt).all()
+        assert len(rows) == 10
+
+        svc.stop()
+        assert not svc.is_running
+        assert not subscriber_loopback.is_connected
+        assert broker.publish(topic.name, "{}") == 0
+
+    def test_service_mqtt_run_wildcard(
+            self, tmpdir, database, subscriber_loopback, wildcard_topic):
+
+        wildcard_topic.add_subscriber(subscriber_loopback.id)
+
+        svc = Service(str(tmpdir))
+        svc.run()
+        assert svc.is_running
+        # Messages are counted by topic filter, not by device.
+        messages_received = metrics.MESSAGES_RECEIVED.labels(
+            str(subscriber_loopback.id), wildcard_topic.name)
+        nb_messages = messages_received.value
+
+        # Each device values are written to its own timeseries, values of
+        #  unknown devices are dropped.
+        broker = loopback.get_broker("localhost", 1883)
+        start_dt = dt.datetime(2021, 4, 27, 16, 5, 11, tzinfo=dt.timezone.utc)
+        for idx, device in enumerate(("dev1", "dev2", "dev2", "dev3",)):
+            payload = {
+                "ts": (start_dt + dt.timedelta(seconds=idx)).isoformat(),
+                "value": idx,
+            }
+            assert broker.publish(
+                f"bemserver/app/device/{device}/rx", json.dumps(payload),
+                qos=1) == 1
+        for device, nb_values in (("dev1", 1), ("dev2", 2),):
+            ts_ids = [
+                x.timeseries_id for x in wildcard_topic.device_links
+                if x.device == device]
+            stmt = sqla.select(TimeseriesData).filter(
+                TimeseriesData.timeseries_id.in_(ts_ids))
+            assert len(db.session.execute(stmt).all()) == nb_values
+        # (unknown device: no route)
+        assert messages_received.value == nb_messages + 3
+
+        svc.stop()
+        assert not svc.is_running
+
+    def test_service_mqtt_on_message_no_route(self, tmpdir, caplog):
+
+        svc = Service(str(tmpdir), logger=logging.getLogger(SERVICE_LOGNAME))
+        messages_received = metrics.MESSAGES_RECEIVED.labels(
+            "1", NO_ROUTE_TOPIC_LABEL)
+        nb_messages = messages_received.value
+
+        with caplog.at_level(logging.DEBUG, logger=SERVICE_LOGNAME):
+            for idx in range(3):
+                msg = mqttc.MQTTMessage(topic=f"unknown/{idx}".encode())
+                svc._on_message(None, "1", msg)
+        # Counted with the same label, whatever the topic.
+        assert messages_received.value == nb_messages + 3
+        # Warned once (then logged as debug).
+        warnings = [
+            x for x in caplog.records
+            if x.levelno == logging.WARNING and "No route" in x.message]
+        assert len(warnings) == 1
+        assert "unknown/0" in warnings[0].message
+
+    def test_service_mqtt_run_startup_report(
+            self, tmpdir, database, subscriber_loopback, topic):
+
+        topic.add_subscriber(subscriber_loopback.id)
+        decoder = topic.payload_decoder
+        for idx in range(10):
+            other_topic = svc_model.Topic(
+                name=f"bemserver/startup/{idx}",
+                payload_decoder_id=decoder.id)
+            other_topic.save()
+            other_topic.add_subscriber(subscriber_loopback.id)
+            for payload_field in decoder.fields:
+                ts = Timeseries(
+                    name=f"Timeseries startup {idx} {payload_field.name}")
+                db.session.add(ts)
+                db.session.commit()
+                other_topic.add_link(payload_field.id, ts.id)
+        db.session.expunge_all()
+
+        svc = Service(str(tmpdir))
+        assert svc.startup_report is None
+        svc.run()
+        report = svc.startup_report.as_dict()
+        assert svc.status["startup"] == report
+        assert report["subscribers"] == 1
+        assert report["topics"] == 11
+        assert report["connected"] == 1
+        assert list(report["phases"]) == [
+            "decoders", "topology", "routing", "connection"]
+        # Topology is loaded at once, whatever the number of topics.
+        assert report["phases"]["topology"]["queries"] <= 4
+        assert report["phases"]["routing"]["queries"] == 0
+        assert report["queries"] == sum(
+            x["queries"] for x in report["phases"].values())
+        svc.stop()
+
+    def test_service_mqtt_run_connection_timeout(
+            self, tmpdir, database, subscriber_loopback, topic):
+
+        topic.add_subscriber(subscriber_loopback.id)
+        # Broker accepting TCP connections but never answering.
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(8)
+        silent_subscribers = []
+        for _ in range(3):
+            broker = svc_model.Broker(
+                host="127.0.0.1", port=sock.getsockname()[1])
+            broker.save()
+            subscriber = svc_model.Subscriber(broker_id=broker.id)
+            subscriber.save()
+            topic.add_subscriber(subscriber.id)
+            silent_subscribers.append(subscriber)
+
+        svc = Service(str(tmpdir))
+        with pytest.raises(ValueError):
+            svc.set_connection(workers=0)
+        with pytest.raises(ValueError):
+            svc.set_connection(timeout=0)
+        svc.set_connection(workers=4, timeout=0.5)
+        t_start = time.monotonic()
+        svc.run()
+        # Subscribers connect concurrently, unreachable ones are not run.
+        assert time.monotonic() - t_start < 1.5
+        assert svc.is_running
+        assert subscriber_loopback.is_connected
+        assert [x.id for x in svc._running_subscribers] == [
+            subscriber_loopback.id]
+        for subscriber in silent_subscribers:
+            assert not subscriber.is_connected
+            assert subscriber.timestamp_last_connection is None
+
+        svc.stop()
+        assert not subscriber_loopback.is_connected
+        assert svc._running_subscribers == []
+        sock.close()
+
+    def test_service_mqtt_reload(
+            self, tmpdir, database, subscriber_loopback, topic):
+
+        topic.add_subscriber(subscriber_loopback.id)
+        other_broker = svc_model.Broker(
+            host="localhost", port=1884,
+            transport=svc_model.Broker.Transport.loopback.value)
+        other_broker.save()
+        other_subscriber = svc_model.Subscriber(
+            broker_id=other_broker.id, is_enabled=False)
+        other_subscriber.save()
+        new_topic = svc_model.Topic(
+            name="bemserver/reload/1",
+            payload_decoder_id=topic.payload_decoder_id)
+        new_topic.save()
+
+        svc = Service(str(tmpdir))
+        with pytest.raises(ValueError):
+            svc.set_reload(delay=-1)
+        svc.set_reload(listen=False, delay=0)
+        with pytest.raises(ServiceError):
+            svc.reload()
+        svc.run()
+        broker = loopback.get_broker("localhost", 1883)
+        payload = json.dumps({"ts": "2021-04-27T16:05:11+00:00", "value": 1})
+        client = subscriber_loopback._client
+        route = svc._routing_table.get(topic.name)
+        assert not svc.is_reload_requested
+        assert broker.publish(new_topic.name, payload) == 0
+
+        # Topic added to a subscriber, subscriber enabled.
+        new_topic.add_subscriber(subscriber_loopback.id)
+        other_subscriber.is_enabled = True
+        other_subscriber.save()
+        svc.request_reload()
+        assert svc.is_reload_requested
+        report = svc.reload()
+        assert not svc.is_reload_requested
+        assert svc.status["reload"] == report
+        assert report["connected"] == 1
+        assert report["disconnected"] == 0
+        assert report["subscribed"] == 1
+        assert report["unsubscribed"] == 0
+        assert report["topics"] == 2
+        assert other_subscriber.is_connected
+        assert len(svc._running_subscribers) == 2
+        # Unchanged subscriber and routes are not touched.
+        assert subscriber_loopback._client is client
+        assert svc._routing_table.get(topic.name) is route
+        assert broker.publish(topic.name, payload) == 1
+        assert broker.publish(new_topic.name, payload) == 1
+
+        # Topic removed from a subscriber, subscriber disabled.
+        topic.remove_subscriber(subscriber_loopback.id)
+        other_subscriber.is_enabled = False
+        other_subscriber.save()
+        report = svc.reload()
+        assert report["connected"] == 0
+        assert report["disconnected"] == 1
+        assert report["subscribed"] == 0
+        assert report["unsubscribed"] == 1
+        assert report["topics"] == 1
+        assert not other_subscriber.is_connected
+        assert subscriber_loopback._client is client
+        assert broker.publish(topic.name, payload) == 0
+        assert broker.publish(new_topic.name, payload) == 1
+
+        # Broker changed: subscriber connects again.
+        subscriber_loopback.broker.port = 1885
+        subscriber_loopback.broker.save()
+        report = svc.reload()
+        assert report["connected"] == 1
+        assert report["disconnected"] == 1
+        assert subscriber_loopback._client is not client
+        assert broker.publish(new_topic.name, payload) == 0
+        assert loopback.get_broker("localhost", 1885).publish(
+            new_topic.name, payload) == 1
+
+        svc.stop()
+        assert not subscriber_loopback.is_connected
+
     def test_service_mqtt_run_tls(
             self, tmpdir, database, subscriber_tls, topic, publisher):
 
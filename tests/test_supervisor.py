@@ -0,0 +1,62 @@
+"""Supervisor tests"""
+
+import os
+import time
+import signal
+
+import pytest
+
+from bemserver_service_acquisition_mqtt.supervisor import Supervisor
+
+
+def _wait_for(condition, timeout=30):
+    t_end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > t_end:
+            return False
+        time.sleep(0.2)
+    return True
+
+
+class TestSupervisor:
+
+    def test_supervisor_run(
+            self, database, subscriber, topic, json_service_config):
+
+        with pytest.raises(ValueError):
+            Supervisor(json_service_config, 0)
+
+        topic.add_subscriber(subscriber.id)
+        json_service_config["db_url"] = str(database.url)
+
+        supervisor = Supervisor(
+            json_service_config, 2, restart_delay=0.1, status_interval=0.5)
+        assert supervisor.nb_workers == 2
+        assert not supervisor.is_running
+        supervisor.run()
+        assert supervisor.is_running
+        assert all(x is not None for x in supervisor.pids)
+
+        # Only the worker of subscriber's shard runs it.
+        assert _wait_for(lambda: supervisor.status["subscribers"] == 1)
+        status = supervisor.status
+        assert status["topics"] == 1
+        shard_index = subscriber.id % 2
+        assert status["workers"][shard_index]["is_alive"]
+        assert status["workers"][shard_index]["status"]["is_running"]
+        # Empty shard worker exits and is not restarted.
+        assert _wait_for(
+            lambda: not supervisor.status["workers"][1 - shard_index][
+                "is_alive"])
+        assert supervisor.status["workers"][1 - shard_index]["restarts"] == 0
+
+        # Crashed worker is restarted.
+        pid = supervisor.pids[shard_index]
+        os.kill(pid, signal.SIGKILL)
+        assert _wait_for(
+            lambda: supervisor.pids[shard_index] not in (None, pid))
+        assert supervisor.status["workers"][shard_index]["restarts"] == 1
+
+        supervisor.stop()
+        assert not supervisor.is_running
+        assert supervisor.status["workers_alive"] == 0